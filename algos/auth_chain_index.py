@@ -0,0 +1,143 @@
+"""A reachability index over the auth DAG, used to quickly calculate the
+difference between the auth chains of a set of state sets.
+
+This uses a chain cover: every state event is assigned to a chain and given a
+sequence number within that chain, such that an event's predecessor in its
+chain is always one of its auth events. This means if an event is in an auth
+chain then so are all the events before it in its chain, and so an auth chain
+can be described by just the maximum sequence number reachable in each chain.
+
+Working out which events are in some but not all auth chains is then a case of
+comparing the maximum sequence numbers of each chain, rather than walking the
+auth events.
+"""
+
+from synapse.api.constants import EventTypes
+
+
+class AuthChainIndex(object):
+    """Chain cover index of the auth DAG.
+
+    Events must be added after their auth events, which is always the case
+    when events are added in the order they're received.
+    """
+
+    def __init__(self):
+        # Map from event_id to (chain_id, sequence number), with sequence
+        # numbers starting at 1.
+        self._positions = {}
+
+        # Map from chain_id to the list of event_ids in that chain, ordered by
+        # sequence number.
+        self._chains = []
+
+        # Map from chain_id to the type/state_key tuple of the events in it.
+        self._chain_keys = []
+
+        # Map from event_id to a dict of chain_id to the maximum sequence
+        # number in that chain that is in the event's auth chain (including
+        # the event itself).
+        self._reach = {}
+
+    def __contains__(self, event_id):
+        return event_id in self._positions
+
+    def add_event(self, event):
+        """Add a state event to the index.
+
+        Args:
+            event (FrozenEvent)
+        """
+        if event.event_id in self._positions:
+            return
+
+        key = (event.type, event.state_key)
+        auth_ids = [aid for aid, _ in event.auth_events]
+
+        # We try and extend the chain of an auth event with the same
+        # type/state_key, but only if that event is currently the end of its
+        # chain.
+        chain_id = None
+        for aid in auth_ids:
+            aid_chain_id, seq = self._positions[aid]
+            if (
+                self._chain_keys[aid_chain_id] == key
+                and len(self._chains[aid_chain_id]) == seq
+            ):
+                chain_id = aid_chain_id
+                break
+        else:
+            chain_id = len(self._chains)
+            self._chains.append([])
+            self._chain_keys.append(key)
+
+        chain = self._chains[chain_id]
+        chain.append(event.event_id)
+        seq = len(chain)
+
+        reach = {}
+        for aid in auth_ids:
+            _update_reach(reach, self._reach[aid])
+        reach[chain_id] = seq
+
+        self._positions[event.event_id] = (chain_id, seq)
+        self._reach[event.event_id] = reach
+
+    def get_auth_chain_difference(self, state_sets):
+        """Compare the auth chains of each state set and return the set of
+        events that only appear in some but not all of the auth chains.
+
+        Args:
+            state_sets(list[dict[tuple[str, str], str]])
+
+        Returns:
+            set[str]
+        """
+        # Events that appear in every state set contribute the same to each
+        # auth chain, so we only need to look at them once.
+        common = set(state_sets[0].values()).intersection(
+            *(s.values() for s in state_sets[1:])
+        )
+
+        common_reach = {}
+        for key, eid in state_sets[0].items():
+            if eid in common and _is_auth_key(key):
+                _update_reach(common_reach, self._reach[eid])
+
+        reaches = []
+        for state_set in state_sets:
+            reach = dict(common_reach)
+            for key, eid in state_set.items():
+                if eid not in common and _is_auth_key(key):
+                    _update_reach(reach, self._reach[eid])
+            reaches.append(reach)
+
+        difference = set()
+        for chain_id in set().union(*reaches):
+            seqs = [reach.get(chain_id, 0) for reach in reaches]
+            lowest, highest = min(seqs), max(seqs)
+            if lowest < highest:
+                # Sequence numbers start at 1, so this is all events with a
+                # sequence number in (lowest, highest]
+                difference.update(self._chains[chain_id][lowest:highest])
+
+        return difference
+
+
+def _update_reach(reach, other):
+    """Update reach with the maximum sequence number for each chain from other
+    """
+    for chain_id, seq in other.items():
+        if reach.get(chain_id, 0) < seq:
+            reach[chain_id] = seq
+
+
+def _is_auth_key(key):
+    if key[0] in (EventTypes.Member, EventTypes.ThirdPartyInvite):
+        return True
+
+    return key in (
+        (EventTypes.PowerLevels, ""),
+        (EventTypes.JoinRules, ""),
+        (EventTypes.Create, ""),
+    )
@@ -0,0 +1,114 @@
+"""Caches the result of auth checking an event against a set of auth events.
+
+The same event gets auth checked against the same auth events many times: in
+each pass of the resolvers, and again when replaying the room at every merge
+the event is still conflicted at. `event_auth.check` only looks at the auth
+events whose type/state_key are given by `auth_types_for_event`, so the result
+only depends on the event and which events those are.
+"""
+
+from synapse import event_auth
+from synapse.api.errors import AuthError
+
+from algos.lru_cache import LruCache
+
+
+_MISSING = object()
+
+
+class AuthCheckCache(object):
+    """An LRU cache of the result of `event_auth.check`, keyed by the event_id
+    and the event_ids of the auth events that the check can consult.
+    """
+
+    def __init__(self, max_size=10000):
+        self._cache = LruCache(max_size)
+
+        # Map from event_id to the result of `auth_types_for_event`, which
+        # only depends on the event. Bounded to the same size as the results.
+        self._auth_types = LruCache(max_size)
+
+    @property
+    def hits(self):
+        return self._cache.hits
+
+    @property
+    def misses(self):
+        return self._cache.misses
+
+    @property
+    def evictions(self):
+        return self._cache.evictions
+
+    def check(self, event, auth_events):
+        """Check the event is allowed by the auth events, as `check_auth`.
+
+        Args:
+            event (FrozenEvent)
+            auth_events (dict[tuple[str, str], FrozenEvent])
+
+        Raises:
+            AuthError: if the event isn't allowed
+        """
+        key = self._get_cache_key(event, auth_events)
+
+        error = self._cache.get(key, _MISSING)
+        if error is _MISSING:
+            try:
+                event_auth.check(
+                    event, auth_events,
+                    do_sig_check=False,
+                    do_size_check=False,
+                )
+                error = None
+            except AuthError as e:
+                # We don't want to keep the frames of the failed check alive
+                error = e.with_traceback(None)
+
+            self._cache.set(key, error)
+
+        if error is not None:
+            raise error.with_traceback(None)
+
+    def _get_cache_key(self, event, auth_events):
+        auth_types = self._auth_types.get(event.event_id)
+        if auth_types is None:
+            auth_types = tuple(event_auth.auth_types_for_event(event))
+            self._auth_types.set(event.event_id, auth_types)
+
+        auth_event_ids = []
+        for key in auth_types:
+            auth_event = auth_events.get(key)
+            auth_event_ids.append(
+                auth_event.event_id if auth_event is not None else None
+            )
+
+        return event.event_id, tuple(auth_event_ids)
+
+    def describe_stats(self):
+        return self._cache.describe_stats()
+
+
+def check_auth(event, auth_events, event_map):
+    """Check the event is allowed by the auth events, like `event_auth.check`
+    without the signature and size checks. If the event map has an
+    `auth_check_cache` then that is used.
+
+    Args:
+        event (FrozenEvent)
+        auth_events (dict[tuple[str, str], FrozenEvent])
+        event_map (dict[str, FrozenEvent])
+
+    Raises:
+        AuthError: if the event isn't allowed
+    """
+    cache = getattr(event_map, "auth_check_cache", None)
+    if cache is not None:
+        cache.check(event, auth_events)
+        return
+
+    event_auth.check(
+        event, auth_events,
+        do_sig_check=False,
+        do_size_check=False,
+    )
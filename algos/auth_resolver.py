@@ -12,10 +12,13 @@ the algorithm doesn't necessarily pick the "latest" topic.
 
 import itertools
 
-from synapse import event_auth
 from synapse.api.constants import EventTypes
 from synapse.api.errors import AuthError
 
+from algos import instrumentation
+from algos.auth_check_cache import check_auth
+from algos.event_map import prefetch_state_auth_chains
+
 
 def resolver(state_sets, event_map):
     """Given a set of state return the resolved state.
@@ -28,13 +31,26 @@ def resolver(state_sets, event_map):
     Returns:
         dict[tuple[str, str], str]: The resolved state map.
     """
+    if getattr(event_map, "is_compact", False):
+        return event_map.externalise_state(resolver_compact(
+            [event_map.intern_state(s) for s in state_sets], event_map,
+        ))
+
+    stats = instrumentation.start_resolution(__name__)
 
     # First split up the un/conflicted state
     unconflicted_state, conflicted_state = _seperate(state_sets)
+    stats.lap("seperate")
+
+    # If the events are loaded lazily, load the auth chains we're about to
+    # walk in one go.
+    if prefetch_state_auth_chains(state_sets, event_map, skip_common=False):
+        stats.lap("prefetch")
 
     # Also fetch all auth events that appear in only some of the state sets'
     # auth chains.
     auth_diff = _get_auth_chain_difference(state_sets, event_map)
+    stats.lap("auth_chain_difference")
 
     # Now order the conflicted state and auth_diff by power level (falling
     # back to event_id to tie break consistently).
@@ -47,6 +63,10 @@ def resolver(state_sets, event_map):
     ]
     event_id_to_level.sort()
 
+    stats.incr("conflicted_keys", len(conflicted_state))
+    stats.incr("auth_difference", len(auth_diff))
+    stats.incr("full_conflicted_set", len(event_id_to_level))
+
     events_sorted_by_power = [eid for _, eid in event_id_to_level]
 
     # Now we reorder the list to ensure that auth dependencies of an event
@@ -67,6 +87,8 @@ def resolver(state_sets, event_map):
         ev = events_sorted_by_power.pop()
         add_to_list(ev)
 
+    stats.lap("power_sort")
+
     # Now we go through the sorted events and auth each one in turn, using any
     # previously successfully auth'ed events (falling back to their auth events
     # if they don't exist)
@@ -81,15 +103,13 @@ def resolver(state_sets, event_map):
             for key, eid in overridden_state.items():
                 auth_events[key] = event_map[eid]
 
+        stats.incr("auth_checks")
         try:
-            event_auth.check(
-                event, auth_events,
-                do_sig_check=False,
-                do_size_check=False
-            )
+            check_auth(event, auth_events, event_map)
             allowed = True
             overridden_state[(event.type, event.state_key)] = event_id
         except AuthError:
+            stats.incr("auth_rejections")
             allowed = False
 
         event_id_to_auth[event_id] = allowed
@@ -112,6 +132,8 @@ def resolver(state_sets, event_map):
                 resolved_state[key] = resolved_eid
                 break
 
+    stats.lap("auth_checks")
+
     return resolved_state
 
 
@@ -119,6 +141,10 @@ def _get_power_level_for_sender(event_id, event_map):
     """Return the power level of the sender of the given event according to
     their auth events.
     """
+    cache = getattr(event_map, "power_level_cache", None)
+    if cache is not None:
+        return cache.get_sender_level(event_id, event_map, check_creator=False)
+
     event = event_map[event_id]
 
     for aid, _ in event.auth_events:
@@ -143,6 +169,10 @@ def _get_auth_chain_difference(state_sets, event_map):
     """Compare the auth chains of each state set and return the set of events
     that only appear in some but not all of the auth chains.
     """
+    index = getattr(event_map, "auth_chain_index", None)
+    if index is not None:
+        return index.get_auth_chain_difference(state_sets)
+
     auth_sets = []
     for state_set in state_sets:
         auth_ids = set(
@@ -204,3 +234,154 @@ def _is_auth_event(key):
         (EventTypes.JoinRules, ""),
         (EventTypes.Create, ""),
     )
+
+
+def resolver_compact(state_sets, store):
+    """Given a set of interned state return the resolved state. This is the
+    same algorithm as `resolver`, but operates on interned ints throughout.
+
+    Args:
+        state_sets(list[dict[int, int]]): A list of dicts from interned
+            type/state_key to interned event ID
+        store(CompactEventStore)
+
+    Returns:
+        dict[int, int]: The resolved interned state map.
+    """
+    records = store.records
+
+    stats = instrumentation.start_resolution(__name__)
+
+    # First split up the un/conflicted state
+    unconflicted_state, conflicted_state = store.seperate(state_sets)
+    stats.lap("seperate")
+
+    # Also fetch all auth events that appear in only some of the state sets'
+    # auth chains.
+    auth_diff = store.auth_chain_difference(state_sets)
+    stats.lap("auth_chain_difference")
+
+    # Now order the conflicted state and auth_diff by power level (falling
+    # back to event_id to tie break consistently).
+    event_id_to_level = [
+        (
+            _get_power_level_for_sender_compact(idx, store),
+            records[idx].event_id,
+            idx,
+        )
+        for idx in set(itertools.chain(
+            itertools.chain.from_iterable(conflicted_state.values()),
+            auth_diff,
+        ))
+    ]
+    event_id_to_level.sort()
+
+    stats.incr("conflicted_keys", len(conflicted_state))
+    stats.incr("auth_difference", len(auth_diff))
+    stats.incr("full_conflicted_set", len(event_id_to_level))
+
+    events_sorted_by_power = [idx for _, _, idx in event_id_to_level]
+
+    # The events in events_sorted_by_power that haven't been added to the
+    # sorted list yet. We leave added events in events_sorted_by_power and
+    # skip them when we pop them, rather than doing O(n) list removals.
+    unsorted = set(events_sorted_by_power)
+
+    # Now we reorder the list to ensure that auth dependencies of an event
+    # appear before the event in the list
+    sorted_events = []
+
+    def add_to_list(idx):
+        for aid in records[idx].auth:
+            if aid in unsorted:
+                unsorted.remove(aid)
+                add_to_list(aid)
+
+        sorted_events.append(idx)
+
+    while events_sorted_by_power:
+        idx = events_sorted_by_power.pop()
+        if idx in unsorted:
+            unsorted.remove(idx)
+            add_to_list(idx)
+
+    stats.lap("power_sort")
+
+    # Now we go through the sorted events and auth each one in turn, using any
+    # previously successfully auth'ed events (falling back to their auth events
+    # if they don't exist)
+    overridden_state = {}
+    event_id_to_auth = {}
+    _auth_events_compact(
+        sorted_events, overridden_state, event_id_to_auth, store, stats,
+    )
+
+    resolved_state = unconflicted_state
+
+    # Now for each conflicted state type/state_key, pick the latest event tat
+    # has passed auth above, falling back to the first one if none passed auth.
+    _pick_conflicts_compact(
+        conflicted_state, sorted_events, event_id_to_auth, resolved_state,
+    )
+
+    stats.lap("auth_checks")
+
+    return resolved_state
+
+
+def _get_power_level_for_sender_compact(idx, store):
+    """Return the power level of the sender of the given interned event
+    according to their auth events.
+    """
+    record = store.records[idx]
+    if record.power_levels == -1:
+        return 0
+    return record.sender_level
+
+
+def _auth_events_compact(event_idxs, overridden_state, event_id_to_auth,
+                         store, stats=instrumentation.NULL_STATS):
+    """Auth each of the interned events in turn, using the overridden state
+    in preference to their auth events. Events that pass auth are added to
+    overridden_state, and whether each event passed is recorded in
+    event_id_to_auth.
+    """
+    records = store.records
+    events = store.events
+    state_keys = store.state_keys
+
+    for idx in event_idxs:
+        auth_events = store.get_auth_events(idx)
+        if auth_events:
+            for key, oidx in overridden_state.items():
+                auth_events[state_keys[key]] = events[oidx]
+
+        stats.incr("auth_checks")
+        try:
+            check_auth(events[idx], auth_events, store)
+            allowed = True
+            overridden_state[records[idx].key] = idx
+        except AuthError:
+            stats.incr("auth_rejections")
+            allowed = False
+
+        event_id_to_auth[idx] = allowed
+
+
+def _pick_conflicts_compact(conflicted_state, sorted_events, event_id_to_auth,
+                            resolved_state):
+    """For each conflicted key, pick the latest event in sorted_events that
+    passed auth.
+    """
+    for key, conflicted_ids in conflicted_state.items():
+        sorted_conflicts = []
+        for idx in sorted_events:
+            if idx in conflicted_ids:
+                sorted_conflicts.append(idx)
+
+        sorted_conflicts.reverse()
+
+        for idx in sorted_conflicts:
+            if event_id_to_auth[idx]:
+                resolved_state[key] = idx
+                break
@@ -0,0 +1,490 @@
+"""A compact store of events for the resolvers to operate on natively.
+
+Event IDs and type/state_key tuples are interned to ints, and auth events are
+stored as a CSR style adjacency (an array of offsets into an array of auth
+event indices). The fields that resolution needs are pulled out of each
+FrozenEvent once into a slotted `CompactEvent` record, so resolvers that work
+in terms of the interned ints don't need to keep going back to the events.
+
+The store is still an `EventMap`, so resolvers that don't know about it can
+carry on using it as a map from event_id to FrozenEvent. Resolvers that do
+intern their state sets with `intern_state`, resolve with ints, and then
+convert the result back with `externalise_state`.
+
+Auth chains are compared as bitsets over the interned event IDs, held as
+Python ints, so taking the union and intersection of the auth chains of many
+state sets is a word at a time. The bitset of the auth chain of each event is
+built from those of its auth events and kept in an LRU cache.
+
+If NumPy is installed, the conflicted keys of large state sets are found by
+lining the state sets up as rows of an array indexed by interned type/state_key
+and comparing whole columns at a time.
+"""
+
+import sys
+from array import array
+
+from synapse import event_auth
+from synapse.api.constants import EventTypes
+
+from algos.event_map import EventMap
+from algos.lru_cache import LruCache
+from algos.mainline_index import MainlineIndex
+
+
+# Number of entries in the first state set at which `seperate` uses NumPy, if
+# it's installed. Below this building the arrays costs more than it saves.
+_VECTORISE_MIN_KEYS = 100
+
+# The numpy module, False if it isn't installed, or None if it hasn't been
+# needed yet. It's slow to import, so is only imported once there's a state
+# set large enough to use it on, see `_get_numpy`.
+_numpy = None
+
+
+class CompactEvent(object):
+    """The fields of an event needed for resolution.
+
+    Attributes:
+        idx (int): The interned event ID
+        event_id (str)
+        key (int|None): The interned type/state_key, or None if not a state
+            event
+        sender (str)
+        membership (str|None): The membership, if a member event
+        origin_server_ts (int)
+        auth (tuple[int]): The interned auth event IDs
+        auth_types (tuple[int]): The interned type/state_keys that may be
+            needed to auth the event, from `auth_types_for_event`
+        power_levels (int): The interned ID of the power levels event in the
+            auth events, or -1
+        sender_level (int): The power level of the sender according to the
+            auth events. If there is no power levels event this is 100 if the
+            sender created the room, otherwise 0.
+        is_power (bool): Whether this is a "power event", i.e. power levels,
+            join rules, create or a kick/ban.
+    """
+
+    __slots__ = (
+        "idx", "event_id", "key", "sender", "membership", "origin_server_ts",
+        "auth", "auth_types", "power_levels", "sender_level", "is_power",
+    )
+
+
+class CompactEventStore(EventMap):
+    """An EventMap that also keeps an interned, compact copy of each event.
+
+    Resolvers check for the `is_compact` attribute rather than the type, so
+    that they don't have to import this module to handle plain event maps.
+
+    Attributes:
+        event_ids (list[str]): Map from interned ID to event_id
+        events (list[FrozenEvent]): Map from interned ID to event
+        records (list[CompactEvent]): Map from interned ID to record
+        state_keys (list[tuple[str, str]]): Map from interned type/state_key
+            to type/state_key
+        auth_offsets (array): The auth events of the event with interned ID
+            `i` are `auth_targets[auth_offsets[i]:auth_offsets[i + 1]]`
+        auth_targets (array)
+        interned_mainline_index (MainlineIndex): Mainline index of the
+            interned event IDs
+        auth_chain_index (None): The store walks its interned auth events
+            instead, so doesn't keep the event_id based index
+        mainline_index (None): See `interned_mainline_index`
+
+    Args:
+        chain_bits_cache_bytes (int): Maximum total size in bytes of the auth
+            chain bitsets to keep, see `auth_chain_bits`. Each bitset is sized
+            by the interned ID of its event, e.g. ~13KB at the 100,000th
+            event, and replaying a generated 100,000 event room peaks at
+            ~4,800 bitsets (~30MB).
+    """
+
+    is_compact = True
+
+    def __init__(self, chain_bits_cache_bytes=64 * 1024 * 1024):
+        super(CompactEventStore, self).__init__()
+
+        self.auth_chain_index = None
+        self.mainline_index = None
+
+        self.event_ids = []
+        self.events = []
+        self.records = []
+        self._event_idx = {}
+
+        self.state_keys = []
+        self._state_key_idx = {}
+
+        # Whether each interned type/state_key is one whose event ends up in
+        # auth chains.
+        self._is_auth_key = bytearray()
+
+        self.auth_offsets = array("l", [0])
+        self.auth_targets = array("l")
+
+        self.interned_mainline_index = MainlineIndex()
+
+        # Map from interned ID to the bitset of the event's auth chain
+        self._chain_bits = LruCache(
+            chain_bits_cache_bytes, size_callback=sys.getsizeof,
+        )
+
+        self.power_levels_key = self.intern_key((EventTypes.PowerLevels, ""))
+
+    def _index_event(self, event):
+        if event.event_id in self._event_idx:
+            return
+
+        idx = len(self.event_ids)
+
+        record = CompactEvent()
+        record.idx = idx
+        record.event_id = event.event_id
+        record.key = None
+        if event.is_state():
+            record.key = self.intern_key((event.type, event.state_key))
+        record.sender = event.sender
+        record.membership = None
+        if event.type == EventTypes.Member:
+            record.membership = event.membership
+        record.origin_server_ts = event.origin_server_ts
+        record.auth = tuple(
+            self._event_idx[aid] for aid, _ in event.auth_events
+        )
+        record.auth_types = tuple(
+            self.intern_key(key)
+            for key in event_auth.auth_types_for_event(event)
+        )
+        record.power_levels = -1
+        for aid in record.auth:
+            if self.records[aid].key == self.power_levels_key:
+                record.power_levels = aid
+                break
+        record.sender_level = self._get_sender_level(event, record)
+        record.is_power = _is_power_event(event)
+
+        self.event_ids.append(event.event_id)
+        self.events.append(event)
+        self.records.append(record)
+        self._event_idx[event.event_id] = idx
+
+        self.auth_targets.extend(record.auth)
+        self.auth_offsets.append(len(self.auth_targets))
+
+        self.interned_mainline_index.add_event(
+            idx,
+            record.power_levels if record.power_levels != -1 else None,
+        )
+
+    def _get_sender_level(self, event, record):
+        if record.power_levels == -1:
+            # Check if they're creator
+            for aid in record.auth:
+                aev = self.events[aid]
+                if (aev.type, aev.state_key) == (EventTypes.Create, ""):
+                    if aev.content.get("creator") == event.sender:
+                        return 100
+                    break
+            return 0
+
+        compiled = self.power_level_cache.get_compiled(
+            self.events[record.power_levels],
+        )
+        return compiled.get_user_level(event.sender)
+
+    def intern_key(self, key):
+        """Returns the interned int for the type/state_key tuple
+        """
+        key_idx = self._state_key_idx.get(key)
+        if key_idx is None:
+            key_idx = len(self.state_keys)
+            self.state_keys.append(key)
+            self._state_key_idx[key] = key_idx
+            self._is_auth_key.append(_is_auth_key(key))
+        return key_idx
+
+    def is_auth_key(self, key_idx):
+        """Returns whether events with the interned type/state_key can be in
+        auth chains
+        """
+        return bool(self._is_auth_key[key_idx])
+
+    def get_idx(self, event_id):
+        """Returns the interned int for the event_id
+        """
+        return self._event_idx[event_id]
+
+    def intern_state(self, state):
+        """Convert a state map to use interned ints
+
+        Args:
+            state (dict[tuple[str, str], str])
+
+        Returns:
+            dict[int, int]
+        """
+        return {
+            self.intern_key(key): self._event_idx[event_id]
+            for key, event_id in state.items()
+        }
+
+    def externalise_state(self, state):
+        """Convert a state map using interned ints back to type/state_key
+        tuples and event_ids
+
+        Args:
+            state (dict[int, int])
+
+        Returns:
+            dict[tuple[str, str], str]
+        """
+        state_keys = self.state_keys
+        event_ids = self.event_ids
+        return {
+            state_keys[key]: event_ids[idx] for key, idx in state.items()
+        }
+
+    def seperate(self, state_sets):
+        """Return the unconflicted and conflicted state of interned state
+        sets. A key is conflicted if one of the state sets doesn't have it.
+
+        Returns:
+            tuple[dict[int, int], dict[int, set[int]]]
+        """
+        if len(state_sets[0]) >= _VECTORISE_MIN_KEYS:
+            numpy = _get_numpy()
+            if numpy:
+                return self._seperate_vectorised(state_sets, numpy)
+
+        unconflicted_state = {}
+        conflicted_state = {}
+
+        first = state_sets[0]
+        rest = state_sets[1:]
+
+        keys = set(first)
+        for state_set in rest:
+            keys.update(state_set)
+
+        for key in keys:
+            idx = first.get(key)
+            if idx is not None and all(s.get(key) == idx for s in rest):
+                unconflicted_state[key] = idx
+            else:
+                event_ids = set(s.get(key) for s in state_sets)
+                event_ids.discard(None)
+                conflicted_state[key] = event_ids
+
+        return unconflicted_state, conflicted_state
+
+    def _seperate_vectorised(self, state_sets, numpy):
+        """Same as `seperate`, but compares the state sets with NumPy.
+
+        Args:
+            state_sets (list[dict[int, int]])
+            numpy (module)
+        """
+        # Each state set is a row, with the event in the state set for each
+        # interned type/state_key, or -1 if it doesn't have that key.
+        aligned = numpy.full(
+            (len(state_sets), len(self.state_keys)), -1, dtype=numpy.int64,
+        )
+        for row, state_set in zip(aligned, state_sets):
+            size = len(state_set)
+            keys = numpy.fromiter(state_set.keys(), numpy.int64, size)
+            row[keys] = numpy.fromiter(state_set.values(), numpy.int64, size)
+
+        conflicted = (aligned != aligned[0]).any(axis=0)
+        unconflicted_keys = numpy.flatnonzero((aligned[0] != -1) & ~conflicted)
+        conflicted_keys = numpy.flatnonzero(conflicted)
+
+        unconflicted_state = dict(zip(
+            unconflicted_keys.tolist(),
+            aligned[0, unconflicted_keys].tolist(),
+        ))
+
+        conflicted_state = {}
+        for key, column in zip(
+            conflicted_keys.tolist(), aligned[:, conflicted_keys].T.tolist(),
+        ):
+            event_ids = set(column)
+            event_ids.discard(-1)
+            conflicted_state[key] = event_ids
+
+        return unconflicted_state, conflicted_state
+
+    def auth_chain(self, event_idxs, exclude=frozenset()):
+        """Returns the interned IDs of the events and their auth chains,
+        without walking into any events in `exclude`.
+
+        Returns:
+            set[int]
+        """
+        offsets = self.auth_offsets
+        targets = self.auth_targets
+
+        chain = set(idx for idx in event_idxs if idx not in exclude)
+        to_check = list(chain)
+        while to_check:
+            idx = to_check.pop()
+            for aid in targets[offsets[idx]:offsets[idx + 1]]:
+                if aid not in chain and aid not in exclude:
+                    chain.add(aid)
+                    to_check.append(aid)
+
+        return chain
+
+    def auth_chain_bits(self, idx):
+        """Returns the auth chain of the event, including the event itself,
+        as a bitset: an int with bit `i` set if the event with interned ID
+        `i` is in it.
+
+        Returns:
+            int
+        """
+        cache = self._chain_bits
+        bits = cache.get(idx)
+        if bits is not None:
+            return bits
+
+        offsets = self.auth_offsets
+        targets = self.auth_targets
+
+        # Find the events in the auth chain that don't have a cached bitset,
+        # stopping at the ones that do.
+        chain_bits = {}
+        missing = {idx}
+        to_check = [idx]
+        while to_check:
+            i = to_check.pop()
+            for aid in targets[offsets[i]:offsets[i + 1]]:
+                if aid in missing or aid in chain_bits:
+                    continue
+
+                bits = cache.get(aid)
+                if bits is None:
+                    missing.add(aid)
+                    to_check.append(aid)
+                else:
+                    chain_bits[aid] = bits
+
+        # Auth events are always interned before the events they auth, so in
+        # order of interned ID each event comes after its auth events.
+        for i in sorted(missing):
+            bits = 1 << i
+            for aid in targets[offsets[i]:offsets[i + 1]]:
+                bits |= chain_bits[aid]
+            chain_bits[i] = bits
+            cache.set(i, bits)
+
+        return chain_bits[idx]
+
+    def auth_chain_difference(self, state_sets):
+        """Compare the auth chains of each interned state set and return the
+        set of events that only appear in some but not all of the auth chains.
+
+        Args:
+            state_sets (list[dict[int, int]])
+
+        Returns:
+            set[int]
+        """
+        is_auth_key = self._is_auth_key
+        auth_chain_bits = self.auth_chain_bits
+
+        # The events in every state set contribute the same to each auth
+        # chain, so we only look at them once.
+        common = set(state_sets[0].values()).intersection(
+            *(s.values() for s in state_sets[1:])
+        )
+        common_bits = 0
+        for key, idx in state_sets[0].items():
+            if idx in common and is_auth_key[key]:
+                common_bits |= auth_chain_bits(idx)
+
+        union = 0
+        intersection = -1
+        for state_set in state_sets:
+            bits = common_bits
+            for key, idx in state_set.items():
+                if idx not in common and is_auth_key[key]:
+                    bits |= auth_chain_bits(idx)
+
+            union |= bits
+            intersection &= bits
+
+        return _bits_to_set(union & ~intersection)
+
+    def get_auth_events(self, idx):
+        """Returns the auth events of the event as a dict from type/state_key
+        to FrozenEvent, as expected by `event_auth.check`.
+        """
+        records = self.records
+        state_keys = self.state_keys
+        events = self.events
+        return {
+            state_keys[records[aid].key]: events[aid]
+            for aid in records[idx].auth
+        }
+
+
+def _get_numpy():
+    """Returns the numpy module, importing it the first time, or False if it
+    isn't installed.
+    """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy
+
+
+def _bits_to_set(bits):
+    """Returns the indices of the set bits of a non-negative int
+    """
+    # Finding the ones in the binary string is done in C, rather than
+    # clearing the lowest bit one at a time, which copies the whole int each
+    # time.
+    binary = bin(bits)[:1:-1]
+
+    indices = set()
+    i = binary.find("1")
+    while i != -1:
+        indices.add(i)
+        i = binary.find("1", i + 1)
+    return indices
+
+
+def _is_auth_key(key):
+    if key[0] in (EventTypes.Member, EventTypes.ThirdPartyInvite):
+        return True
+
+    return key in (
+        (EventTypes.PowerLevels, ""),
+        (EventTypes.JoinRules, ""),
+        (EventTypes.Create, ""),
+    )
+
+
+def _is_power_event(event):
+    """Return whether or not the event is a "power event"
+    """
+    if not event.is_state():
+        return False
+
+    if (event.type, event.state_key) in (
+        (EventTypes.PowerLevels, ""),
+        (EventTypes.JoinRules, ""),
+        (EventTypes.Create, ""),
+    ):
+        return True
+
+    if event.type == EventTypes.Member:
+        if event.membership in ('leave', 'ban'):
+            return event.sender != event.state_key
+
+    return False
@@ -0,0 +1,95 @@
+"""A map from event_id to event that also maintains indexes over the room.
+
+Resolvers are always given the event map, so this is where anything that can
+be precomputed once per room lives. Resolvers look up the indexes with
+getattr, so a plain dict can still be used as an event map.
+"""
+
+from synapse.api.constants import EventTypes
+
+from algos.auth_chain_index import AuthChainIndex
+from algos.mainline_index import MainlineIndex
+from algos.power_levels import PowerLevelCache
+
+
+class EventMap(dict):
+    """A dict from event_id to FrozenEvent. Events should be added with
+    `add_event` so that the indexes are kept up to date.
+
+    Attributes:
+        auth_chain_index (AuthChainIndex)
+        auth_check_cache (AuthCheckCache|None): If set, used to cache the
+            result of auth checking events, see `check_auth`.
+        power_level_cache (PowerLevelCache)
+        mainline_index (MainlineIndex): Mainline index of the state events
+    """
+
+    def __init__(self):
+        super(EventMap, self).__init__()
+        self.auth_chain_index = AuthChainIndex()
+        self.power_level_cache = PowerLevelCache()
+        self.mainline_index = MainlineIndex()
+        self.auth_check_cache = None
+
+    def add_event(self, event):
+        """Add an event to the map. The event's auth events must already have
+        been added.
+
+        Args:
+            event (FrozenEvent)
+        """
+        self[event.event_id] = event
+        self._index_event(event)
+
+    def _index_event(self, event):
+        """Add a newly added event to the indexes.
+
+        Args:
+            event (FrozenEvent)
+        """
+        if event.is_state():
+            self.auth_chain_index.add_event(event)
+            self.mainline_index.add_event(
+                event.event_id, self._get_power_levels_id(event),
+            )
+
+    def _get_power_levels_id(self, event):
+        """Returns the power levels event in the event's auth events, or None
+        """
+        for aid, _ in event.auth_events:
+            aev = self[aid]
+            if (aev.type, aev.state_key) == (EventTypes.PowerLevels, ""):
+                return aid
+        return None
+
+
+def prefetch_state_auth_chains(state_sets, event_map, skip_common=True):
+    """If the event map supports it, prefetch the auth chains of the events in
+    the state sets.
+
+    Args:
+        state_sets (list[dict[tuple[str, str], str]])
+        event_map (dict[str, FrozenEvent])
+        skip_common (bool): Whether the resolver only walks the auth chains of
+            the events that aren't in every state set, without walking into
+            the ones that are, in which case only those are prefetched.
+
+    Returns:
+        bool: Whether the event map supported prefetching
+    """
+    prefetch = getattr(event_map, "prefetch_auth_chains", None)
+    if prefetch is None:
+        return False
+
+    if not skip_common:
+        prefetch(set().union(*(s.values() for s in state_sets)))
+        return True
+
+    common = set(state_sets[0].values()).intersection(
+        *(s.values() for s in state_sets[1:])
+    )
+    prefetch(
+        set().union(*(s.values() for s in state_sets)) - common,
+        exclude=common,
+    )
+    return True
@@ -0,0 +1,169 @@
+"""Opt-in instrumentation of the resolvers.
+
+Each resolution asks for a `ResolutionStats` with `start_resolution`, and then
+calls `lap` at the end of each of its phases to record how long it took, and
+`incr` to count things like the size of the conflicted set and the number of
+auth checks. Unless a `StatsCollector` has been installed with `collecting`
+this returns a stats object that ignores everything, so the resolvers don't
+pay for instrumentation they're not using.
+
+    collector = StatsCollector()
+    with collecting(collector):
+        resolver(state_sets, event_map)
+    print(collector.summary())
+"""
+
+import contextlib
+import time
+
+
+# The collector installed by `collecting`, if any.
+_collector = None
+
+
+class ResolutionStats(object):
+    """The per phase timings and counters of a single resolution.
+
+    Attributes:
+        resolver (str): Name of the resolver
+        phases (dict[str, float]): Map from phase name to the time spent in
+            that phase, in seconds
+        counters (dict[str, int]): Map from counter name to value
+    """
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.phases = {}
+        self.counters = {}
+
+        self._last_lap = time.perf_counter()
+
+    def lap(self, name):
+        """Add the time since the previous lap, or the start of the
+        resolution, to the named phase.
+        """
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0) + now - self._last_lap
+        self._last_lap = now
+
+    def incr(self, name, amount=1):
+        """Increment the named counter
+        """
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def as_dict(self):
+        return {
+            "resolver": self.resolver,
+            "phases": dict(self.phases),
+            "counters": dict(self.counters),
+        }
+
+
+class _NullStats(object):
+    """A ResolutionStats that ignores everything
+    """
+
+    def lap(self, name):
+        pass
+
+    def incr(self, name, amount=1):
+        pass
+
+
+NULL_STATS = _NullStats()
+
+
+class StatsCollector(object):
+    """Collects the stats of every resolution while installed with
+    `collecting`.
+
+    Attributes:
+        resolutions (list[ResolutionStats])
+    """
+
+    def __init__(self):
+        self.resolutions = []
+
+    def start_resolution(self, resolver):
+        stats = ResolutionStats(resolver)
+        self.resolutions.append(stats)
+        return stats
+
+    def add_resolutions(self, resolutions):
+        """Add the stats of resolutions that happened elsewhere, e.g. in
+        another process.
+        """
+        self.resolutions.extend(resolutions)
+
+    def summary(self):
+        """Returns the totals of each phase and counter across all the
+        resolutions.
+
+        Returns:
+            dict: With keys "resolutions", "phases" and "counters"
+        """
+        phases = {}
+        counters = {}
+        for stats in self.resolutions:
+            for name, elapsed in stats.phases.items():
+                phases[name] = phases.get(name, 0) + elapsed
+            for name, value in stats.counters.items():
+                counters[name] = counters.get(name, 0) + value
+
+        return {
+            "resolutions": len(self.resolutions),
+            "phases": phases,
+            "counters": counters,
+        }
+
+    def as_dict(self):
+        summary = self.summary()
+        summary["per_resolution"] = [
+            stats.as_dict() for stats in self.resolutions
+        ]
+        return summary
+
+
+@contextlib.contextmanager
+def collecting(collector):
+    """Context manager that installs the collector, so that resolutions in
+    this process record their stats to it.
+    """
+    global _collector
+
+    previous = _collector
+    _collector = collector
+    try:
+        yield collector
+    finally:
+        _collector = previous
+
+
+def is_collecting():
+    return _collector is not None
+
+
+def start_resolution(resolver):
+    """Called by resolvers at the start of each resolution.
+
+    Args:
+        resolver (str): Name of the resolver
+
+    Returns:
+        ResolutionStats: The stats to record the resolution to, which ignores
+        everything if no collector is installed.
+    """
+    if _collector is None:
+        return NULL_STATS
+    return _collector.start_resolution(resolver)
+
+
+def add_resolutions(resolutions):
+    """Add the stats of resolutions that happened in another process to the
+    installed collector, if any.
+
+    Args:
+        resolutions (list[ResolutionStats])
+    """
+    if _collector is not None:
+        _collector.add_resolutions(resolutions)
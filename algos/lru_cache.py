@@ -0,0 +1,92 @@
+"""A simple size bounded LRU cache that keeps track of how well it's doing.
+"""
+
+from collections import OrderedDict
+
+
+class LruCache(object):
+    """A dict-like cache that evicts the least recently used entries once it
+    holds more than `max_size` entries, or if `size_callback` is given once
+    the total size of the values is more than `max_size`.
+
+    Args:
+        max_size (int)
+        size_callback (callable[object, int]|None): Returns the size of a
+            value, e.g. in bytes
+
+    Attributes:
+        size (int): Number of entries, or the total size of the values if
+            there is a `size_callback`
+        hits (int): Number of lookups that found an entry
+        misses (int): Number of lookups that didn't find an entry
+        evictions (int): Number of entries that have been evicted
+    """
+
+    def __init__(self, max_size, size_callback=None):
+        self.max_size = max_size
+        self._size_callback = size_callback
+        self._cache = OrderedDict()
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, key):
+        """Whether the key is in the cache. This doesn't count as a lookup or
+        mark the entry as recently used.
+        """
+        return key in self._cache
+
+    def get(self, key, default=None):
+        """Look up a key, marking it as recently used if found.
+        """
+        try:
+            value = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        size_callback = self._size_callback
+        if size_callback is None:
+            if key not in self._cache:
+                self.size += 1
+        else:
+            if key in self._cache:
+                self.size -= size_callback(self._cache[key])
+            self.size += size_callback(value)
+
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+
+        while self.size > self.max_size:
+            _, evicted = self._cache.popitem(last=False)
+            self.size -= 1 if size_callback is None else size_callback(evicted)
+            self.evictions += 1
+
+    def clear(self):
+        self._cache.clear()
+        self.size = 0
+
+    def hit_rate(self):
+        """Returns the fraction of lookups that were hits
+        """
+        lookups = self.hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def describe_stats(self):
+        """Returns a human readable summary of the cache stats
+        """
+        return "%d hits, %d misses (%.1f%% hit rate), %d evictions" % (
+            self.hits, self.misses, 100 * self.hit_rate(), self.evictions,
+        )
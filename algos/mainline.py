@@ -13,10 +13,13 @@ picked.
 
 import itertools
 
-from synapse import event_auth
 from synapse.api.constants import EventTypes
 from synapse.api.errors import AuthError
 
+from algos import instrumentation
+from algos.auth_check_cache import check_auth
+from algos.event_map import prefetch_state_auth_chains
+
 
 def resolver(state_sets, event_map):
     """Given a set of state return the resolved state.
@@ -29,13 +32,26 @@ def resolver(state_sets, event_map):
     Returns:
         dict[tuple[str, str], str]: The resolved state map.
     """
+    if getattr(event_map, "is_compact", False):
+        return event_map.externalise_state(resolver_compact(
+            [event_map.intern_state(s) for s in state_sets], event_map,
+        ))
+
+    stats = instrumentation.start_resolution(__name__)
 
     # First split up the un/conflicted state
     unconflicted_state, conflicted_state = _seperate(state_sets)
+    stats.lap("seperate")
+
+    # If the events are loaded lazily, load the auth chains we're about to
+    # walk in one go.
+    if prefetch_state_auth_chains(state_sets, event_map, skip_common=False):
+        stats.lap("prefetch")
 
     # Also fetch all auth events that appear in only some of the state sets'
     # auth chains.
     auth_diff = _get_auth_chain_difference(state_sets, event_map)
+    stats.lap("auth_chain_difference")
 
     # Now order the conflicted state and auth_diff by power level (falling
     # back to event_id to tie break consistently).
@@ -48,6 +64,10 @@ def resolver(state_sets, event_map):
     ]
     event_id_to_level.sort()
 
+    stats.incr("conflicted_keys", len(conflicted_state))
+    stats.incr("auth_difference", len(auth_diff))
+    stats.incr("full_conflicted_set", len(event_id_to_level))
+
     events_sorted_by_power = [eid for _, eid in event_id_to_level]
 
     # Now we reorder the list to ensure that auth dependencies of an event
@@ -73,6 +93,8 @@ def resolver(state_sets, event_map):
         else:
             leftover_events.append(event_id)
 
+    stats.lap("power_sort")
+
     # Now we go through the sorted events and auth each one in turn, using any
     # previously successfully auth'ed events (falling back to their auth events
     # if they don't exist)
@@ -87,15 +109,13 @@ def resolver(state_sets, event_map):
             for key, eid in overridden_state.items():
                 auth_events[key] = event_map[eid]
 
+        stats.incr("auth_checks")
         try:
-            event_auth.check(
-                event, auth_events,
-                do_sig_check=False,
-                do_size_check=False
-            )
+            check_auth(event, auth_events, event_map)
             allowed = True
             overridden_state[(event.type, event.state_key)] = event_id
         except AuthError:
+            stats.incr("auth_rejections")
             allowed = False
 
         event_id_to_auth[event_id] = allowed
@@ -119,50 +139,33 @@ def resolver(state_sets, event_map):
                 break
 
     resolved_state.update(unconflicted_state)
+    stats.lap("power_auth_checks")
 
     # OK, so we've now resolved the power events. Now mainline them.
     sorted_power_resolved = sorted(resolved_state.values())
 
     mainline = []
+    in_mainline = set()
 
-    def add_to_list_two(event_id):
-        ev = event_map[event_id]
-        for aid, _ in ev.auth_events:
-            if aid not in mainline and event_id_to_auth.get(aid, True):
-                add_to_list_two(aid)
-
-        if event_id not in mainline:
-            mainline.append(event_id)
+    def get_auth_ids(event_id):
+        return [aid for aid, _ in event_map[event_id].auth_events]
 
     while sorted_power_resolved:
         ev_id = sorted_power_resolved.pop()
         ev = event_map[ev_id]
         if _is_power_event(ev):
-            add_to_list_two(ev_id)
+            _add_to_mainline(
+                ev_id, get_auth_ids, event_id_to_auth, mainline, in_mainline,
+            )
 
     mainline_map = {ev_id: i + 1 for i, ev_id in enumerate(mainline)}
 
-    def get_mainline_depth(event_id):
-        if event_id in mainline_map:
-            return mainline_map[event_id]
-
-        ev = event_map[event_id]
-        if not ev.auth_events:
-            return 0
-
-        depth = max(
-            get_mainline_depth(aid)
-            for aid, _ in ev.auth_events
-        )
-
-        return depth
-
-    leftover_events_map = {
-        ev_id: get_mainline_depth(ev_id)
-        for ev_id in leftover_events
-    }
+    leftover_events_map = _get_mainline_depths(
+        leftover_events, get_auth_ids, mainline_map,
+    )
 
     leftover_events.sort(key=lambda ev_id: (leftover_events_map[ev_id], ev_id))
+    stats.lap("mainline_sort")
 
     for event_id in leftover_events:
         event = event_map[event_id]
@@ -173,15 +176,13 @@ def resolver(state_sets, event_map):
             for key, eid in overridden_state.items():
                 auth_events[key] = event_map[eid]
 
+        stats.incr("auth_checks")
         try:
-            event_auth.check(
-                event, auth_events,
-                do_sig_check=False,
-                do_size_check=False
-            )
+            check_auth(event, auth_events, event_map)
             allowed = True
             overridden_state[(event.type, event.state_key)] = event_id
         except AuthError:
+            stats.incr("auth_rejections")
             allowed = False
 
         event_id_to_auth[event_id] = allowed
@@ -201,14 +202,92 @@ def resolver(state_sets, event_map):
                 break
 
     resolved_state.update(unconflicted_state)
+    stats.lap("leftover_auth_checks")
 
     return resolved_state
 
 
+def _add_to_mainline(event_id, get_auth_ids, event_id_to_auth, mainline,
+                     in_mainline):
+    """Adds the event to the mainline after any of its auth events (and
+    theirs, and so on) that aren't already in it and didn't fail auth.
+
+    This walks the auth events depth first with an explicit stack, rather
+    than recursing, as the auth chains can be longer than the recursion
+    limit.
+
+    Args:
+        event_id: The event
+        get_auth_ids (callable): Returns the auth events of an event
+        event_id_to_auth (dict): Whether each event passed auth
+        mainline (list): The mainline so far, which gets appended to
+        in_mainline (set): The events in the mainline
+    """
+    stack = [(event_id, iter(get_auth_ids(event_id)))]
+    while stack:
+        eid, auth_ids = stack[-1]
+        for aid in auth_ids:
+            if aid not in in_mainline and event_id_to_auth.get(aid, True):
+                stack.append((aid, iter(get_auth_ids(aid))))
+                break
+        else:
+            stack.pop()
+            if eid not in in_mainline:
+                mainline.append(eid)
+                in_mainline.add(eid)
+
+
+def _get_mainline_depths(event_ids, get_auth_ids, mainline_map):
+    """Returns the mainline depth of each event, which is its position in the
+    mainline if it's in it, otherwise the maximum mainline depth of its auth
+    events (or 0 if it has none).
+
+    The depths of the auth chains are remembered rather than recalculated
+    for every event that shares them, and are calculated with an explicit
+    stack as the auth chains can be longer than the recursion limit.
+
+    Args:
+        event_ids (list): The events
+        get_auth_ids (callable): Returns the auth events of an event
+        mainline_map (dict): Map from event in the mainline to its position
+
+    Returns:
+        dict: Map from event to mainline depth, which includes the depths
+        of events in their auth chains.
+    """
+    depths = dict(mainline_map)
+
+    for event_id in event_ids:
+        if event_id in depths:
+            continue
+
+        stack = [event_id]
+        while stack:
+            eid = stack[-1]
+            auth_ids = get_auth_ids(eid)
+
+            missing = [aid for aid in auth_ids if aid not in depths]
+            if missing:
+                stack.extend(missing)
+                continue
+
+            stack.pop()
+            if eid not in depths:
+                depths[eid] = max(
+                    (depths[aid] for aid in auth_ids), default=0,
+                )
+
+    return depths
+
+
 def _get_power_level_for_sender(event_id, event_map):
     """Return the power level of the sender of the given event according to
     their auth events.
     """
+    cache = getattr(event_map, "power_level_cache", None)
+    if cache is not None:
+        return cache.get_sender_level(event_id, event_map, check_creator=False)
+
     event = event_map[event_id]
 
     for aid, _ in event.auth_events:
@@ -233,6 +312,10 @@ def _get_auth_chain_difference(state_sets, event_map):
     """Compare the auth chains of each state set and return the set of events
     that only appear in some but not all of the auth chains.
     """
+    index = getattr(event_map, "auth_chain_index", None)
+    if index is not None:
+        return index.get_auth_chain_difference(state_sets)
+
     auth_sets = []
     for state_set in state_sets:
         auth_ids = set(
@@ -309,3 +392,202 @@ def _is_power_event(event):
             return event.sender != event.state_key
 
     return False
+
+
+def resolver_compact(state_sets, store):
+    """Given a set of interned state return the resolved state. This is the
+    same algorithm as `resolver`, but operates on interned ints throughout.
+
+    Args:
+        state_sets(list[dict[int, int]]): A list of dicts from interned
+            type/state_key to interned event ID
+        store(CompactEventStore)
+
+    Returns:
+        dict[int, int]: The resolved interned state map.
+    """
+    records = store.records
+
+    stats = instrumentation.start_resolution(__name__)
+
+    # First split up the un/conflicted state
+    unconflicted_state, conflicted_state = store.seperate(state_sets)
+    stats.lap("seperate")
+
+    # Also fetch all auth events that appear in only some of the state sets'
+    # auth chains.
+    auth_diff = store.auth_chain_difference(state_sets)
+    stats.lap("auth_chain_difference")
+
+    # Now order the conflicted state and auth_diff by power level (falling
+    # back to event_id to tie break consistently).
+    event_id_to_level = [
+        (
+            _get_power_level_for_sender_compact(idx, store),
+            records[idx].event_id,
+            idx,
+        )
+        for idx in set(itertools.chain(
+            itertools.chain.from_iterable(conflicted_state.values()),
+            auth_diff,
+        ))
+    ]
+    event_id_to_level.sort()
+
+    stats.incr("conflicted_keys", len(conflicted_state))
+    stats.incr("auth_difference", len(auth_diff))
+    stats.incr("full_conflicted_set", len(event_id_to_level))
+
+    events_sorted_by_power = [idx for _, _, idx in event_id_to_level]
+
+    # The events in events_sorted_by_power that haven't been added to the
+    # sorted list yet. We leave added events in events_sorted_by_power and
+    # skip them when we pop them, rather than doing O(n) list removals.
+    unsorted = set(events_sorted_by_power)
+
+    # Now we reorder the list to ensure that auth dependencies of an event
+    # appear before the event in the list
+    sorted_events = []
+
+    def add_to_list(idx):
+        for aid in records[idx].auth:
+            if aid in unsorted:
+                unsorted.remove(aid)
+                add_to_list(aid)
+
+        sorted_events.append(idx)
+
+    # First, lets pick out all the events that (probably) require power
+    leftover_events = []
+    while events_sorted_by_power:
+        idx = events_sorted_by_power.pop()
+        if idx not in unsorted:
+            continue
+
+        unsorted.remove(idx)
+        if records[idx].is_power:
+            add_to_list(idx)
+        else:
+            leftover_events.append(idx)
+
+    stats.lap("power_sort")
+
+    # Now we go through the sorted events and auth each one in turn, using any
+    # previously successfully auth'ed events (falling back to their auth events
+    # if they don't exist)
+    overridden_state = {}
+    event_id_to_auth = {}
+    _auth_events_compact(
+        sorted_events, overridden_state, event_id_to_auth, store, stats,
+    )
+
+    resolved_state = {}
+
+    # Now for each conflicted state type/state_key, pick the latest event that
+    # has passed auth above, falling back to the first one if none passed auth.
+    _pick_conflicts_compact(
+        conflicted_state, sorted_events, event_id_to_auth, resolved_state,
+    )
+
+    resolved_state.update(unconflicted_state)
+    stats.lap("power_auth_checks")
+
+    # OK, so we've now resolved the power events. Now mainline them.
+    sorted_power_resolved = sorted(
+        resolved_state.values(), key=lambda idx: records[idx].event_id,
+    )
+
+    mainline = []
+    in_mainline = set()
+
+    def get_auth_ids(idx):
+        return records[idx].auth
+
+    while sorted_power_resolved:
+        idx = sorted_power_resolved.pop()
+        if records[idx].is_power:
+            _add_to_mainline(
+                idx, get_auth_ids, event_id_to_auth, mainline, in_mainline,
+            )
+
+    mainline_map = {idx: i + 1 for i, idx in enumerate(mainline)}
+
+    depths = _get_mainline_depths(leftover_events, get_auth_ids, mainline_map)
+    leftover_events_map = {
+        idx: (depths[idx], records[idx].event_id)
+        for idx in leftover_events
+    }
+
+    leftover_events.sort(key=lambda idx: leftover_events_map[idx])
+    stats.lap("mainline_sort")
+
+    _auth_events_compact(
+        leftover_events, overridden_state, event_id_to_auth, store, stats,
+    )
+
+    _pick_conflicts_compact(
+        conflicted_state, leftover_events, event_id_to_auth, resolved_state,
+    )
+
+    resolved_state.update(unconflicted_state)
+    stats.lap("leftover_auth_checks")
+
+    return resolved_state
+
+
+def _get_power_level_for_sender_compact(idx, store):
+    """Return the power level of the sender of the given interned event
+    according to their auth events.
+    """
+    record = store.records[idx]
+    if record.power_levels == -1:
+        return 0
+    return record.sender_level
+
+
+def _auth_events_compact(event_idxs, overridden_state, event_id_to_auth,
+                         store, stats=instrumentation.NULL_STATS):
+    """Auth each of the interned events in turn, using the overridden state
+    in preference to their auth events. Events that pass auth are added to
+    overridden_state, and whether each event passed is recorded in
+    event_id_to_auth.
+    """
+    records = store.records
+    events = store.events
+    state_keys = store.state_keys
+
+    for idx in event_idxs:
+        auth_events = store.get_auth_events(idx)
+        if auth_events:
+            for key, oidx in overridden_state.items():
+                auth_events[state_keys[key]] = events[oidx]
+
+        stats.incr("auth_checks")
+        try:
+            check_auth(events[idx], auth_events, store)
+            allowed = True
+            overridden_state[records[idx].key] = idx
+        except AuthError:
+            stats.incr("auth_rejections")
+            allowed = False
+
+        event_id_to_auth[idx] = allowed
+
+
+def _pick_conflicts_compact(conflicted_state, sorted_events, event_id_to_auth,
+                            resolved_state):
+    """For each conflicted key, pick the latest event in sorted_events that
+    passed auth.
+    """
+    for key, conflicted_ids in conflicted_state.items():
+        sorted_conflicts = []
+        for idx in sorted_events:
+            if idx in conflicted_ids:
+                sorted_conflicts.append(idx)
+
+        sorted_conflicts.reverse()
+
+        for idx in sorted_conflicts:
+            if event_id_to_auth[idx]:
+                resolved_state[key] = idx
+                break
@@ -0,0 +1,103 @@
+"""An index of the power levels chain of a room, used for mainline ordering.
+
+The "mainline" of a power levels event is that event, followed by the power
+levels event in its auth events, followed by the one in their auth events and
+so on back to the start of the room. Events are then ordered by how far they
+are along the mainline of the resolved power levels event, found by following
+the power levels events in their auth events back until one is on the
+mainline.
+
+The power levels event in an event's auth events never changes, so the index
+just records it for each event as it's added. The mainline depths depend on
+the resolved power levels event, but consecutive resolutions in a room tend to
+share it, so the depths are remembered for the most recently used ones.
+"""
+
+from algos.lru_cache import LruCache
+
+
+class MainlineIndex(object):
+    """Remembers the power levels event in the auth events of each event, and
+    the mainline depth of events for recently used mainlines.
+
+    Events must be added after their auth events. The events can be
+    identified by any hashable, e.g. event_ids or interned ints.
+    """
+
+    def __init__(self, max_mainlines=100):
+        # Map from event to the power levels event in its auth events, or None
+        self._parents = {}
+
+        # Map from resolved power levels event to a dict of event to mainline
+        # depth, which starts off with the events on the mainline.
+        self._depths = LruCache(max_mainlines)
+
+    def __contains__(self, event_id):
+        return event_id in self._parents
+
+    def add_event(self, event_id, power_levels_id):
+        """Add an event to the index.
+
+        Args:
+            event_id: The event
+            power_levels_id: The power levels event in its auth events, or
+                None
+        """
+        self._parents[event_id] = power_levels_id
+
+    def get_mainline_depth(self, event_id, resolved_power_event_id):
+        """Returns the mainline depth of the event.
+
+        If the event is on the mainline this is its position along it,
+        counting from the start of the room. Otherwise it's the depth of the
+        first power levels event on the mainline found by following the power
+        levels events in the auth events, plus the number of steps it took to
+        get there (or just the number of steps, if there isn't one).
+
+        Args:
+            event_id: The event, which must be in the index
+            resolved_power_event_id: The resolved power levels event whose
+                mainline to use, or None
+
+        Returns:
+            int
+        """
+        depths = self._get_depths(resolved_power_event_id)
+
+        # Walk back until we hit an event whose depth we know, and then fill
+        # in the depths of everything we walked past.
+        path = []
+        node = event_id
+        while node not in depths:
+            path.append(node)
+            node = self._parents[node]
+            if node is None:
+                depth = -1
+                break
+        else:
+            depth = depths[node]
+
+        for node in reversed(path):
+            depth += 1
+            depths[node] = depth
+
+        return depths[event_id]
+
+    def _get_depths(self, resolved_power_event_id):
+        depths = self._depths.get(resolved_power_event_id)
+        if depths is None:
+            mainline = []
+            node = resolved_power_event_id
+            while node is not None:
+                mainline.append(node)
+                node = self._parents[node]
+
+            depths = {
+                node: len(mainline) - i for i, node in enumerate(mainline)
+            }
+            self._depths.set(resolved_power_event_id, depths)
+
+        return depths
+
+    def describe_stats(self):
+        return self._depths.describe_stats()
@@ -0,0 +1,116 @@
+"""Cached power level lookups.
+
+Resolvers order events by the power level of their sender, which is worked
+out from the power levels event in the event's auth events (or whether the
+sender created the room, if there isn't one). As an event's auth events never
+change neither does its sender's power level, so it only needs working out
+once per event, and each power levels event only needs parsing once however
+many events point at it.
+"""
+
+from synapse.api.constants import EventTypes
+
+
+class CompiledPowerLevels(object):
+    """The parts of a power levels event needed to look up a user's level.
+
+    Attributes:
+        users (dict[str, int|str]): Map from user_id to their level, as given
+            in the event
+        users_default (int|str|None)
+    """
+
+    __slots__ = ("users", "users_default")
+
+    def __init__(self, event):
+        """
+        Args:
+            event (FrozenEvent): The power levels event
+        """
+        self.users = event.content.get("users", {})
+        self.users_default = event.content.get("users_default", 0)
+
+    def get_user_level(self, user_id):
+        """Returns the level of the user according to these power levels
+
+        Returns:
+            int
+        """
+        level = self.users.get(user_id)
+        if level is None:
+            level = self.users_default
+
+        if level is None:
+            return 0
+        else:
+            return int(level)
+
+
+class PowerLevelCache(object):
+    """Caches the compiled power levels events, and the power level of the
+    sender of each event according to its auth events.
+    """
+
+    def __init__(self):
+        # Map from power levels event_id to CompiledPowerLevels
+        self._compiled = {}
+
+        # Map from event_id to a tuple of the sender's level, and whether the
+        # event had a power levels event in its auth events.
+        self._sender_levels = {}
+
+    def get_compiled(self, event):
+        """Returns the compiled form of the power levels event
+
+        Args:
+            event (FrozenEvent)
+
+        Returns:
+            CompiledPowerLevels
+        """
+        compiled = self._compiled.get(event.event_id)
+        if compiled is None:
+            compiled = CompiledPowerLevels(event)
+            self._compiled[event.event_id] = compiled
+        return compiled
+
+    def get_sender_level(self, event_id, event_map, check_creator=True):
+        """Return the power level of the sender of the given event according
+        to their auth events.
+
+        Args:
+            event_id (str)
+            event_map (dict[str, FrozenEvent])
+            check_creator (bool): Whether a sender with no power levels event
+                in the auth events gets level 100 if they created the room,
+                rather than 0.
+
+        Returns:
+            int
+        """
+        cached = self._sender_levels.get(event_id)
+        if cached is None:
+            cached = self._get_sender_level(event_map[event_id], event_map)
+            self._sender_levels[event_id] = cached
+
+        level, has_power_levels = cached
+        if not has_power_levels and not check_creator:
+            return 0
+        return level
+
+    def _get_sender_level(self, event, event_map):
+        create_event = None
+        for aid, _ in event.auth_events:
+            aev = event_map[aid]
+            key = (aev.type, aev.state_key)
+            if key == (EventTypes.PowerLevels, ""):
+                compiled = self.get_compiled(aev)
+                return compiled.get_user_level(event.sender), True
+            if key == (EventTypes.Create, "") and create_event is None:
+                create_event = aev
+
+        # Check if they're creator
+        if create_event is not None:
+            if create_event.content.get("creator") == event.sender:
+                return 100, False
+        return 0, False
@@ -0,0 +1,88 @@
+"""Caches the result of state resolution, keyed by the state sets being
+resolved.
+
+State sets are identified by their `StateMap.state_hash`, which is maintained
+incrementally as state maps are derived from each other, so looking up a set
+of states doesn't require looking at their contents.
+"""
+
+from algos.lru_cache import LruCache
+from algos.state_map import StateMap
+
+
+class ResolutionCache(object):
+    """An LRU cache of resolved state, keyed by the hashes of the state sets
+    that were resolved.
+
+    The order of the state sets is ignored, since resolution doesn't depend
+    on it.
+    """
+
+    def __init__(self, max_size=1000):
+        self._cache = LruCache(max_size)
+
+    @property
+    def hits(self):
+        return self._cache.hits
+
+    @property
+    def misses(self):
+        return self._cache.misses
+
+    def resolve(self, state_sets, event_map, resolution_func):
+        """Resolve the state sets, using a previous result if we've seen the
+        same state sets before.
+
+        Args:
+            state_sets (list[StateMap])
+            event_map (dict[str, FrozenEvent])
+            resolution_func: The state resolution algorithm
+
+        Returns:
+            StateMap: The resolved state
+        """
+        resolved = self.get(state_sets)
+        if resolved is None:
+            resolved = StateMap.from_dict(
+                resolution_func(state_sets, event_map),
+                base=state_sets[0],
+            )
+            self.set(state_sets, resolved)
+
+        return resolved
+
+    def get(self, state_sets):
+        """Returns the previously resolved state for the state sets, or None
+
+        Args:
+            state_sets (list[StateMap])
+
+        Returns:
+            StateMap|None
+        """
+        return self._cache.get(get_cache_key(state_sets))
+
+    def set(self, state_sets, resolved):
+        """Store the resolved state for the state sets
+
+        Args:
+            state_sets (list[StateMap])
+            resolved (StateMap)
+        """
+        self._cache.set(get_cache_key(state_sets), resolved)
+
+    def describe_stats(self):
+        return self._cache.describe_stats()
+
+
+def get_cache_key(state_sets):
+    """Returns a key that is the same for state sets with the same contents,
+    whatever order they're in.
+
+    Args:
+        state_sets (list[StateMap])
+
+    Returns:
+        tuple[int]
+    """
+    return tuple(sorted(state_set.state_hash for state_set in state_sets))
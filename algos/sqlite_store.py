@@ -0,0 +1,273 @@
+"""An event map backed by a SQLite database, for rooms that don't fit in
+memory.
+
+Events are stored as JSON in an `events` table, with their auth events also
+in an `event_auth` edge table. Events are only hydrated into FrozenEvents
+when looked up, and the most recently used ones are kept in an LRU cache.
+
+Looking up events one at a time means a database round trip per event, which
+adds up when walking auth chains. Resolvers instead call
+`prefetch_auth_chains` with the events they're about to walk from. That walks
+the auth chains in memory as far as they're cached, and then loads the auth
+chains of everything that isn't with a single recursive query over the edge
+table. Resolvers look the method up with getattr, so any event map can opt
+in.
+"""
+
+import json
+import sqlite3
+from collections.abc import Mapping
+
+from synapse.events import FrozenEvent
+from synapse.util.frozenutils import unfreeze
+
+from algos.lru_cache import LruCache
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    event_id TEXT PRIMARY KEY,
+    json TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS event_auth (
+    event_id TEXT NOT NULL,
+    auth_id TEXT NOT NULL,
+    PRIMARY KEY (event_id, auth_id)
+) WITHOUT ROWID;
+
+CREATE TEMP TABLE IF NOT EXISTS prefetch_ids (
+    event_id TEXT PRIMARY KEY
+);
+"""
+
+# Maximum number of event_ids to put in a single `IN (...)` clause, to stay
+# under SQLite's limit on the number of variables in a query.
+_BATCH_SIZE = 500
+
+
+class SqliteEventStore(Mapping):
+    """A read only map from event_id to FrozenEvent, backed by a SQLite
+    database. Events are added with `add_events`.
+
+    The store can be pickled, e.g. to send to the merge worker processes, in
+    which case the copy opens its own connection to the same database.
+
+    Args:
+        path (str): Path to the database, which is created if it doesn't
+            exist
+        cache_size (int): Maximum number of hydrated events to keep
+
+    Attributes:
+        auth_check_cache (AuthCheckCache|None): See `EventMap`
+        round_trips (int): Number of queries made to look up events
+    """
+
+    def __init__(self, path, cache_size=10000):
+        self._path = path
+        self._cache_size = cache_size
+
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(_SCHEMA)
+
+        self._cache = LruCache(cache_size)
+
+        self.auth_check_cache = None
+        self.round_trips = 0
+
+    def __getstate__(self):
+        return {"path": self._path, "cache_size": self._cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["cache_size"])
+
+    def add_events(self, events):
+        """Store the events, replacing any with the same event_ids.
+
+        Args:
+            events (iterable[FrozenEvent])
+        """
+        with self._conn:
+            for event in events:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO events (event_id, json)"
+                    " VALUES (?, ?)",
+                    (event.event_id, json.dumps(unfreeze(event.get_dict()))),
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO event_auth (event_id, auth_id)"
+                    " VALUES (?, ?)",
+                    ((event.event_id, aid) for aid, _ in event.auth_events),
+                )
+
+    def clear(self):
+        """Delete all the events in the store.
+        """
+        with self._conn:
+            self._conn.execute("DELETE FROM events")
+            self._conn.execute("DELETE FROM event_auth")
+        self._cache.clear()
+
+    def close(self):
+        """Close the connection to the database. The store can't be used
+        afterwards.
+        """
+        self._conn.close()
+
+    def __getitem__(self, event_id):
+        event = self._cache.get(event_id)
+        if event is None:
+            event = self._fetch_events([event_id]).get(event_id)
+            if event is None:
+                raise KeyError(event_id)
+        return event
+
+    def __contains__(self, event_id):
+        if event_id in self._cache:
+            return True
+
+        self.round_trips += 1
+        row = self._conn.execute(
+            "SELECT 1 FROM events WHERE event_id = ?", (event_id,),
+        ).fetchone()
+        return row is not None
+
+    def __iter__(self):
+        for row in self._conn.execute("SELECT event_id FROM events"):
+            yield row[0]
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def items(self):
+        """Iterates over all the events in the store with a single query,
+        rather than one per event.
+        """
+        self.round_trips += 1
+        for event_id, event_json in self._conn.execute(
+            "SELECT event_id, json FROM events",
+        ):
+            event = self._cache.get(event_id)
+            if event is None:
+                event = self._hydrate(event_id, event_json)
+            yield event_id, event
+
+    def values(self):
+        return (event for _, event in self.items())
+
+    def get_events(self, event_ids):
+        """Look up a number of events, fetching the ones that aren't cached in
+        batches.
+
+        Args:
+            event_ids (iterable[str])
+
+        Returns:
+            dict[str, FrozenEvent]: The events that were found
+        """
+        events = {}
+        missing = []
+        for event_id in event_ids:
+            event = self._cache.get(event_id)
+            if event is None:
+                missing.append(event_id)
+            else:
+                events[event_id] = event
+
+        events.update(self._fetch_events(missing))
+        return events
+
+    def prefetch_auth_chains(self, event_ids, exclude=frozenset()):
+        """Make sure the events and their auth chains are in the cache, taking
+        at most one query.
+
+        If the auth chains are bigger than the cache then some of the events
+        will be evicted again, and fetched individually when they're used.
+
+        Args:
+            event_ids (iterable[str])
+            exclude (set[str]): Events whose auth chains the caller won't
+                walk into, so don't need to be loaded if they're cached
+        """
+        # Walk the cached part of the auth chains, which also marks them as
+        # recently used so they don't get evicted before they're walked.
+        missing = []
+        seen = set()
+        to_check = list(event_ids)
+        while to_check:
+            event_id = to_check.pop()
+            if event_id in seen or event_id in exclude:
+                continue
+            seen.add(event_id)
+
+            event = self._cache.get(event_id)
+            if event is None:
+                missing.append(event_id)
+            else:
+                to_check.extend(aid for aid, _ in event.auth_events)
+
+        if missing:
+            self._fetch_auth_chains(missing)
+
+    def _fetch_auth_chains(self, event_ids):
+        """Load the events and their auth chains into the cache, in a single
+        query.
+        """
+        with self._conn:
+            self._conn.execute("DELETE FROM prefetch_ids")
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO prefetch_ids (event_id) VALUES (?)",
+                ((event_id,) for event_id in event_ids),
+            )
+
+        self.round_trips += 1
+        rows = self._conn.execute("""
+            WITH RECURSIVE chain(event_id) AS (
+                SELECT event_id FROM prefetch_ids
+                UNION
+                SELECT auth_id FROM event_auth
+                INNER JOIN chain USING (event_id)
+            )
+            SELECT event_id, json FROM events
+            INNER JOIN chain USING (event_id)
+        """)
+
+        for event_id, event_json in rows:
+            if event_id not in self._cache:
+                self._hydrate(event_id, event_json)
+
+    def _fetch_events(self, event_ids):
+        """Fetch events from the database and add them to the cache.
+
+        Returns:
+            dict[str, FrozenEvent]
+        """
+        event_ids = list(event_ids)
+
+        events = {}
+        for i in range(0, len(event_ids), _BATCH_SIZE):
+            batch = event_ids[i:i + _BATCH_SIZE]
+
+            self.round_trips += 1
+            rows = self._conn.execute(
+                "SELECT event_id, json FROM events WHERE event_id IN (%s)" % (
+                    ",".join("?" * len(batch)),
+                ),
+                batch,
+            )
+            for event_id, event_json in rows:
+                events[event_id] = self._hydrate(event_id, event_json)
+
+        return events
+
+    def _hydrate(self, event_id, event_json):
+        event = FrozenEvent(json.loads(event_json))
+        self._cache.set(event_id, event)
+        return event
+
+    def describe_stats(self):
+        """Returns a human readable summary of the store's stats
+        """
+        return "%d round trips, cache: %s" % (
+            self.round_trips, self._cache.describe_stats(),
+        )
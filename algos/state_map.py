@@ -0,0 +1,342 @@
+"""A persistent (immutable) state map that shares structure with the maps it
+was derived from.
+
+The map is stored as a hash array mapped trie: the hash of each key is split
+into 5 bit chunks which are used to index into a tree of 32 way nodes. Adding
+or replacing a key only copies the nodes along the path to that key, so a
+state map derived from another by a single state event shares all but a
+handful of small nodes with it.
+
+Nodes are represented as:
+    list: an interior node with 32 slots, each either None or a node
+    tuple: a leaf of (key hash, key, value)
+    dict: a bucket of keys whose full hashes collide
+
+Each map also has a hash of its contents, which is the sum of the hashes of
+its entries. When a single entry changes the new hash can be derived from the
+old one without looking at the rest of the map.
+"""
+
+import hashlib
+from collections.abc import Mapping
+
+
+_BITS = 5
+_WIDTH = 1 << _BITS
+_MASK = _WIDTH - 1
+
+# Number of bits of the key hash that we use, after which colliding keys get
+# put into a bucket.
+_HASH_BITS = 64
+_HASH_MASK = (1 << _HASH_BITS) - 1
+
+# The hashes of state map entries are summed modulo this
+_HASH_MODULUS = 2 ** 128
+
+
+class StateMap(Mapping):
+    """An immutable map from type/state_key tuples to event_id.
+
+    New maps are derived with `evolve` or `from_dict`.
+    """
+
+    __slots__ = ("_root", "_len", "_state_hash")
+
+    def __init__(self, state=None):
+        """
+        Args:
+            state (dict[tuple[str, str], str]|None): The initial entries
+        """
+        self._root = None
+        self._len = 0
+        self._state_hash = None
+
+        if state:
+            self._root = _build(
+                [(_hash_key(key), key, value) for key, value in state.items()],
+                0,
+            )
+            self._len = len(state)
+
+    @classmethod
+    def from_dict(cls, state, base=None):
+        """Create a map with the same entries as the given dict. If a base map
+        is given the new map shares structure with it, which is cheap when
+        they only differ by a few entries.
+
+        Args:
+            state (dict[tuple[str, str], str])
+            base (StateMap|None)
+
+        Returns:
+            StateMap
+        """
+        if base is None:
+            return cls(state)
+
+        new_map = base
+        added = 0
+        for key, event_id in state.items():
+            base_event_id = base.get(key)
+            if base_event_id != event_id:
+                new_map = new_map.evolve(key, event_id)
+                if base_event_id is None:
+                    added += 1
+
+        # If not every key in the base is in the dict then we need to remove
+        # the extra ones.
+        if len(state) - added != len(base):
+            for key in base:
+                if key not in state:
+                    new_map = new_map.discard(key)
+
+        return new_map
+
+    def _derive(self, root, length, state_hash):
+        new_map = StateMap()
+        new_map._root = root
+        new_map._len = length
+        new_map._state_hash = state_hash
+        return new_map
+
+    def evolve(self, key, event_id):
+        """Returns a new map with the key set to the given event_id.
+
+        Returns:
+            StateMap
+        """
+        root, old_event_id = _assoc(
+            self._root, 0, _hash_key(key), key, event_id,
+        )
+
+        state_hash = None
+        if self._state_hash is not None:
+            state_hash = update_state_hash(
+                self._state_hash, key, old_event_id, event_id,
+            )
+
+        length = self._len + (1 if old_event_id is None else 0)
+        return self._derive(root, length, state_hash)
+
+    def discard(self, key):
+        """Returns a new map without the given key.
+
+        Returns:
+            StateMap
+        """
+        root, old_event_id = _dissoc(self._root, 0, _hash_key(key), key)
+        if old_event_id is None:
+            return self
+
+        state_hash = None
+        if self._state_hash is not None:
+            state_hash = update_state_hash(
+                self._state_hash, key, old_event_id, None,
+            )
+
+        return self._derive(root, self._len - 1, state_hash)
+
+    @property
+    def state_hash(self):
+        """The hash of the contents of the map, see `hash_state`. This is
+        maintained incrementally by `evolve` once it has been calculated.
+        """
+        if self._state_hash is None:
+            self._state_hash = hash_state(self)
+        return self._state_hash
+
+    def __getitem__(self, key):
+        node = self._root
+        key_hash = _hash_key(key)
+        shift = 0
+        while True:
+            node_type = type(node)
+            if node_type is list:
+                node = node[(key_hash >> shift) & _MASK]
+                shift += _BITS
+            elif node_type is tuple:
+                if node[1] == key:
+                    return node[2]
+                raise KeyError(key)
+            elif node_type is dict:
+                return node[key]
+            else:
+                raise KeyError(key)
+
+    def __iter__(self):
+        for key, _ in _iter_entries(self._root):
+            yield key
+
+    def __len__(self):
+        return self._len
+
+    def items(self):
+        return _iter_entries(self._root)
+
+    def values(self):
+        for _, value in _iter_entries(self._root):
+            yield value
+
+    def copy(self):
+        """Returns the contents as a plain dict
+        """
+        return dict(_iter_entries(self._root))
+
+    def __reduce__(self):
+        # The layout depends on hash(), which differs between processes, so
+        # we always rebuild from the entries.
+        return (StateMap, (self.copy(),))
+
+    def __repr__(self):
+        return "StateMap(%r)" % (self.copy(),)
+
+
+def hash_state_entry(key, event_id):
+    """Returns the hash of a single entry in a state map
+
+    Args:
+        key (tuple[str, str])
+        event_id (str|None): None means the entry is absent, which hashes to 0
+
+    Returns:
+        int
+    """
+    if event_id is None:
+        return 0
+
+    digest = hashlib.blake2b(
+        ("%s\0%s\0%s" % (key[0], key[1], event_id)).encode("utf-8"),
+        digest_size=16,
+    ).digest()
+    return int.from_bytes(digest, "big")
+
+
+def hash_state(state):
+    """Returns the hash of a full state map
+
+    Args:
+        state (dict[tuple[str, str], str])
+
+    Returns:
+        int
+    """
+    return sum(
+        hash_state_entry(key, event_id) for key, event_id in state.items()
+    ) % _HASH_MODULUS
+
+
+def update_state_hash(state_hash, key, old_event_id, new_event_id):
+    """Returns the hash of a state map after the entry for key has changed from
+    old_event_id to new_event_id.
+    """
+    return (
+        state_hash
+        - hash_state_entry(key, old_event_id)
+        + hash_state_entry(key, new_event_id)
+    ) % _HASH_MODULUS
+
+
+def _hash_key(key):
+    return hash(key) & _HASH_MASK
+
+
+def _build(entries, shift):
+    """Build a node from a list of (key hash, key, value) tuples
+    """
+    if not entries:
+        return None
+
+    if len(entries) == 1:
+        return entries[0]
+
+    if shift >= _HASH_BITS:
+        return {key: value for _, key, value in entries}
+
+    buckets = [[] for _ in range(_WIDTH)]
+    for entry in entries:
+        buckets[(entry[0] >> shift) & _MASK].append(entry)
+
+    return [_build(bucket, shift + _BITS) for bucket in buckets]
+
+
+def _assoc(node, shift, key_hash, key, value):
+    """Returns a copy of the node with the key set to value, along with the
+    previous value of the key (or None).
+    """
+    node_type = type(node)
+    if node is None:
+        return (key_hash, key, value), None
+
+    if node_type is list:
+        idx = (key_hash >> shift) & _MASK
+        child, old_value = _assoc(
+            node[idx], shift + _BITS, key_hash, key, value,
+        )
+        new_node = list(node)
+        new_node[idx] = child
+        return new_node, old_value
+
+    if node_type is tuple:
+        if node[1] == key:
+            return (key_hash, key, value), node[2]
+
+        if shift >= _HASH_BITS:
+            return {node[1]: node[2], key: value}, None
+
+        new_node = [None] * _WIDTH
+        new_node[(node[0] >> shift) & _MASK] = node
+        return _assoc(new_node, shift, key_hash, key, value)
+
+    new_node = dict(node)
+    new_node[key] = value
+    return new_node, node.get(key)
+
+
+def _dissoc(node, shift, key_hash, key):
+    """Returns a copy of the node without the key, along with the previous
+    value of the key (or None if it wasn't there, in which case the node is
+    returned unchanged).
+    """
+    node_type = type(node)
+    if node is None:
+        return None, None
+
+    if node_type is list:
+        idx = (key_hash >> shift) & _MASK
+        child, old_value = _dissoc(node[idx], shift + _BITS, key_hash, key)
+        if old_value is None:
+            return node, None
+
+        new_node = list(node)
+        new_node[idx] = child
+        if not any(n is not None for n in new_node):
+            return None, old_value
+        return new_node, old_value
+
+    if node_type is tuple:
+        if node[1] == key:
+            return None, node[2]
+        return node, None
+
+    if key not in node:
+        return node, None
+
+    new_node = dict(node)
+    old_value = new_node.pop(key)
+    return (new_node or None), old_value
+
+
+def _iter_entries(node):
+    """Yields the (key, value) pairs under the node
+    """
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        node_type = type(node)
+        if node_type is list:
+            stack.extend(n for n in node if n is not None)
+        elif node_type is tuple:
+            yield node[1], node[2]
+        elif node_type is dict:
+            for entry in node.items():
+                yield entry
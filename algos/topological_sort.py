@@ -0,0 +1,46 @@
+"""A dependency free lexicographical topological sort.
+"""
+
+import heapq
+
+
+def lexicographical_topological_sort(graph, key):
+    """Returns the nodes of the graph in topological order, using the key to
+    pick between nodes whose predecessors have all already been returned.
+    This gives the same order as networkx's function of the same name.
+
+    Args:
+        graph (dict[T, iterable[T]]): Map from each node to its successors.
+            Every node must be a key in the map.
+        key (callable[T]): Function returning the sort key of a node
+
+    Raises:
+        ValueError: if the graph has a cycle
+
+    Returns:
+        list[T]
+    """
+    in_degree = dict.fromkeys(graph, 0)
+    for successors in graph.values():
+        for node in successors:
+            in_degree[node] += 1
+
+    heap = [
+        (key(node), node) for node, degree in in_degree.items() if not degree
+    ]
+    heapq.heapify(heap)
+
+    sorted_nodes = []
+    while heap:
+        _, node = heapq.heappop(heap)
+        sorted_nodes.append(node)
+
+        for successor in graph[node]:
+            in_degree[successor] -= 1
+            if not in_degree[successor]:
+                heapq.heappush(heap, (key(successor), successor))
+
+    if len(sorted_nodes) != len(graph):
+        raise ValueError("Graph contains a cycle")
+
+    return sorted_nodes
@@ -1,13 +1,19 @@
 """This is an example implementation of state resolution using power and
 mainline ordering.
 """
+import functools
 import itertools
-import networkx
 
 from synapse import event_auth, events
 from synapse.api.constants import EventTypes
 from synapse.api.errors import AuthError
 
+from algos import instrumentation
+from algos.auth_check_cache import check_auth
+from algos.event_map import EventMap
+from algos.event_map import prefetch_state_auth_chains
+from algos.topological_sort import lexicographical_topological_sort
+
 
 events.USE_FROZEN_DICTS = False
 
@@ -23,19 +29,141 @@ def resolver(state_sets, event_map):
     Returns:
         dict[tuple[str, str], str]: The resolved state map.
     """
+    if getattr(event_map, "is_compact", False):
+        return event_map.externalise_state(resolver_compact(
+            [event_map.intern_state(s) for s in state_sets], event_map,
+        ))
+
+    return _resolve(state_sets, event_map)
+
+
+def resolve_many(state_sets_list, event_map):
+    """Resolve each of a list of independent sets of state sets, e.g. all the
+    merges in one generation of the room DAG.
+
+    This gives the same results as calling `resolver` on each, but shares the
+    work that only depends on a single event or state set. Each distinct
+    state set object is only interned once. If the event map isn't an
+    `EventMap` then the events involved are indexed once for the whole batch,
+    so that power levels and mainline depths are calculated once per event,
+    after prefetching their auth chains if the event map supports it.
+
+    Args:
+        state_sets_list(list[list[dict[tuple[str, str], str]]]): The state
+            sets of each resolution
+        event_map(dict[str, FrozenEvent]): Map from event_id to event
+
+    Returns:
+        list[dict[tuple[str, str], str]]: The resolved state maps, in order.
+    """
+    distinct = {}
+    state_sets_list = [
+        [
+            distinct.setdefault(id(state_set), state_set)
+            for state_set in state_sets
+        ]
+        for state_sets in state_sets_list
+    ]
+
+    if getattr(event_map, "is_compact", False):
+        interned = {
+            id(state_set): event_map.intern_state(state_set)
+            for state_set in distinct.values()
+        }
+
+        return [
+            event_map.externalise_state(resolver_compact(
+                [interned[id(state_set)] for state_set in state_sets],
+                event_map,
+            ))
+            for state_sets in state_sets_list
+        ]
+
+    if getattr(event_map, "auth_chain_index", None) is None:
+        prefetch_state_auth_chains(
+            list(distinct.values()), event_map, skip_common=False,
+        )
+        event_map = _index_events(distinct.values(), event_map)
+
+    return [
+        _resolve(state_sets, event_map) for state_sets in state_sets_list
+    ]
+
+
+def _index_events(state_sets, event_map):
+    """Returns an EventMap of the events in the state sets and their auth
+    chains, which are all the events that resolving them looks at.
+    """
+    dependents = {}
+    to_check = [
+        eid for state_set in state_sets for eid in state_set.values()
+    ]
+    while to_check:
+        eid = to_check.pop()
+        if eid in dependents:
+            continue
+        dependents[eid] = []
+        to_check.extend(aid for aid, _ in event_map[eid].auth_events)
+
+    for eid in dependents:
+        for aid, _ in event_map[eid].auth_events:
+            dependents[aid].append(eid)
+
+    indexed = EventMap()
+    indexed.auth_check_cache = getattr(event_map, "auth_check_cache", None)
+    for eid in lexicographical_topological_sort(dependents, key=str):
+        indexed.add_event(event_map[eid])
+
+    return indexed
+
+
+def _resolve(state_sets, event_map):
+    """Resolves string state sets, see `resolver`.
+
+    Args:
+        state_sets(list[dict[tuple[str, str], str]])
+        event_map(dict[str, FrozenEvent])
+
+    Returns:
+        dict[tuple[str, str], str]
+    """
+    stats = instrumentation.start_resolution(__name__)
 
     # First split up the un/conflicted state
     unconflicted_state, conflicted_state = _seperate(state_sets)
-
-    # Also fetch all auth events that appear in only some of the state sets'
-    # auth chains.
-    auth_diff = _get_auth_chain_difference(state_sets, event_map)
+    stats.lap("seperate")
+
+    # If nothing conflicts then the state sets are all the same.
+    if not conflicted_state:
+        stats.incr("shortcut_unconflicted")
+        return unconflicted_state
+
+    # If the events are loaded lazily, load the auth chains we're about to
+    # walk in one go.
+    if prefetch_state_auth_chains(state_sets, event_map):
+        stats.lap("prefetch")
+
+    if any(_is_auth_key(key) for key in conflicted_state):
+        # Also fetch all auth events that appear in only some of the state
+        # sets' auth chains.
+        auth_diff = _get_auth_chain_difference(state_sets, event_map)
+        stats.lap("auth_chain_difference")
+    else:
+        # Only keys that don't go into auth chains conflict, so every state
+        # set has the same auth chain and none of the conflicted events are
+        # power events. All that's left is to sort them by mainline.
+        stats.incr("shortcut_non_auth_conflicts")
+        auth_diff = set()
 
     full_conflicted_set = set(itertools.chain(
         itertools.chain.from_iterable(conflicted_state.values()),
         auth_diff,
     ))
 
+    stats.incr("conflicted_keys", len(conflicted_state))
+    stats.incr("auth_difference", len(auth_diff))
+    stats.incr("full_conflicted_set", len(full_conflicted_set))
+
     # Get and sort all the power events (kicks/bans/etc)
     power_events = (
         eid for eid in full_conflicted_set
@@ -46,11 +174,13 @@ def resolver(state_sets, event_map):
         event_map,
         auth_diff
     )
+    stats.lap("power_sort")
 
     # Now sequentially auth each one
     resolved_state = _iterative_auth_checks(
-        sorted_power_events, unconflicted_state, event_map,
+        sorted_power_events, unconflicted_state, event_map, stats,
     )
+    stats.lap("power_auth_checks")
 
     # OK, so we've now resolved the power events. Now sort the remaining
     # events using the mainline of the resolved power level.
@@ -63,10 +193,12 @@ def resolver(state_sets, event_map):
 
     pl = resolved_state.get((EventTypes.PowerLevels, ""), None)
     leftover_events = _mainline_sort(leftover_events, pl, event_map)
+    stats.lap("mainline_sort")
 
     resolved_state = _iterative_auth_checks(
-        leftover_events, resolved_state, event_map,
+        leftover_events, resolved_state, event_map, stats,
     )
+    stats.lap("leftover_auth_checks")
 
     # We make sure that unconflicted state always still applies.
     resolved_state.update(unconflicted_state)
@@ -78,6 +210,10 @@ def _get_power_level_for_sender(event_id, event_map):
     """Return the power level of the sender of the given event according to
     their auth events.
     """
+    cache = getattr(event_map, "power_level_cache", None)
+    if cache is not None:
+        return cache.get_sender_level(event_id, event_map)
+
     event = event_map[event_id]
 
     for aid, _ in event.auth_events:
@@ -108,6 +244,12 @@ def _get_power_level_for_sender(event_id, event_map):
 def _get_auth_chain_difference(state_sets, event_map):
     """Compare the auth chains of each state set and return the set of events
     that only appear in some but not all of the auth chains.
+
+    The auth chains are walked without walking into events that are in every
+    state set, so events that are only reached through those aren't counted
+    as being in the auth chain. This means events that are in every auth
+    chain can end up in the difference, which is why this doesn't use the
+    exact difference from `AuthChainIndex` like the other resolvers do.
     """
     common = set(state_sets[0].values()).intersection(
         *(s.values() for s in state_sets[1:])
@@ -118,14 +260,7 @@ def _get_auth_chain_difference(state_sets, event_map):
         auth_ids = set(
             eid
             for key, eid in state_set.items()
-            if (key[0] in (
-                 EventTypes.Member,
-                 EventTypes.ThirdPartyInvite,
-            ) or key in (
-                (EventTypes.PowerLevels, ''),
-                (EventTypes.Create, ''),
-                (EventTypes.JoinRules, ''),
-            )) and eid not in common
+            if _is_auth_key(key) and eid not in common
         )
 
         to_check = auth_ids
@@ -174,6 +309,19 @@ def _seperate(state_sets):
     return unconflicted_state, conflicted_state
 
 
+def _is_auth_key(key):
+    """Return whether events with the type/state_key can be in auth chains
+    """
+    if key[0] in (EventTypes.Member, EventTypes.ThirdPartyInvite):
+        return True
+
+    return key in (
+        (EventTypes.PowerLevels, ""),
+        (EventTypes.JoinRules, ""),
+        (EventTypes.Create, ""),
+    )
+
+
 def _is_power_event(event):
     """Return whether or not the event is a "power event"
     """
@@ -195,7 +343,7 @@ def _add_event_and_auth_chain_to_graph(graph, event_id, event_map, auth_diff):
     """Helper function for _reverse_topological_power_sort that add the event
     and its auth chain (that is in the auth diff) to the graph
     """
-    graph.add_node(event_id)
+    graph.setdefault(event_id, set())
 
     state = [event_id]
     while state:
@@ -204,7 +352,7 @@ def _add_event_and_auth_chain_to_graph(graph, event_id, event_map, auth_diff):
             if aid in auth_diff:
                 # We add the reverse edge because we want to do reverse
                 # topological ordering
-                graph.add_edge(aid, eid)
+                graph.setdefault(aid, set()).add(eid)
                 if aid not in graph:
                     state.append(aid)
 
@@ -214,7 +362,7 @@ def _reverse_topological_power_sort(event_ids, event_map, auth_diff):
     and then by power level and origin_server_ts
     """
 
-    graph = networkx.DiGraph()
+    graph = {}
     for event_id in event_ids:
         _add_event_and_auth_chain_to_graph(
             graph, event_id, event_map, auth_diff,
@@ -226,16 +374,11 @@ def _reverse_topological_power_sort(event_ids, event_map, auth_diff):
 
         return -pl, ev.origin_server_ts, event_id
 
-    it = networkx.algorithms.dag.lexicographical_topological_sort(
-        graph,
-        key=_get_power_order,
-    )
-    sorted_events = list(it)
+    return lexicographical_topological_sort(graph, key=_get_power_order)
 
-    return sorted_events
 
-
-def _iterative_auth_checks(event_ids, base_state, event_map):
+def _iterative_auth_checks(event_ids, base_state, event_map,
+                           stats=instrumentation.NULL_STATS):
     """Sequentially apply auth checks to each event in given list, updating the
     state as it goes along.
     """
@@ -252,16 +395,13 @@ def _iterative_auth_checks(event_ids, base_state, event_map):
             if key in resolved_state:
                 auth_events[key] = event_map[resolved_state[key]]
 
+        stats.incr("auth_checks")
         try:
-            event_auth.check(
-                event, auth_events,
-                do_sig_check=False,
-                do_size_check=False
-            )
+            check_auth(event, auth_events, event_map)
 
             resolved_state[(event.type, event.state_key)] = event_id
         except AuthError:
-            pass
+            stats.incr("auth_rejections")
 
     return resolved_state
 
@@ -270,42 +410,250 @@ def _mainline_sort(event_ids, resolved_power_event_id, event_map):
     """Returns a sorted list of event_ids sorted by mainline ordering based on
     the given event resolved_power_event_id
     """
+    index = getattr(event_map, "mainline_index", None)
+    if index is not None:
+        get_mainline_depth = functools.partial(
+            index.get_mainline_depth,
+            resolved_power_event_id=resolved_power_event_id,
+        )
+    else:
+        get_mainline_depth = _get_mainline_depth_func(
+            resolved_power_event_id, event_map,
+        )
+
+    event_ids = list(event_ids)
+
+    order_map = {
+        ev_id: (
+            get_mainline_depth(ev_id),
+            event_map[ev_id].origin_server_ts,
+            ev_id,
+        )
+        for ev_id in event_ids
+    }
+
+    event_ids.sort(key=lambda ev_id: order_map[ev_id])
+
+    return event_ids
+
+
+def _get_mainline_depth_func(resolved_power_event_id, event_map):
+    """Returns a function that calculates the mainline depth of an event,
+    for event maps that don't have a `MainlineIndex`.
+    """
     mainline = []
     pl = resolved_power_event_id
     while pl:
         mainline.append(pl)
-        auth_events = event_map[pl].auth_events
-        pl = None
-        for aid, _ in auth_events:
-            ev = event_map[aid]
-            if (ev.type, ev.state_key) == (EventTypes.PowerLevels, ""):
-                pl = aid
-                break
+        pl = _get_power_levels_id(event_map[pl], event_map)
 
     mainline_map = {ev_id: i + 1 for i, ev_id in enumerate(reversed(mainline))}
 
-    def get_mainline_depth(event):
-        if event.event_id in mainline_map:
-            return mainline_map[event.event_id]
+    def get_mainline_depth(event_id):
+        # Walk back through the power levels events until we hit the
+        # mainline, counting the steps.
+        steps = 0
+        while event_id not in mainline_map:
+            event_id = _get_power_levels_id(event_map[event_id], event_map)
+            if event_id is None:
+                return steps
+            steps += 1
 
-        for aid, _ in event.auth_events:
-            aev = event_map[aid]
-            if (aev.type, aev.state_key) == (EventTypes.PowerLevels, ""):
-                return get_mainline_depth(aev) + 1
+        return mainline_map[event_id] + steps
 
-        return 0
+    return get_mainline_depth
+
+
+def _get_power_levels_id(event, event_map):
+    """Returns the power levels event in the event's auth events, or None
+    """
+    for aid, _ in event.auth_events:
+        aev = event_map[aid]
+        if (aev.type, aev.state_key) == (EventTypes.PowerLevels, ""):
+            return aid
+    return None
 
-    event_ids = list(event_ids)
+
+def resolver_compact(state_sets, store):
+    """Given a set of interned state return the resolved state. This is the
+    same algorithm as `resolver`, but operates on interned ints throughout.
+
+    Args:
+        state_sets(list[dict[int, int]]): A list of dicts from interned
+            type/state_key to interned event ID
+        store(CompactEventStore)
+
+    Returns:
+        dict[int, int]: The resolved interned state map.
+    """
+    records = store.records
+
+    stats = instrumentation.start_resolution(__name__)
+
+    # First split up the un/conflicted state
+    unconflicted_state, conflicted_state = store.seperate(state_sets)
+    stats.lap("seperate")
+
+    # These shortcuts are the same as in `_resolve`.
+    if not conflicted_state:
+        stats.incr("shortcut_unconflicted")
+        return unconflicted_state
+
+    if any(store.is_auth_key(key) for key in conflicted_state):
+        # Also fetch all auth events that appear in only some of the state
+        # sets' auth chains.
+        auth_diff = _get_auth_chain_difference_compact(state_sets, store)
+        stats.lap("auth_chain_difference")
+    else:
+        stats.incr("shortcut_non_auth_conflicts")
+        auth_diff = set()
+
+    full_conflicted_set = set(itertools.chain(
+        itertools.chain.from_iterable(conflicted_state.values()),
+        auth_diff,
+    ))
+
+    stats.incr("conflicted_keys", len(conflicted_state))
+    stats.incr("auth_difference", len(auth_diff))
+    stats.incr("full_conflicted_set", len(full_conflicted_set))
+
+    # Get and sort all the power events (kicks/bans/etc)
+    power_events = (
+        idx for idx in full_conflicted_set
+        if records[idx].is_power
+    )
+    sorted_power_events = _reverse_topological_power_sort_compact(
+        power_events,
+        store,
+        auth_diff
+    )
+    stats.lap("power_sort")
+
+    # Now sequentially auth each one
+    resolved_state = _iterative_auth_checks_compact(
+        sorted_power_events, unconflicted_state, store, stats,
+    )
+    stats.lap("power_auth_checks")
+
+    # OK, so we've now resolved the power events. Now sort the remaining
+    # events using the mainline of the resolved power level.
+
+    sorted_power_set = set(sorted_power_events)
+    leftover_events = (
+        idx
+        for idx in full_conflicted_set
+        if idx not in sorted_power_set
+    )
+
+    pl = resolved_state.get(store.power_levels_key, None)
+    leftover_events = _mainline_sort_compact(leftover_events, pl, store)
+    stats.lap("mainline_sort")
+
+    resolved_state = _iterative_auth_checks_compact(
+        leftover_events, resolved_state, store, stats,
+    )
+    stats.lap("leftover_auth_checks")
+
+    # We make sure that unconflicted state always still applies.
+    resolved_state.update(unconflicted_state)
+
+    return resolved_state
+
+
+def _get_auth_chain_difference_compact(state_sets, store):
+    """Same as `_get_auth_chain_difference`, for interned state sets.
+    """
+    common = set(state_sets[0].values()).intersection(
+        *(s.values() for s in state_sets[1:])
+    )
+
+    auth_sets = [
+        store.auth_chain(
+            (
+                idx for key, idx in state_set.items()
+                if store.is_auth_key(key) and idx not in common
+            ),
+            exclude=common,
+        )
+        for state_set in state_sets
+    ]
+
+    intersection = set(auth_sets[0]).intersection(*auth_sets[1:])
+    union = set().union(*auth_sets)
+
+    return union - intersection
+
+
+def _reverse_topological_power_sort_compact(event_idxs, store, auth_diff):
+    """Returns a list of the interned event IDs sorted by reverse topological
+    ordering, and then by power level and origin_server_ts
+    """
+    records = store.records
+
+    graph = {}
+    for idx in event_idxs:
+        # Like `_add_event_and_auth_chain_to_graph` we add the event and its
+        # auth events that are in the auth diff.
+        graph.setdefault(idx, set())
+        for aid in records[idx].auth:
+            if aid in auth_diff:
+                graph.setdefault(aid, set()).add(idx)
+
+    def _get_power_order(idx):
+        record = records[idx]
+        return -record.sender_level, record.origin_server_ts, record.event_id
+
+    return lexicographical_topological_sort(graph, key=_get_power_order)
+
+
+def _iterative_auth_checks_compact(event_idxs, base_state, store,
+                                   stats=instrumentation.NULL_STATS):
+    """Sequentially apply auth checks to each event in given list, updating the
+    interned state as it goes along.
+    """
+    records = store.records
+    events = store.events
+    state_keys = store.state_keys
+
+    resolved_state = base_state.copy()
+
+    for idx in event_idxs:
+        record = records[idx]
+
+        auth_events = store.get_auth_events(idx)
+        for key in record.auth_types:
+            if key in resolved_state:
+                auth_events[state_keys[key]] = events[resolved_state[key]]
+
+        stats.incr("auth_checks")
+        try:
+            check_auth(events[idx], auth_events, store)
+
+            resolved_state[record.key] = idx
+        except AuthError:
+            stats.incr("auth_rejections")
+
+    return resolved_state
+
+
+def _mainline_sort_compact(event_idxs, resolved_power_idx, store):
+    """Returns a sorted list of interned event IDs sorted by mainline ordering
+    based on the given interned power levels event ID
+    """
+    records = store.records
+    index = store.interned_mainline_index
+
+    event_idxs = list(event_idxs)
 
     order_map = {
-        ev_id: (
-            get_mainline_depth(event_map[ev_id]),
-            event_map[ev_id].origin_server_ts,
-            ev_id,
+        idx: (
+            index.get_mainline_depth(idx, resolved_power_idx),
+            records[idx].origin_server_ts,
+            records[idx].event_id,
         )
-        for ev_id in event_ids
+        for idx in event_idxs
     }
 
-    event_ids.sort(key=lambda ev_id: order_map[ev_id])
+    event_idxs.sort(key=lambda idx: order_map[idx])
 
-    return event_ids
+    return event_idxs
@@ -0,0 +1,354 @@
+"""An asyncio version of the `ts_mainline` resolver, for servers that fetch
+events from a database asynchronously.
+
+Rather than indexing into an event map, the resolver loads the events it
+needs through an `EventLoader`, which wraps a pluggable fetcher: a coroutine
+function taking a list of event_ids and returning a dict of those it found.
+Lookups made by concurrent resolutions in the same iteration of the event
+loop are coalesced into a single call to the fetcher.
+
+The events a resolution looks at are the state events and their auth chains,
+so the resolver loads those a level of the auth DAG at a time up front, and
+then runs the same phases as `ts_mainline` over the loaded events. It yields
+to the event loop between phases and every so often during the auth checks,
+so a large resolution doesn't block the loop.
+"""
+
+import asyncio
+import itertools
+
+from synapse import event_auth
+from synapse.api.constants import EventTypes
+from synapse.api.errors import AuthError
+
+from algos import instrumentation
+from algos.auth_check_cache import check_auth
+from algos.ts_mainline import (
+    _get_auth_chain_difference, _is_power_event, _mainline_sort,
+    _reverse_topological_power_sort, _seperate,
+)
+
+
+class LoadedEvents(dict):
+    """A dict from event_id to FrozenEvent of the events an `EventLoader` has
+    loaded, which is what the resolvers use as their event map.
+
+    Attributes:
+        auth_check_cache (AuthCheckCache|None): See `EventMap`
+    """
+
+    def __init__(self, auth_check_cache=None):
+        super(LoadedEvents, self).__init__()
+        self.auth_check_cache = auth_check_cache
+
+
+class EventLoader(object):
+    """Loads events through a fetcher, remembering them and batching
+    concurrent lookups.
+
+    Args:
+        fetcher (callable[list[str]]): Coroutine function that returns a dict
+            of event_id to FrozenEvent for the given event_ids that exist
+        auth_check_cache (AuthCheckCache|None): Cache for the resolvers to
+            use when auth checking the loaded events, see `check_auth`
+
+    Attributes:
+        events (LoadedEvents): All the events loaded so far
+        fetches (int): Number of times the fetcher has been called
+        fetched (int): Number of events the fetcher has returned
+    """
+
+    def __init__(self, fetcher, auth_check_cache=None):
+        self.events = LoadedEvents(auth_check_cache)
+        self._fetcher = fetcher
+
+        # Map from event_id to a future that resolves once it's been fetched,
+        # for events that have been requested but not fetched yet.
+        self._pending = {}
+
+        # event_ids that have been requested since the last fetch was started
+        self._queue = []
+
+        self.fetches = 0
+        self.fetched = 0
+
+    async def get_events(self, event_ids):
+        """Load the events.
+
+        Args:
+            event_ids (iterable[str])
+
+        Raises:
+            KeyError: if the fetcher didn't return one of the events
+
+        Returns:
+            dict[str, FrozenEvent]
+        """
+        event_ids = list(event_ids)
+
+        futures = []
+        for event_id in event_ids:
+            if event_id in self.events:
+                continue
+
+            future = self._pending.get(event_id)
+            if future is None:
+                future = asyncio.get_running_loop().create_future()
+                self._pending[event_id] = future
+                if not self._queue:
+                    # Wait until everything else that's runnable has had a
+                    # chance to add to the batch.
+                    asyncio.get_running_loop().call_soon(self._start_fetch)
+                self._queue.append(event_id)
+
+            futures.append(future)
+
+        if futures:
+            await asyncio.gather(*futures)
+
+        return {event_id: self.events[event_id] for event_id in event_ids}
+
+    def _start_fetch(self):
+        batch, self._queue = self._queue, []
+        asyncio.ensure_future(self._fetch(batch))
+
+    async def _fetch(self, batch):
+        self.fetches += 1
+        try:
+            events = await self._fetcher(batch)
+        except Exception as e:
+            for event_id in batch:
+                self._pending.pop(event_id).set_exception(e)
+            return
+
+        self.fetched += len(events)
+        self.events.update(events)
+
+        for event_id in batch:
+            future = self._pending.pop(event_id)
+            if event_id in events:
+                future.set_result(None)
+            else:
+                future.set_exception(KeyError(event_id))
+
+    async def load_auth_chains(self, event_ids):
+        """Load the events and their auth chains, with one batch of fetches
+        per level of the auth DAG that isn't already loaded.
+
+        Args:
+            event_ids (iterable[str])
+        """
+        seen = set()
+        to_load = set(event_ids)
+        while to_load:
+            seen.update(to_load)
+            events = await self.get_events(to_load)
+
+            to_load = set(
+                aid
+                for event in events.values()
+                for aid, _ in event.auth_events
+                if aid not in seen
+            )
+
+    def describe_stats(self):
+        """Returns a human readable summary of the loader's stats
+        """
+        return "%d events in %d fetches" % (self.fetched, self.fetches)
+
+
+async def resolver(state_sets, loader, yield_every=100):
+    """Given a set of state return the resolved state.
+
+    Args:
+        state_sets(list[dict[tuple[str, str], str]]): A list of dicts from
+            type/state_key tuples to event_id
+        loader(EventLoader)
+        yield_every(int): Number of auth checks to do between yielding to the
+            event loop
+
+    Returns:
+        dict[tuple[str, str], str]: The resolved state map.
+    """
+    stats = instrumentation.start_resolution(__name__)
+
+    await loader.load_auth_chains(
+        set().union(*(s.values() for s in state_sets)),
+    )
+    event_map = loader.events
+    stats.lap("load_events")
+
+    # First split up the un/conflicted state
+    unconflicted_state, conflicted_state = _seperate(state_sets)
+    stats.lap("seperate")
+
+    # Also fetch all auth events that appear in only some of the state sets'
+    # auth chains.
+    auth_diff = _get_auth_chain_difference(state_sets, event_map)
+    stats.lap("auth_chain_difference")
+
+    full_conflicted_set = set(itertools.chain(
+        itertools.chain.from_iterable(conflicted_state.values()),
+        auth_diff,
+    ))
+
+    stats.incr("conflicted_keys", len(conflicted_state))
+    stats.incr("auth_difference", len(auth_diff))
+    stats.incr("full_conflicted_set", len(full_conflicted_set))
+
+    await asyncio.sleep(0)
+
+    # Get and sort all the power events (kicks/bans/etc)
+    power_events = (
+        eid for eid in full_conflicted_set
+        if _is_power_event(event_map[eid])
+    )
+    sorted_power_events = _reverse_topological_power_sort(
+        power_events,
+        event_map,
+        auth_diff
+    )
+    stats.lap("power_sort")
+
+    # Now sequentially auth each one
+    resolved_state = await _iterative_auth_checks(
+        sorted_power_events, unconflicted_state, event_map, yield_every,
+        stats,
+    )
+    stats.lap("power_auth_checks")
+
+    # OK, so we've now resolved the power events. Now sort the remaining
+    # events using the mainline of the resolved power level.
+
+    leftover_events = (
+        ev_id
+        for ev_id in full_conflicted_set
+        if ev_id not in sorted_power_events
+    )
+
+    pl = resolved_state.get((EventTypes.PowerLevels, ""), None)
+    leftover_events = _mainline_sort(leftover_events, pl, event_map)
+    stats.lap("mainline_sort")
+
+    await asyncio.sleep(0)
+
+    resolved_state = await _iterative_auth_checks(
+        leftover_events, resolved_state, event_map, yield_every, stats,
+    )
+    stats.lap("leftover_auth_checks")
+
+    # We make sure that unconflicted state always still applies.
+    resolved_state.update(unconflicted_state)
+
+    return resolved_state
+
+
+async def resolve_many(state_sets_list, loader):
+    """Resolve each of a list of independent sets of state sets concurrently,
+    so that their event lookups are batched together.
+
+    Args:
+        state_sets_list(list[list[dict[tuple[str, str], str]]])
+        loader(EventLoader)
+
+    Returns:
+        list[dict[tuple[str, str], str]]: The resolved state maps, in order.
+    """
+    return await asyncio.gather(*(
+        resolver(state_sets, loader) for state_sets in state_sets_list
+    ))
+
+
+async def _iterative_auth_checks(event_ids, base_state, event_map,
+                                 yield_every,
+                                 stats=instrumentation.NULL_STATS):
+    """Sequentially apply auth checks to each event in given list, updating the
+    state as it goes along, and yielding to the event loop every
+    `yield_every` events.
+    """
+    resolved_state = base_state.copy()
+
+    for i, event_id in enumerate(event_ids, 1):
+        event = event_map[event_id]
+
+        auth_events = {
+            (event_map[aid].type, event_map[aid].state_key): event_map[aid]
+            for aid, _ in event.auth_events
+        }
+        for key in event_auth.auth_types_for_event(event):
+            if key in resolved_state:
+                auth_events[key] = event_map[resolved_state[key]]
+
+        stats.incr("auth_checks")
+        try:
+            check_auth(event, auth_events, event_map)
+
+            resolved_state[(event.type, event.state_key)] = event_id
+        except AuthError:
+            stats.incr("auth_rejections")
+
+        if i % yield_every == 0:
+            await asyncio.sleep(0)
+
+    return resolved_state
+
+
+def make_event_map_fetcher(event_map, latency=0.0):
+    """Returns a fetcher that looks events up in an in memory event map after
+    sleeping for `latency` seconds, to stand in for a database.
+
+    Args:
+        event_map (dict[str, FrozenEvent])
+        latency (float)
+    """
+    async def fetcher(event_ids):
+        await asyncio.sleep(latency)
+        return {
+            event_id: event_map[event_id]
+            for event_id in event_ids
+            if event_id in event_map
+        }
+
+    return fetcher
+
+
+class SyncDriver(object):
+    """Runs an async resolver (or `resolve_many`) to completion, so that it can
+    be used where a synchronous one is expected, e.g. by `replay_dag`.
+
+    Events are fetched from the event map the driver is called with, with the
+    given simulated latency, and auth checked with its `auth_check_cache`. The
+    loader, and so the loaded events, are kept for as long as the driver is
+    called with the same event map.
+
+    Args:
+        resolution_func: The async resolver
+        latency (float): Seconds each fetch takes
+    """
+
+    def __init__(self, resolution_func, latency=0.0):
+        self._resolution_func = resolution_func
+        self._latency = latency
+        self._loop = asyncio.new_event_loop()
+
+        self._event_map = None
+        self.loader = None
+
+    def __reduce__(self):
+        # Each process gets its own event loop and loader
+        return SyncDriver, (self._resolution_func, self._latency)
+
+    def __call__(self, state_sets, event_map):
+        if event_map is not self._event_map:
+            self._event_map = event_map
+            self.loader = EventLoader(
+                make_event_map_fetcher(event_map, self._latency),
+                auth_check_cache=getattr(event_map, "auth_check_cache", None),
+            )
+
+        return self._loop.run_until_complete(
+            self._resolution_func(state_sets, self.loader),
+        )
+
+    def close(self):
+        self._loop.close()
@@ -3,20 +3,54 @@
 Currently supported modes:
     render: outputs a dotfile of the graph
     resolve: tests a given state resolution algorithm against the given graph
+    state-at: prints the state after particular events of the given graph
+    generate: outputs a synthetic graph description of a large room
+    convert: converts a graph description between yaml and JSON lines
+    compile: compiles a graph description into a memory mapped binary format
+    bench: times state resolution algorithms against synthetic graphs
+    bench-ingest: times adding events to a live room one at a time
+    bench-sort: times the topological power sort against networkx's
 """
 
 import argparse
+import contextlib
+import functools
+import hashlib
 import importlib
+import inspect
+import io
 import itertools
-import yaml
+import json
+import random
+import re
+import subprocess
+import sys
+import time
+import traceback
 
-from networkx import DiGraph, topological_sort
 from synapse import event_auth
 from synapse.api.constants import EventTypes, JoinRules, Membership
 from synapse.api.errors import AuthError
 from synapse.events import FrozenEvent
 from synapse.types import UserID, EventID, RoomID, get_localpart_from_id
-from tabulate import tabulate
+
+from algos import instrumentation
+from algos.auth_check_cache import check_auth
+from algos.event_map import EventMap
+from algos.resolution_cache import get_cache_key
+from algos.state_map import StateMap
+from algos.topological_sort import lexicographical_topological_sort
+from compiled_graph import (
+    COMPILED_EXTENSION, CompiledGraph, CompiledGraphCache,
+    write_compiled_graph,
+)
+from graph_loader import (
+    dump_graph_desc_jsonl, dump_graph_desc_yaml, load_graph_desc,
+)
+
+# The remaining dependencies (networkx, tabulate, yaml, graphviz and the graph
+# generator) are comparatively slow to import and are only needed by some
+# modes, so they are imported where they're used. See `--import-report`.
 
 
 def pairwise(iterable):
@@ -112,14 +146,79 @@ AUTH_EVENTS = {
 ROOM_ID = to_room_id("room")
 
 
-def create_dag(graph_desc):
+def create_dag(graph_desc, compact=False):
     """Takes a graph description and returns DiGraph's
 
+    Args:
+        graph_desc (dict|CompiledGraph)
+        compact (bool): Whether to return a CompactEventStore as the event
+            map, which the resolvers can operate on natively.
+
     Returns
-        (DiGraph, DiGraph, dict[str, FrozenEvent]): A tuple of room DAG, auth
-        DAG and event map.
+        (DiGraph, DiGraph, EventMap): A tuple of room DAG, auth DAG and event
+        map.
     """
+    from networkx import DiGraph
+
+    if isinstance(graph_desc, CompiledGraph):
+        event_map = graph_desc.to_event_map(compact=compact)
+
+        event_graph = DiGraph()
+        auth_graph = DiGraph()
+        for eid, event in event_map.items():
+            event_graph.add_edges_from(
+                (eid, pid) for pid, _ in event.prev_events
+            )
+            auth_graph.add_edges_from(
+                (eid, aid) for aid, _ in event.auth_events
+            )
+
+        return event_graph, auth_graph, event_map
+
+    edge_map, auth_events, events = _build_events(graph_desc)
+
+    event_graph = DiGraph()
+    for eid, prev_ids in edge_map.items():
+        event_graph.add_edges_from(
+            (to_event_id(eid), to_event_id(pid))
+            for pid in prev_ids
+        )
+
+    auth_graph = DiGraph()
+    for eid, auth_ids in auth_events.items():
+        auth_graph.add_edges_from(
+            (to_event_id(eid), to_event_id(pid))
+            for pid in auth_ids
+        )
+
+    event_map = _build_event_map(events, compact)
+
+    return event_graph, auth_graph, event_map
+
 
+def create_event_map(graph_desc, compact=False):
+    """Takes a graph description and returns just the event map. This is all
+    that `replay_dag` needs, and unlike `create_dag` doesn't need networkx.
+
+    Args:
+        graph_desc (dict)
+        compact (bool): Whether to return a CompactEventStore
+
+    Returns:
+        EventMap
+    """
+    _, _, events = _build_events(graph_desc)
+    return _build_event_map(events, compact)
+
+
+def _build_events(graph_desc):
+    """Builds the events in a graph description.
+
+    Returns:
+        (dict[str, set[str]], dict[str, list[str]], dict[str, FrozenEvent]):
+        The prev events and auth events of each event by name, and the events
+        by event_id.
+    """
     edge_map = {}
     auth_events = dict(AUTH_EVENTS)
 
@@ -133,7 +232,7 @@ def create_dag(graph_desc):
     for eid, aids in graph_desc["auth"].items():
         auth_events[eid] = ["CREATE"] + aids
 
-    event_map = {}
+    events = {}
 
     current_origin_server_ts = 100
 
@@ -168,109 +267,1085 @@ def create_dag(graph_desc):
         event["origin_server_ts"] = current_origin_server_ts
         current_origin_server_ts += 1
 
-        event_map[to_event_id(eid)] = FrozenEvent(event)
+        events[to_event_id(eid)] = FrozenEvent(event)
 
-    event_graph = DiGraph()
-    for eid, prev_ids in edge_map.items():
-        event_graph.add_edges_from(
-            (to_event_id(eid), to_event_id(pid))
-            for pid in prev_ids
+    return edge_map, auth_events, events
+
+
+def _build_event_map(events, compact):
+    """Adds the events to a new event map, each after its auth events so that
+    the indexes can be built incrementally.
+
+    Args:
+        events (dict[str, FrozenEvent])
+        compact (bool): Whether to return a CompactEventStore
+
+    Returns:
+        EventMap
+    """
+    if compact:
+        from algos.compact_store import CompactEventStore
+        event_map = CompactEventStore()
+    else:
+        event_map = EventMap()
+
+    dependents = {eid: [] for eid in events}
+    for eid, event in events.items():
+        for aid, _ in event.auth_events:
+            dependents[aid].append(eid)
+
+    for eid in lexicographical_topological_sort(dependents, key=str):
+        event_map.add_event(events[eid])
+
+    return event_map
+
+
+def create_sqlite_store(graph_desc, path, cache_size=10000):
+    """Builds the events in a graph and stores them in a SQLite database,
+    replacing anything already in it.
+
+    Args:
+        graph_desc (dict|CompiledGraph)
+        path (str): Path to the database
+        cache_size (int): Number of events the store keeps in memory
+
+    Returns:
+        SqliteEventStore
+    """
+    from algos.sqlite_store import SqliteEventStore
+
+    if isinstance(graph_desc, CompiledGraph):
+        events = (
+            graph_desc.get_event(idx) for idx in range(graph_desc.num_events)
         )
+    else:
+        _, _, events = _build_events(graph_desc)
+        events = events.values()
 
-    auth_graph = DiGraph()
-    for eid, auth_ids in auth_events.items():
-        auth_graph.add_edges_from(
-            (to_event_id(eid), to_event_id(pid))
-            for pid in auth_ids
+    store = SqliteEventStore(path, cache_size)
+    store.clear()
+    store.add_events(events)
+    return store
+
+
+def load_graph(path, dag_cache_dir=None):
+    """Loads a graph from a file, which is either a compiled graph or a graph
+    description. If a cache directory is given then graph descriptions are
+    loaded from compiled copies kept there, see `CompiledGraphCache`.
+
+    Args:
+        path (str)
+        dag_cache_dir (str|None)
+
+    Returns:
+        dict|CompiledGraph: Compiled graphs must be closed once done with,
+        see `open_graph`.
+    """
+    if path.endswith(COMPILED_EXTENSION):
+        return CompiledGraph(path)
+
+    if dag_cache_dir:
+        dag_cache = CompiledGraphCache(dag_cache_dir, _dag_cache_salt())
+        return dag_cache.load(path, compile_file)
+
+    return load_graph_desc(path)
+
+
+@contextlib.contextmanager
+def open_graph(path, dag_cache_dir=None):
+    """Context manager that loads a graph with `load_graph`, and closes it
+    afterwards if it's a compiled graph.
+    """
+    graph_desc = load_graph(path, dag_cache_dir)
+    try:
+        yield graph_desc
+    finally:
+        if isinstance(graph_desc, CompiledGraph):
+            graph_desc.close()
+
+
+def _dag_cache_salt():
+    """Returns everything other than the description file itself that goes
+    into building its events, so that cached graphs are rebuilt when any of it
+    changes. This includes the source of the code that parses descriptions,
+    builds the events and writes compiled graphs.
+    """
+    import compiled_graph
+    import graph_loader
+
+    sources = hashlib.sha256()
+    for obj in (
+        graph_loader, pairwise, to_user_id, to_room_id, to_event_id,
+        _build_events, compile_graph_desc, compiled_graph,
+    ):
+        sources.update(inspect.getsource(obj).encode("utf-8"))
+
+    return json.dumps(
+        [
+            SERVER_NAME, ROOM_ID, INITIAL_EVENTS, EDGES, AUTH_EVENTS,
+            sources.hexdigest(),
+        ],
+        sort_keys=True,
+    )
+
+
+def compile_file(path, output_path):
+    """Compiles the graph description in a file, see `compile_graph_desc`.
+
+    Args:
+        path (str)
+        output_path (str)
+    """
+    compile_graph_desc(load_graph_desc(path), output_path)
+
+
+def compile_graph_desc(graph_desc, path):
+    """Builds the events in a graph description and writes them to a file
+    in the format of `compiled_graph`.
+
+    Args:
+        graph_desc (dict)
+        path (str)
+    """
+    _, _, events = _build_events(graph_desc)
+    expected_state = [to_event_id(eid) for eid in graph_desc["expected_state"]]
+
+    with open(path, "wb") as f:
+        write_compiled_graph(f, events, expected_state)
+
+
+class EventAuthFailure(Exception):
+    """Raised when an event in the graph fails auth against the state before
+    it.
+    """
+
+    def __init__(self, event_id, error):
+        super(EventAuthFailure, self).__init__(event_id, error)
+        self.event_id = event_id
+        self.error = error
+
+
+def replay_dag(event_map, resolution_func, resolution_cache=None, keep=None,
+               jobs=1, batch_merges=False):
+    """Walks the room DAG from the create event computing the state after each
+    event, using the given state resolution algorithm at each merge.
+
+    Args:
+        event_map (dict[str, FrozenEvent]): All the events in the room DAG
+        resolution_func: The state resolution algorithm
+        resolution_cache (ResolutionCache|None): If given, used to reuse the
+            result of resolving the same state sets more than once.
+        keep (iterable[str]|None): If given, the state after an event is
+            dropped as soon as all of the event's children have been
+            processed, unless the event is in `keep`.
+        jobs (int): If more than one, the events are processed a topological
+            generation at a time and the merges in each generation are
+            resolved in parallel by a pool of this many processes. The result
+            is the same as resolving them one at a time.
+        batch_merges (bool): If true, `resolution_func` is a batch resolver
+            like `ts_mainline.resolve_many`, and the events are processed a
+            topological generation at a time with all the merges in each
+            generation resolved in one call. Can't be combined with `jobs`.
+
+    Raises:
+        EventAuthFailure: if an event fails auth against the state before it
+
+    Returns:
+        dict[str, StateMap]: Map from event_id to the state after that event.
+        If `keep` is given then this only includes the events in `keep`.
+    """
+    if batch_merges and jobs > 1:
+        raise ValueError("Batched merges can't be resolved in parallel")
+
+    children = _get_children(event_map)
+
+    # Map from event_id to the number of its children that we haven't
+    # processed yet, if we're dropping states.
+    remaining_children = None
+    if keep is not None:
+        keep = set(keep)
+        remaining_children = {
+            eid: len(child_ids) for eid, child_ids in children.items()
+        }
+
+    ordered = lexicographical_topological_sort(children, key=str)
+
+    executor = None
+    if jobs > 1:
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_init_merge_worker,
+            initargs=(event_map, resolution_func),
         )
+        batches = _topological_generations(ordered, event_map)
+    elif batch_merges:
+        batches = _topological_generations(ordered, event_map)
+    else:
+        batches = ([eid] for eid in ordered)
 
-    return event_graph, auth_graph, event_map
+    state_past_event = {}
+    try:
+        for batch in batches:
+            resolved_states = _resolve_merges(
+                batch, state_past_event, event_map, resolution_func,
+                resolution_cache, executor, batch_merges,
+            )
+
+            for eid in batch:
+                event = event_map[eid]
+
+                if len(event.prev_events) == 1:
+                    state_ids = state_past_event[event.prev_events[0][0]]
+                elif event.prev_events:
+                    state_ids = resolved_states[eid]
+                else:
+                    state_ids = StateMap()
+
+                state_past_event[eid] = _apply_event(
+                    event, state_ids, event_map,
+                )
+
+                if remaining_children is not None:
+                    for pid, _ in event.prev_events:
+                        remaining_children[pid] -= 1
+                        if not remaining_children[pid] and pid not in keep:
+                            del state_past_event[pid]
+
+                    if not remaining_children[eid] and eid not in keep:
+                        del state_past_event[eid]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return state_past_event
+
+
+def _apply_event(event, state_ids, event_map):
+    """Auth checks the event against the state before it, and returns the
+    state after it.
+
+    Args:
+        event (FrozenEvent)
+        state_ids (StateMap): The state before the event
+        event_map (dict[str, FrozenEvent])
+
+    Raises:
+        EventAuthFailure: if the event fails auth
+
+    Returns:
+        StateMap
+    """
+    auth_events = {
+        key: event_map[state_ids[key]]
+        for key in event_auth.auth_types_for_event(event)
+        if key in state_ids
+    }
+
+    try:
+        check_auth(event, auth_events, event_map)
+    except AuthError as e:
+        raise EventAuthFailure(event.event_id, e)
+
+    if event.is_state():
+        state_ids = state_ids.evolve(
+            (event.type, event.state_key), event.event_id,
+        )
+
+    return state_ids
+
+
+class RoomReplayer(object):
+    """Keeps the state after each event of a live room, computing the state
+    after new events as they arrive rather than replaying the whole room.
+
+    New events can have any existing events as prev events, so can fork off
+    old points in the DAG. The state after every event is kept, which is
+    cheap as states share structure with the ones they're derived from.
+
+    Args:
+        resolution_func: The state resolution algorithm
+        event_map (EventMap|None): The event map to add events to, which
+            should be empty. Defaults to a new EventMap.
+        resolution_cache (ResolutionCache|None): If given, used to reuse the
+            result of resolving the same state sets more than once.
+    """
+
+    def __init__(self, resolution_func, event_map=None,
+                 resolution_cache=None):
+        self.resolution_func = resolution_func
+        self.event_map = event_map if event_map is not None else EventMap()
+        self.resolution_cache = resolution_cache
+
+        self._state_past_event = {}
+
+    def add_event(self, event):
+        """Add a new event to the room and work out the state after it. Its
+        prev and auth events must already have been added.
+
+        Args:
+            event (FrozenEvent)
+
+        Raises:
+            EventAuthFailure: if the event fails auth against the state
+                before it, in which case it isn't added.
+
+        Returns:
+            StateMap: The state after the event
+        """
+        prev_states = [
+            self._state_past_event[pid] for pid, _ in event.prev_events
+        ]
+
+        state_ids = _apply_event(
+            event,
+            _resolve_prev_states(
+                prev_states, self.event_map, self.resolution_func,
+                self.resolution_cache,
+            ),
+            self.event_map,
+        )
+
+        self.event_map.add_event(event)
+        self._state_past_event[event.event_id] = state_ids
+
+        return state_ids
+
+    def add_events(self, events):
+        """Add a number of new events, in an order where each comes after its
+        prev and auth events. See `add_event`.
+
+        Args:
+            events (iterable[FrozenEvent])
+        """
+        for event in order_events(events):
+            self.add_event(event)
+
+    def get_state(self, event_id):
+        """Returns the state after an event that has been added.
+
+        Returns:
+            StateMap
+        """
+        return self._state_past_event[event_id]
+
+
+class StateQuery(object):
+    """Answers queries for the state after particular events of a room,
+    computing only the states of the events' ancestors rather than of the
+    whole room as `replay_dag` does.
+
+    The state after every event that's computed is remembered, so later
+    queries only walk back as far as the ancestors they share with earlier
+    ones.
+
+    Args:
+        event_map (dict[str, FrozenEvent]): All the events in the room DAG
+        resolution_func: The state resolution algorithm
+        resolution_cache (ResolutionCache|None): If given, used to reuse the
+            result of resolving the same state sets more than once.
+
+    Attributes:
+        computed (int): Number of events whose state has been computed
+        resolutions (int): Number of merges that have been resolved
+    """
+
+    def __init__(self, event_map, resolution_func, resolution_cache=None):
+        self.event_map = event_map
+        self.resolution_func = resolution_func
+        self.resolution_cache = resolution_cache
+
+        self._state_past_event = {}
+
+        self.computed = 0
+        self.resolutions = 0
+
+    def state_at(self, event_id):
+        """Returns the state after the event.
+
+        Args:
+            event_id (str)
+
+        Raises:
+            KeyError: if the event, or one of its ancestors, isn't in the
+                event map
+            EventAuthFailure: if one of the ancestors of the event, or the
+                event itself, fails auth against the state before it
+
+        Returns:
+            StateMap
+        """
+        event_map = self.event_map
+        state_past_event = self._state_past_event
+
+        # Walk back through the prev events that haven't been computed yet,
+        # computing the state after each event once the states after all its
+        # prev events have been. This is done with an explicit stack as the
+        # DAG can be much deeper than the recursion limit.
+        to_visit = [(event_id, False)]
+        while to_visit:
+            eid, prevs_computed = to_visit.pop()
+            if eid in state_past_event:
+                continue
+
+            event = event_map[eid]
+
+            if not prevs_computed:
+                to_visit.append((eid, True))
+                to_visit.extend(
+                    (pid, False)
+                    for pid, _ in event.prev_events
+                    if pid not in state_past_event
+                )
+                continue
+
+            prev_states = [
+                state_past_event[pid] for pid, _ in event.prev_events
+            ]
+            if len(prev_states) > 1:
+                self.resolutions += 1
+
+            state_past_event[eid] = _apply_event(
+                event,
+                _resolve_prev_states(
+                    prev_states, event_map, self.resolution_func,
+                    self.resolution_cache,
+                ),
+                event_map,
+            )
+            self.computed += 1
+
+        return state_past_event[event_id]
+
+
+def _resolve_prev_states(prev_states, event_map, resolution_func,
+                         resolution_cache=None):
+    """Returns the state before an event with the given states after its prev
+    events, resolving them if there's more than one.
+
+    Args:
+        prev_states (list[StateMap])
+        event_map (dict[str, FrozenEvent])
+        resolution_func: The state resolution algorithm
+        resolution_cache (ResolutionCache|None)
 
+    Returns:
+        StateMap
+    """
+    if not prev_states:
+        return StateMap()
+
+    if len(prev_states) == 1:
+        return prev_states[0]
+
+    if resolution_cache is not None:
+        resolved = resolution_cache.get(prev_states)
+        if resolved is not None:
+            return resolved
+
+    result = resolution_func(prev_states, event_map)
+
+    resolved = StateMap.from_dict(result, base=prev_states[0])
+    if resolution_cache is not None:
+        resolution_cache.set(prev_states, resolved)
+    return resolved
+
+
+def order_events(events):
+    """Orders the events so that each comes after any of its prev and auth
+    events that are also in the list, and otherwise by origin_server_ts, i.e.
+    the order they would normally arrive in.
+
+    Args:
+        events (iterable[FrozenEvent])
+
+    Returns:
+        list[FrozenEvent]
+    """
+    events = {event.event_id: event for event in events}
+
+    children = {eid: set() for eid in events}
+    for eid, event in events.items():
+        for pid, _ in itertools.chain(event.prev_events, event.auth_events):
+            if pid in children:
+                children[pid].add(eid)
+
+    ordered = lexicographical_topological_sort(
+        children, key=lambda eid: (events[eid].origin_server_ts, eid),
+    )
+    return [events[eid] for eid in ordered]
+
+
+def _get_children(event_map):
+    """Returns a map from each event_id in the room DAG to the event_ids of
+    the events that have it as a prev event.
+
+    Returns:
+        dict[str, list[str]]
+    """
+    children = {eid: [] for eid in event_map}
+    for eid, event in event_map.items():
+        for pid, _ in event.prev_events:
+            children[pid].append(eid)
+    return children
+
+
+def _topological_generations(ordered, event_map):
+    """Splits the room DAG into generations, where each event is in the
+    generation after the latest of its prev events. No event is an ancestor
+    of another in the same generation.
+
+    Args:
+        ordered (list[str]): The event_ids in topological order, parents
+            first
+        event_map (dict[str, FrozenEvent])
+
+    Returns:
+        list[list[str]]
+    """
+    generation_of = {}
+    generations = []
+    for eid in ordered:
+        generation = 1 + max(
+            (generation_of[pid] for pid, _ in event_map[eid].prev_events),
+            default=-1,
+        )
+        generation_of[eid] = generation
+
+        if generation == len(generations):
+            generations.append([])
+        generations[generation].append(eid)
+
+    return generations
+
+
+def _resolve_merges(batch, state_past_event, event_map, resolution_func,
+                    resolution_cache, executor, batch_merges=False):
+    """Resolve the state before each event in the batch that has more than one
+    prev event. The events must not depend on each other.
+
+    If `batch_merges` is true then `resolution_func` is a batch resolver and
+    is called once with all of the merges.
+
+    Events that merge the same states are only resolved once. Without a
+    resolution cache the states are compared by identity rather than by
+    contents, which avoids hashing the states but still catches events with
+    the same prev events, or prev events that didn't change the state.
+
+    Returns:
+        dict[str, StateMap]: Map from event_id to the resolved state before it
+    """
+    resolved_states = {}
+
+    # Map from a key identifying the prev states of each event, to the prev
+    # states and the event_ids of the events with those prev states.
+    to_resolve = {}
+    for eid in batch:
+        event = event_map[eid]
+        if len(event.prev_events) < 2:
+            continue
+
+        prev_states = [state_past_event[pid] for pid, _ in event.prev_events]
+
+        if resolution_cache is not None:
+            resolved = resolution_cache.get(prev_states)
+            if resolved is not None:
+                resolved_states[eid] = resolved
+                continue
+
+        if resolution_cache is not None:
+            key = get_cache_key(prev_states)
+        else:
+            key = tuple(sorted(id(state) for state in prev_states))
+
+        if key in to_resolve:
+            to_resolve[key][1].append(eid)
+        else:
+            to_resolve[key] = (prev_states, [eid])
+
+    merges = list(to_resolve.values())
+
+    if executor is not None and len(merges) > 1:
+        results = executor.map(
+            _resolve_in_merge_worker,
+            [
+                [state_set.copy() for state_set in prev_states]
+                for prev_states, _ in merges
+            ],
+            itertools.repeat(instrumentation.is_collecting()),
+        )
+    elif batch_merges and merges:
+        results = zip(
+            resolution_func(
+                [prev_states for prev_states, _ in merges], event_map,
+            ),
+            itertools.repeat(None),
+        )
+    else:
+        results = (
+            (resolution_func(prev_states, event_map), None)
+            for prev_states, _ in merges
+        )
+
+    for (prev_states, eids), (result, stats) in zip(merges, results):
+        if stats:
+            instrumentation.add_resolutions(stats)
+
+        resolved = StateMap.from_dict(result, base=prev_states[0])
+        if resolution_cache is not None:
+            resolution_cache.set(prev_states, resolved)
+        for eid in eids:
+            resolved_states[eid] = resolved
+
+    return resolved_states
+
+
+# The event map and resolution function used by merge worker processes, set
+# by `_init_merge_worker`.
+_worker_event_map = None
+_worker_resolution_func = None
+
+
+def _init_merge_worker(event_map, resolution_func):
+    global _worker_event_map, _worker_resolution_func
+    _worker_event_map = event_map
+    _worker_resolution_func = resolution_func
+
+
+def _resolve_in_merge_worker(state_sets, collect_stats):
+    """Resolves the state sets, returning the result along with the stats of
+    the resolution if `collect_stats` is set, as the parent process can't see
+    the stats recorded in this one.
+    """
+    if not collect_stats:
+        return _worker_resolution_func(state_sets, _worker_event_map), None
 
-def resolve(graph_desc, resolution_func):
+    collector = instrumentation.StatsCollector()
+    with instrumentation.collecting(collector):
+        result = _worker_resolution_func(state_sets, _worker_event_map)
+    return result, collector.resolutions
+
+
+def resolve(graph_desc, resolution_func, resolution_cache=None, evict=False,
+            compact=False, merge_jobs=1, stats=None, auth_check_cache=None,
+            batch_merges=False, sqlite_path=None, event_cache_size=10000,
+            show_stats=True):
     """Given graph description and state resolution algorithm, compute the end
     state of the graph and compare against the expected state defined in the
     graph description
+
+    Args:
+        graph_desc (dict|CompiledGraph)
+        resolution_func: The state resolution algorithm
+        resolution_cache (ResolutionCache|None)
+        evict (bool): Whether to drop the state after each event once it's no
+            longer needed, rather than keeping it until the end
+        compact (bool): Whether to build a CompactEventStore for the
+            resolvers to operate on
+        merge_jobs (int): Number of processes to resolve independent merges
+            with, see `replay_dag`
+        stats (StatsCollector|None): If given, the resolvers record per phase
+            timings and counters to it, and a summary is printed unless
+            `show_stats` is false.
+        auth_check_cache (AuthCheckCache|None): If given, used to cache the
+            result of auth checks both when replaying and in the resolvers
+        batch_merges (bool): Whether `resolution_func` is a batch resolver
+            to give each generation of merges to at once, see `replay_dag`
+        sqlite_path (str|None): If given, the events are stored in a SQLite
+            database at this path and the resolvers load them from there as
+            needed, rather than keeping them all in memory. Anything already
+            in the database is replaced. This takes precedence over `compact`.
+        event_cache_size (int): Number of events the SQLite store keeps in
+            memory
+        show_stats (bool): Whether to print a summary of `stats`
+
+    Returns:
+        bool: Whether the end state matched the expected state, which is
+        always the case if the graph doesn't give one
     """
 
-    graph, _, event_map = create_dag(graph_desc)
+    if isinstance(graph_desc, CompiledGraph):
+        expected_state_ids = graph_desc.expected_state
+    else:
+        expected_state_ids = [
+            to_event_id(eid) for eid in graph_desc.get("expected_state", [])
+        ]
 
-    state_past_event = {}
-    for eid in reversed(list(topological_sort(graph))):
-        event = event_map[eid]
+    if sqlite_path is not None:
+        event_map = create_sqlite_store(
+            graph_desc, sqlite_path, cache_size=event_cache_size,
+        )
+    elif isinstance(graph_desc, CompiledGraph):
+        event_map = graph_desc.to_event_map(compact=compact)
+    else:
+        event_map = create_event_map(graph_desc, compact=compact)
 
-        prev_states = []
-        for pid, _ in event.prev_events:
-            prev_states.append(state_past_event[pid])
-
-        state_ids = {}
-        if len(prev_states) == 1:
-            state_ids = prev_states[0]
-        elif len(prev_states) > 1:
-            state_ids = resolution_func(
-                prev_states, event_map,
-            )
+    try:
+        event_map.auth_check_cache = auth_check_cache
 
-        auth_events = {
-            key: event_map[state_ids[key]]
-            for key in event_auth.auth_types_for_event(event)
-            if key in state_ids
-        }
+        keep = None
+        if evict:
+            keep = (to_event_id("START"), to_event_id("END"))
 
         try:
-            event_auth.check(
-                event, auth_events,
-                do_sig_check=False, do_size_check=False,
-            )
-        except AuthError as e:
-            print("Failed to auth event", eid, " because:", e)
-            return
+            with instrumentation.collecting(stats):
+                state_past_event = replay_dag(
+                    event_map, resolution_func,
+                    resolution_cache=resolution_cache,
+                    keep=keep,
+                    jobs=merge_jobs,
+                    batch_merges=batch_merges,
+                )
+        except EventAuthFailure as e:
+            print("Failed to auth event", e.event_id, " because:", e.error)
+            return False
+
+        if resolution_cache is not None:
+            print("Resolution cache:", resolution_cache.describe_stats())
+
+        if auth_check_cache is not None:
+            print("Auth check cache:", auth_check_cache.describe_stats())
+
+        if sqlite_path is not None:
+            print("Event store:", event_map.describe_stats())
+
+        if stats is not None and show_stats:
+            print_stats(stats.summary())
+
+        # Generated graphs don't say what the end state should be
+        if not expected_state_ids:
+            print("No expected state to check against")
+            return True
+
+        start_state = state_past_event[to_event_id("START")]
+        end_state = state_past_event[to_event_id("END")]
+
+        expected_state = {}
+        for eid in expected_state_ids:
+            ev = event_map[eid]
+            expected_state[(ev.type, ev.state_key)] = eid
+
+        mismatches = []
+        for key in set(itertools.chain(end_state, expected_state)):
+            expected_id = expected_state.get(key)
+            actual_id = end_state.get(key)
+            if actual_id == start_state.get(key) and not expected_id:
+                continue
+
+            if expected_id != actual_id:
+                mismatches.append((key[0], key[1], expected_id, actual_id))
+
+        if mismatches:
+            from tabulate import tabulate
+
+            print("Unexpected end state\n")
+            print(tabulate(
+                mismatches,
+                headers=["Type", "State Key", "Expected", "Got"],
+            ))
+            return False
+        else:
+            print("Everything matched!")
+            return True
+    finally:
+        if sqlite_path is not None:
+            event_map.close()
+
+
+def query_state(path, resolver_name, events, dag_cache_dir=None,
+                cache_size=0, compact=False):
+    """Prints the state after each of the given events of a graph, computing
+    only the states of their ancestors.
 
-        if event.is_state():
-            state_ids = dict(state_ids)
-            state_ids[(event.type, event.state_key)] = eid
+    Args:
+        path (str): Path to the graph description
+        resolver_name (str): Fully qualified resolver name
+        events (list[str]): The events to print the state after, either as
+            names from the graph description or full event IDs
+        dag_cache_dir (str|None): See `load_graph`
+        cache_size (int): Size of the resolution cache, 0 disables it
+        compact (bool): Whether to build a CompactEventStore for the
+            resolvers to operate on
+
+    Returns:
+        bool: Whether the state after every event could be computed
+    """
+    from tabulate import tabulate
 
-        state_past_event[eid] = state_ids
+    resolution_func = load_resolver(resolver_name)
 
-    start_state = state_past_event[to_event_id("START")]
-    end_state = state_past_event[to_event_id("END")]
+    with open_graph(path, dag_cache_dir) as graph_desc:
+        if isinstance(graph_desc, CompiledGraph):
+            event_map = graph_desc.to_event_map(compact=compact)
+        else:
+            event_map = create_event_map(graph_desc, compact=compact)
 
-    expected_state = {}
-    for eid in graph_desc["expected_state"]:
-        ev = event_map[to_event_id(eid)]
-        expected_state[(ev.type, ev.state_key)] = to_event_id(eid)
+    resolution_cache = None
+    if cache_size:
+        from algos.resolution_cache import ResolutionCache
+        resolution_cache = ResolutionCache(cache_size)
 
-    mismatches = []
-    for key in set(itertools.chain(end_state, expected_state)):
-        expected_id = expected_state.get(key)
-        actual_id = end_state.get(key)
-        if actual_id == start_state.get(key) and not expected_id:
-            continue
+    query = StateQuery(event_map, resolution_func, resolution_cache)
 
-        if expected_id != actual_id:
-            mismatches.append((key[0], key[1], expected_id, actual_id))
+    for name in events:
+        eid = name if name.startswith("$") else to_event_id(name)
+        if eid not in event_map:
+            print("Unknown event", eid)
+            return False
 
-    if mismatches:
-        print("Unexpected end state\n")
+        computed, resolutions = query.computed, query.resolutions
+        start = time.time()
+        try:
+            state = query.state_at(eid)
+        except EventAuthFailure as e:
+            print("Failed to auth event", e.event_id, " because:", e.error)
+            return False
+        elapsed = time.time() - start
+
+        print("State after %s (%.2fms, %d events, %d merges):\n" % (
+            eid, elapsed * 1000, query.computed - computed,
+            query.resolutions - resolutions,
+        ))
         print(tabulate(
-            mismatches,
-            headers=["Type", "State Key", "Expected", "Got"],
+            sorted(
+                (etype, state_key, state_eid)
+                for (etype, state_key), state_eid in state.items()
+            ),
+            headers=["Type", "State Key", "Event"],
         ))
+        print()
+
+    return True
+
+
+def print_stats(summary):
+    """Prints tables of the total and mean time spent in each phase of
+    resolution, and of the counters.
+
+    Args:
+        summary (dict): As returned by `StatsCollector.summary`
+    """
+    from tabulate import tabulate
+
+    resolutions = summary["resolutions"]
+    print("Resolution stats: %d resolutions\n" % (resolutions,))
+    if not resolutions:
+        return
+
+    print(tabulate(
+        [
+            (name, "%.3fms" % (elapsed * 1000,),
+             "%.3fms" % (elapsed * 1000 / resolutions,))
+            for name, elapsed in summary["phases"].items()
+        ],
+        headers=["Phase", "Total", "Mean"],
+    ))
+    print()
+    print(tabulate(
+        [
+            (name, value, "%.1f" % (value / resolutions,))
+            for name, value in sorted(summary["counters"].items())
+        ],
+        headers=["Counter", "Total", "Mean"],
+    ))
+    print()
+
+
+def resolve_file(path, resolver_name, cache_size=0, evict=False,
+                 compact=False, merge_jobs=1, collect_stats=False,
+                 auth_cache_size=0, dag_cache_dir=None, batch_merges=False,
+                 sqlite_path=None, event_cache_size=10000, fetch_latency=0.0,
+                 show_stats=False):
+    """Resolves the graph description in the given file, capturing the output
+    rather than printing it. This is used as the unit of work when resolving
+    files in parallel.
+
+    Args:
+        path (str): Path to the graph description
+        resolver_name (str): Fully qualified resolver name
+        cache_size (int): Size of the resolution cache, 0 disables it
+        evict (bool)
+        compact (bool)
+        merge_jobs (int)
+        collect_stats (bool): Whether to record the per phase stats of each
+            resolution and return them
+        auth_cache_size (int): Size of the auth check cache, 0 disables it
+        dag_cache_dir (str|None): Directory to cache compiled copies of graph
+            descriptions in, see `load_graph`
+        batch_merges (bool): Whether to resolve each generation of merges in
+            one call to the `resolve_many` function in the resolver's module
+        sqlite_path (str|None)
+        event_cache_size (int)
+        fetch_latency (float): For async resolvers, the simulated latency in
+            seconds of each fetch of events
+        show_stats (bool): Whether to record the per phase stats of each
+            resolution and print tables of them in the output
+
+    Returns:
+        tuple[bool, float, str, dict|None]: Whether the end state matched, how
+        long it took in seconds, the output of `resolve` and the stats from
+        `StatsCollector.as_dict` if they were collected. If resolving the file
+        raised an exception then it didn't pass, and the traceback is
+        included in the output.
+    """
+    start = time.time()
+
+    stats = None
+    if collect_stats or show_stats:
+        stats = instrumentation.StatsCollector()
+
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        try:
+            passed = _resolve_file(
+                path, resolver_name, cache_size, evict, compact, merge_jobs,
+                stats, auth_cache_size, dag_cache_dir, batch_merges,
+                sqlite_path, event_cache_size, fetch_latency, show_stats,
+            )
+        except Exception:
+            # Report the failure with the file, rather than aborting the
+            # rest of the files.
+            traceback.print_exc(file=sys.stdout)
+            passed = False
+
+    return (
+        passed, time.time() - start, output.getvalue(),
+        stats.as_dict() if stats is not None else None,
+    )
+
+
+def _resolve_file(path, resolver_name, cache_size, evict, compact,
+                  merge_jobs, stats, auth_cache_size, dag_cache_dir,
+                  batch_merges, sqlite_path, event_cache_size, fetch_latency,
+                  show_stats):
+    """Does the work of `resolve_file`, printing the output.
+
+    Returns:
+        bool: Whether the end state matched
+    """
+    if batch_merges:
+        resolution_func = load_resolver(batch_resolver_name(resolver_name))
+    else:
+        resolution_func = load_resolver(resolver_name)
+
+    driver = None
+    if inspect.iscoroutinefunction(resolution_func):
+        from algos.ts_mainline_async import SyncDriver
+        resolution_func = driver = SyncDriver(resolution_func, fetch_latency)
+
+    resolution_cache = None
+    if cache_size:
+        from algos.resolution_cache import ResolutionCache
+        resolution_cache = ResolutionCache(cache_size)
+
+    auth_check_cache = None
+    if auth_cache_size:
+        from algos.auth_check_cache import AuthCheckCache
+        auth_check_cache = AuthCheckCache(auth_cache_size)
+
+    try:
+        with open_graph(path, dag_cache_dir) as graph_desc:
+            passed = resolve(
+                graph_desc, resolution_func, resolution_cache,
+                evict=evict, compact=compact, merge_jobs=merge_jobs,
+                stats=stats, auth_check_cache=auth_check_cache,
+                batch_merges=batch_merges, sqlite_path=sqlite_path,
+                event_cache_size=event_cache_size, show_stats=show_stats,
+            )
+
+        if driver is not None and driver.loader is not None:
+            print("Event loader:", driver.loader.describe_stats())
+    finally:
+        if driver is not None:
+            driver.close()
+
+    return passed
+
+
+def resolve_files(paths, resolver_name, jobs=1, stats_json=None, **kwargs):
+    """Resolve each file, printing the results in order followed by a summary.
+
+    Args:
+        paths (list[str])
+        resolver_name (str): Fully qualified resolver name
+        jobs (int): Number of processes to use
+        stats_json (file|None): If given, the per phase stats of each file
+            are written to it as a line of JSON
+        **kwargs: Passed to `resolve_file`
+
+    Returns:
+        bool: Whether every file passed
+    """
+    if stats_json is not None:
+        kwargs["collect_stats"] = True
+
+    work = functools.partial(
+        resolve_file, resolver_name=resolver_name, **kwargs
+    )
+
+    if jobs > 1:
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(work, paths)
     else:
-        print("Everything matched!")
+        executor = None
+        results = map(work, paths)
+
+    summary = []
+    try:
+        # Results come back in the same order as the paths, so we print
+        # each one as soon as all the ones before it have finished.
+        for path, (passed, elapsed, output, stats) in zip(paths, results):
+            print("Resolving", path)
+            print(output, end="")
+
+            if stats_json is not None:
+                stats["file"] = path
+                stats["passed"] = passed
+                stats_json.write(json.dumps(stats, sort_keys=True) + "\n")
+
+            summary.append(
+                (path, "passed" if passed else "FAILED", "%.3fs" % (elapsed,))
+            )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    failed = sum(1 for _, result, _ in summary if result != "passed")
+
+    if len(paths) > 1:
+        from tabulate import tabulate
+
+        print()
+        print(tabulate(summary, headers=["File", "Result", "Time"]))
+        print()
+        print("%d passed, %d failed" % (len(summary) - failed, failed))
+
+    return not failed
 
 
 def render(graph_desc, render_auth_events, prev_edges):
     """Given graph description prints a dot file of the graph.
 
     Args:
-        graph_desc (dict)
+        graph_desc (dict|CompiledGraph)
         render_auth_events (bool): Whether to render the auth event relations
             as edges
         prev_edges (bool): Whether to render prev event edges
     """
     event_graph, auth_graph, event_map = create_dag(graph_desc)
 
+    if isinstance(graph_desc, CompiledGraph):
+        expected_state = {
+            get_localpart_from_id(eid) for eid in graph_desc.expected_state
+        }
+        names = {
+            get_localpart_from_id(eid) for eid in event_map
+        }.difference(INITIAL_EVENTS)
+    else:
+        expected_state = graph_desc["expected_state"]
+        names = graph_desc["events"]
+
     from graphviz import Digraph
 
     graph = Digraph()
@@ -283,7 +1358,7 @@ def render(graph_desc, render_auth_events, prev_edges):
             nid = get_localpart_from_id(eid)
 
             attrs = {}
-            if nid in graph_desc["expected_state"]:
+            if nid in expected_state:
                 attrs["style"] = "bold"
                 attrs["color"] = "green"
                 attrs["peripheries"] = "2"
@@ -292,7 +1367,7 @@ def render(graph_desc, render_auth_events, prev_edges):
                 attrs["color"] = "grey"
                 attrs["fontcolor"] = "grey"
 
-            if nid in graph_desc["events"]:
+            if nid in names:
                 c.node(nid, **attrs)
             else:
                 graph.node(nid, **attrs)
@@ -317,19 +1392,493 @@ def render(graph_desc, render_auth_events, prev_edges):
     print(graph.source)
 
 
+DEFAULT_BENCH_RESOLVERS = (
+    "algos.auth_resolver.resolver",
+    "algos.mainline.resolver",
+    "algos.ts_mainline.resolver",
+    "algos.existing.resolver",
+)
+
+
+def load_resolver(name):
+    """Import a resolver given its fully qualified name, e.g.
+    "algos.ts_mainline.resolver"
+    """
+    module, func_name = name.rsplit(".", 1)
+    module = importlib.import_module(module)
+    return getattr(module, func_name)
+
+
+def batch_resolver_name(name):
+    """Returns the name of the batch resolver, `resolve_many`, in the module
+    of the given resolver, see `replay_dag`.
+    """
+    return name.rsplit(".", 1)[0] + ".resolve_many"
+
+
+def bench(resolver_names, sizes, generator_args, cache_size=0,
+          compact=False, merge_jobs=1, auth_cache_size=0):
+    """Times each resolver against synthetic graphs of the given sizes and
+    prints a table of the results, followed by a table of how often the
+    resolvers' shortcuts for trivial merges were taken.
+
+    Args:
+        resolver_names (list[str]): Fully qualified resolver names
+        sizes (list[int]): Approximate number of events in each graph
+        generator_args (dict): Keyword arguments for `generate_graph_desc`,
+            excluding `rounds` which is derived from the size.
+        cache_size (int): Size of the resolution cache to use, 0 disables it
+        compact (bool): Whether to build a CompactEventStore for the
+            resolvers to operate on
+        merge_jobs (int): Number of processes to resolve independent merges
+            with, see `replay_dag`
+        auth_cache_size (int): Size of the auth check cache to use, 0
+            disables it
+    """
+    from tabulate import tabulate
+
+    from algos.auth_check_cache import AuthCheckCache
+    from algos.resolution_cache import ResolutionCache
+    from generate_graph import generate_graph_desc, rounds_for_size
+
+    resolvers = [(name, load_resolver(name)) for name in resolver_names]
+
+    rows = []
+    shortcut_rows = []
+    for size in sizes:
+        rounds = rounds_for_size(
+            size,
+            generator_args["members"],
+            generator_args["fork_width"],
+            generator_args["fork_depth"],
+        )
+        graph_desc = generate_graph_desc(rounds=rounds, **generator_args)
+
+        start = time.time()
+        event_map = create_event_map(graph_desc, compact=compact)
+        build_time = time.time() - start
+
+        merges = sum(
+            1 for event in event_map.values() if len(event.prev_events) > 1
+        )
+
+        row = [len(event_map), merges, "%.3fs" % (build_time,)]
+        shortcut_row = [len(event_map), merges]
+        for name, resolution_func in resolvers:
+            resolution_cache = None
+            if cache_size:
+                resolution_cache = ResolutionCache(cache_size)
+
+            # The cache is per room, and we don't want to reuse the results
+            # of one resolver for the next.
+            event_map.auth_check_cache = None
+            if auth_cache_size:
+                event_map.auth_check_cache = AuthCheckCache(auth_cache_size)
+
+            stats = instrumentation.StatsCollector()
+            start = time.time()
+            try:
+                with instrumentation.collecting(stats):
+                    replay_dag(
+                        event_map, resolution_func,
+                        resolution_cache=resolution_cache,
+                        jobs=merge_jobs,
+                    )
+                row.append("%.3fs" % (time.time() - start,))
+            except EventAuthFailure as e:
+                row.append(
+                    "failed (%s)" % (get_localpart_from_id(e.event_id),)
+                )
+            except Exception as e:
+                # Carry on so that the other resolvers are still timed
+                row.append("error (%s)" % (type(e).__name__,))
+                traceback.print_exc()
+
+            summary = stats.summary()
+            shortcut_row.append("%d / %d of %d" % (
+                summary["counters"].get("shortcut_unconflicted", 0),
+                summary["counters"].get("shortcut_non_auth_conflicts", 0),
+                summary["resolutions"],
+            ))
+
+            # Print progress as large graphs take a while
+            print("Finished", name, "with", len(event_map), "events",
+                  file=sys.stderr)
+
+        rows.append(row)
+        shortcut_rows.append(shortcut_row)
+
+    print(tabulate(
+        rows,
+        headers=["Events", "Merges", "Build"] + [
+            name for name, _ in resolvers
+        ],
+    ))
+    print()
+    print(
+        "Shortcuts taken: unconflicted / only non-auth conflicts, of all"
+        " resolutions\n"
+    )
+    print(tabulate(
+        shortcut_rows,
+        headers=["Events", "Merges"] + [name for name, _ in resolvers],
+    ))
+
+
+def generate_room_events(size, generator_args):
+    """Generates a room, see `generate_graph_desc`.
+
+    Args:
+        size (int): Approximate number of events in the room
+        generator_args (dict): Keyword arguments for `generate_graph_desc`,
+            excluding `rounds` which is derived from the size.
+
+    Returns:
+        list[FrozenEvent]: The events of the room, in the order they would
+        arrive, see `order_events`.
+    """
+    from generate_graph import generate_graph_desc, rounds_for_size
+
+    rounds = rounds_for_size(
+        size,
+        generator_args["members"],
+        generator_args["fork_width"],
+        generator_args["fork_depth"],
+    )
+    graph_desc = generate_graph_desc(rounds=rounds, **generator_args)
+
+    _, _, events = _build_events(graph_desc)
+    return order_events(events.values())
+
+
+def bench_ingest(resolver_names, events, ingest, cache_size=0, compact=False):
+    """Times each resolver ingesting new events into a live room with a
+    `RoomReplayer`, against replaying the whole room, and prints a table of
+    the results.
+
+    All but the last `ingest` events are added to the replayer up front. The
+    rest are then added one at a time.
+
+    Args:
+        resolver_names (list[str]): Fully qualified resolver names
+        events (list[FrozenEvent]): The events of the room, in the order they
+            would arrive, see `generate_room_events`
+        ingest (int): Number of events to ingest one at a time, which must be
+            at least one and fewer than the number of events
+        cache_size (int): Size of the resolution cache to use, 0 disables it
+        compact (bool): Whether the replayer should use a CompactEventStore
+    """
+    from tabulate import tabulate
+
+    from algos.compact_store import CompactEventStore
+    from algos.resolution_cache import ResolutionCache
+
+    if not 0 < ingest < len(events):
+        raise ValueError(
+            "Can only ingest between 1 and %d events" % (len(events) - 1,)
+        )
+
+    initial, new = events[:-ingest], events[-ingest:]
+
+    merges = sum(1 for event in new if len(event.prev_events) > 1)
+
+    rows = []
+    for name in resolver_names:
+        resolution_func = load_resolver(name)
+
+        resolution_cache = None
+        if cache_size:
+            resolution_cache = ResolutionCache(cache_size)
+
+        replayer = RoomReplayer(
+            resolution_func,
+            event_map=CompactEventStore() if compact else EventMap(),
+            resolution_cache=resolution_cache,
+        )
+
+        start = time.time()
+        for event in initial:
+            replayer.add_event(event)
+        initial_time = time.time() - start
+
+        start = time.time()
+        for event in new:
+            replayer.add_event(event)
+        ingest_time = time.time() - start
+
+        # The cost of computing the state after a new event by replaying the
+        # whole room
+        start = time.time()
+        replay_dag(replayer.event_map, resolution_func)
+        replay_time = time.time() - start
+
+        rows.append((
+            name,
+            "%.3fs" % (initial_time,),
+            "%.2fms" % (ingest_time * 1000 / len(new),),
+            "%.0f" % (len(new) / max(ingest_time, 1e-9),),
+            "%.3fs" % (replay_time,),
+        ))
+
+        print("Finished", name, file=sys.stderr)
+
+    print("%d events, ingesting the last %d (%d merges)\n" % (
+        len(events), len(new), merges,
+    ))
+    print(tabulate(
+        rows,
+        headers=[
+            "Resolver", "Initial", "Per event", "Events/s", "Full replay",
+        ],
+    ))
+
+
+def bench_sort(sizes, seed=0):
+    """Times the dependency free topological power sort used by ts_mainline
+    against networkx's implementation, on random DAGs shaped like a large set
+    of power events, and prints a table of the results.
+
+    Args:
+        sizes (list[int]): Number of events in each DAG
+        seed: Seed for the random number generator
+    """
+    from networkx import DiGraph
+    from networkx.algorithms import dag as nx_dag
+    from tabulate import tabulate
+
+    rows = []
+    for size in sizes:
+        rng = random.Random(seed)
+
+        # Each event points at a few earlier events, like auth events.
+        graph = {idx: set() for idx in range(size)}
+        for idx in range(1, size):
+            for _ in range(rng.randint(1, 3)):
+                graph[rng.randrange(idx)].add(idx)
+
+        keys = {
+            idx: (
+                -rng.choice((0, 50, 100)),
+                rng.randrange(10 * size),
+                to_event_id("E%d" % (idx,)),
+            )
+            for idx in graph
+        }
+
+        start = time.time()
+        nx_graph = DiGraph()
+        nx_graph.add_nodes_from(graph)
+        for idx, successors in graph.items():
+            nx_graph.add_edges_from((idx, succ) for succ in successors)
+        nx_sorted = list(nx_dag.lexicographical_topological_sort(
+            nx_graph, key=keys.__getitem__,
+        ))
+        nx_time = time.time() - start
+
+        start = time.time()
+        native_sorted = lexicographical_topological_sort(
+            graph, key=keys.__getitem__,
+        )
+        native_time = time.time() - start
+
+        if nx_sorted != native_sorted:
+            raise Exception("Sort orders differ for size %d" % (size,))
+
+        rows.append((
+            size,
+            "%.3fs" % (nx_time,),
+            "%.3fs" % (native_time,),
+            "%.1fx" % (nx_time / max(native_time, 1e-9),),
+        ))
+
+    print(tabulate(rows, headers=["Events", "networkx", "Native", "Speedup"]))
+
+
+_IMPORT_TIME_RE = re.compile(
+    r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$"
+)
+
+
+def import_report(argv, limit=15):
+    """Runs this program with the given arguments under `python -X importtime`
+    and prints the slowest top level imports, and the total time spent
+    importing, to stderr. The program's own output is passed through.
+
+    Args:
+        argv (list[str]): The arguments to run the program with
+        limit (int): Number of imports to list
+
+    Returns:
+        int: The exit code of the program
+    """
+    from tabulate import tabulate
+
+    proc = subprocess.Popen(
+        [sys.executable, "-X", "importtime", __file__] + argv,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+
+    timings = []
+    for line in proc.stderr:
+        if not line.startswith("import time:"):
+            # This is the program's own output
+            sys.stderr.write(line)
+            continue
+
+        match = _IMPORT_TIME_RE.match(line.rstrip("\n"))
+        if not match:
+            # The header line
+            continue
+
+        _, cumulative, indent, name = match.groups()
+
+        # Nested imports are indented by two spaces per level, and are
+        # already included in the cumulative time of their parent.
+        if len(indent) == 0:
+            timings.append((name, int(cumulative)))
+
+    returncode = proc.wait()
+
+    timings.sort(key=lambda timing: timing[1], reverse=True)
+    total = sum(cumulative for _, cumulative in timings)
+
+    rows = [
+        (name, "%.1fms" % (cumulative / 1000.,))
+        for name, cumulative in timings[:limit]
+    ]
+    rows.append(("total (%d modules)" % (len(timings),),
+                 "%.1fms" % (total / 1000.,)))
+
+    print(file=sys.stderr)
+    print(tabulate(rows, headers=["Import", "Cumulative"]), file=sys.stderr)
+
+    return returncode
+
+
+def _add_generator_arguments(parser):
+    """Adds the arguments that control `generate_graph_desc` to the parser
+    """
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--fork-width", type=int, default=2)
+    parser.add_argument("--fork-depth", type=int, default=5)
+    parser.add_argument("--pl-churn", type=float, default=0.05)
+    parser.add_argument("--ban-rate", type=float, default=0.01)
+    parser.add_argument("--topic-spam", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def _generator_args(args):
+    return {
+        "members": args.members,
+        "fork_width": args.fork_width,
+        "fork_depth": args.fork_depth,
+        "pl_churn": args.pl_churn,
+        "ban_rate": args.ban_rate,
+        "topic_spam": args.topic_spam,
+        "seed": args.seed,
+    }
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--import-report", action="store_true",
+        help="Print how long the command spent importing each module",
+    )
 
     subparsers = parser.add_subparsers(dest="command")
 
     parser_resolve = subparsers.add_parser('resolve')
     parser_resolve.add_argument("resolver")
+    parser_resolve.add_argument("files", nargs='+')
+    parser_resolve.add_argument(
+        "--cache-size", type=int, default=0,
+        help="Size of the resolution cache, 0 disables it",
+    )
+    parser_resolve.add_argument(
+        "--evict", action="store_true",
+        help="Drop the state after each event once it's no longer needed",
+    )
+    parser_resolve.add_argument(
+        "--compact", action="store_true",
+        help="Have the resolvers operate on a compact interned event store",
+    )
+    parser_resolve.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="Number of files to resolve in parallel",
+    )
+    parser_resolve.add_argument(
+        "--merge-jobs", type=int, default=1,
+        help="Number of processes to resolve independent merges with",
+    )
     parser_resolve.add_argument(
-        "files", nargs='+', type=argparse.FileType('r'),
+        "--auth-cache-size", type=int, default=0,
+        help="Size of the auth check cache, 0 disables it",
+    )
+    parser_resolve.add_argument(
+        "--stats", action="store_true",
+        help="Print the time spent in each phase of resolution",
+    )
+    parser_resolve.add_argument(
+        "--stats-json", type=argparse.FileType('w'),
+        help="Write the per resolution stats of each file to this file, as "
+             "one line of JSON per file",
+    )
+
+    parser_resolve.add_argument(
+        "--batch-merges", action="store_true",
+        help="Resolve each generation of merges in one call to the "
+             "resolver module's resolve_many",
+    )
+    parser_resolve.add_argument(
+        "--sqlite-store", metavar="PATH",
+        help="Store the events in a SQLite database at this path, replacing "
+             "its contents, and load them lazily from there",
+    )
+    parser_resolve.add_argument(
+        "--event-cache-size", type=int, default=10000,
+        help="Number of events the SQLite store keeps in memory",
+    )
+    parser_resolve.add_argument(
+        "--fetch-latency", type=float, default=0.0,
+        help="Simulated latency in milliseconds of each event fetch made by "
+             "async resolvers",
+    )
+    parser_resolve.add_argument(
+        "--dag-cache", metavar="DIR",
+        help="Cache compiled copies of the graph descriptions in this "
+             "directory, so later runs skip parsing the descriptions",
+    )
+
+    parser_state_at = subparsers.add_parser('state-at')
+    parser_state_at.add_argument("resolver")
+    parser_state_at.add_argument("file")
+    parser_state_at.add_argument(
+        "events", nargs='+',
+        help="Names or event IDs of the events to print the state after",
+    )
+    parser_state_at.add_argument(
+        "--cache-size", type=int, default=0,
+        help="Size of the resolution cache, 0 disables it",
+    )
+    parser_state_at.add_argument(
+        "--compact", action="store_true",
+        help="Have the resolvers operate on a compact interned event store",
+    )
+    parser_state_at.add_argument(
+        "--dag-cache", metavar="DIR",
+        help="Cache compiled copies of the graph descriptions in this "
+             "directory, so later runs skip parsing the descriptions",
     )
 
     parser_render = subparsers.add_parser('render')
-    parser_render.add_argument("file", type=argparse.FileType('r'))
+    parser_render.add_argument("file")
+    parser_render.add_argument(
+        "--dag-cache", metavar="DIR",
+        help="Cache compiled copies of the graph descriptions in this "
+             "directory, so later runs skip parsing the descriptions",
+    )
     parser_render.add_argument("-a", "--auth-events", action="store_true")
     parser_render.add_argument(
         "-e", "--no-prev-edges",
@@ -337,18 +1886,178 @@ if __name__ == "__main__":
         action="store_false",
     )
 
+    parser_generate = subparsers.add_parser('generate')
+    parser_generate.add_argument("--rounds", type=int, default=10)
+    parser_generate.add_argument(
+        "--format", choices=("yaml", "jsonl"), default="yaml",
+    )
+    _add_generator_arguments(parser_generate)
+
+    parser_convert = subparsers.add_parser(
+        'convert',
+        help="Convert a graph description between yaml and line delimited "
+             "JSON, based on the file extensions",
+    )
+    parser_convert.add_argument("input")
+    parser_convert.add_argument("output")
+
+    parser_compile = subparsers.add_parser(
+        'compile',
+        help="Compile a graph description into a binary format that is "
+             "memory mapped when resolving files ending in %s" % (
+                 COMPILED_EXTENSION,
+             ),
+    )
+    parser_compile.add_argument("input")
+    parser_compile.add_argument("output")
+
+    parser_bench = subparsers.add_parser('bench')
+    parser_bench.add_argument(
+        "resolvers", nargs='*', default=list(DEFAULT_BENCH_RESOLVERS),
+    )
+    parser_bench.add_argument(
+        "--sizes",
+        type=lambda s: [int(size) for size in s.split(",")],
+        default=[100, 1000, 10000],
+        help="Comma separated list of approximate graph sizes",
+    )
+    parser_bench.add_argument(
+        "--cache-size", type=int, default=0,
+        help="Size of the resolution cache, 0 disables it",
+    )
+    parser_bench.add_argument(
+        "--compact", action="store_true",
+        help="Have the resolvers operate on a compact interned event store",
+    )
+    parser_bench.add_argument(
+        "--merge-jobs", type=int, default=1,
+        help="Number of processes to resolve independent merges with",
+    )
+    parser_bench.add_argument(
+        "--auth-cache-size", type=int, default=0,
+        help="Size of the auth check cache, 0 disables it",
+    )
+    _add_generator_arguments(parser_bench)
+
+    parser_bench_ingest = subparsers.add_parser('bench-ingest')
+    parser_bench_ingest.add_argument(
+        "resolvers", nargs='*', default=list(DEFAULT_BENCH_RESOLVERS[:-1]),
+    )
+    parser_bench_ingest.add_argument(
+        "--size", type=int, default=10000,
+        help="Approximate number of events in the room",
+    )
+    parser_bench_ingest.add_argument(
+        "--ingest", type=int, default=500,
+        help="Number of events to add to the live room one at a time",
+    )
+    parser_bench_ingest.add_argument(
+        "--cache-size", type=int, default=0,
+        help="Size of the resolution cache, 0 disables it",
+    )
+    parser_bench_ingest.add_argument(
+        "--compact", action="store_true",
+        help="Have the resolvers operate on a compact interned event store",
+    )
+    _add_generator_arguments(parser_bench_ingest)
+
+    parser_bench_sort = subparsers.add_parser('bench-sort')
+    parser_bench_sort.add_argument(
+        "--sizes",
+        type=lambda s: [int(size) for size in s.split(",")],
+        default=[1000, 10000, 100000],
+        help="Comma separated list of numbers of power events",
+    )
+    parser_bench_sort.add_argument("--seed", type=int, default=0)
+
     args = parser.parse_args()
 
-    if args.command == "resolve":
-        module, func_name = args.resolver.rsplit(".", 1)
-        module = importlib.import_module(module)
-        resolver_func = getattr(module, func_name)
+    if args.import_report:
+        argv = [arg for arg in sys.argv[1:] if arg != "--import-report"]
+        sys.exit(import_report(argv))
 
-        for f in args.files:
-            graph_desc = yaml.load(f)
+    if args.command == "resolve":
+        if args.sqlite_store and args.jobs > 1:
+            parser.error("--sqlite-store can't be used with --jobs")
+
+        if args.batch_merges:
+            if args.merge_jobs > 1:
+                parser.error("--batch-merges can't be used with --merge-jobs")
+
+            try:
+                load_resolver(batch_resolver_name(args.resolver))
+            except (ImportError, AttributeError):
+                parser.error(
+                    "--batch-merges needs a resolver module with a "
+                    "resolve_many function, which %s doesn't have" % (
+                        args.resolver,
+                    )
+                )
 
-            print("Resolving", f.name)
-            resolve(graph_desc, resolver_func)
+        all_passed = resolve_files(
+            args.files, args.resolver,
+            jobs=args.jobs,
+            cache_size=args.cache_size,
+            evict=args.evict,
+            compact=args.compact,
+            merge_jobs=args.merge_jobs,
+            show_stats=args.stats,
+            stats_json=args.stats_json,
+            auth_cache_size=args.auth_cache_size,
+            dag_cache_dir=args.dag_cache,
+            batch_merges=args.batch_merges,
+            sqlite_path=args.sqlite_store,
+            event_cache_size=args.event_cache_size,
+            fetch_latency=args.fetch_latency / 1000,
+        )
+        if not all_passed:
+            sys.exit(1)
+    elif args.command == "state-at":
+        if not query_state(
+            args.file, args.resolver, args.events,
+            dag_cache_dir=args.dag_cache, cache_size=args.cache_size,
+            compact=args.compact,
+        ):
+            sys.exit(1)
     elif args.command == "render":
-        graph_desc = yaml.load(args.file)
-        render(graph_desc, args.auth_events, args.prev_edges)
+        with open_graph(args.file, args.dag_cache) as graph_desc:
+            render(graph_desc, args.auth_events, args.prev_edges)
+    elif args.command == "generate":
+        from generate_graph import generate_graph_desc
+
+        graph_desc = generate_graph_desc(
+            rounds=args.rounds, **_generator_args(args)
+        )
+        if args.format == "jsonl":
+            dump_graph_desc_jsonl(graph_desc, sys.stdout)
+        else:
+            dump_graph_desc_yaml(graph_desc, sys.stdout)
+    elif args.command == "convert":
+        graph_desc = load_graph_desc(args.input)
+        with open(args.output, "w") as f:
+            if args.output.endswith(".jsonl"):
+                dump_graph_desc_jsonl(graph_desc, f)
+            else:
+                dump_graph_desc_yaml(graph_desc, f)
+    elif args.command == "compile":
+        compile_file(args.input, args.output)
+    elif args.command == "bench-ingest":
+        events = generate_room_events(args.size, _generator_args(args))
+        if not 0 < args.ingest < len(events):
+            parser.error(
+                "--ingest must be between 1 and %d, one less than the number"
+                " of events in the generated room" % (len(events) - 1,)
+            )
+
+        bench_ingest(
+            args.resolvers, events, args.ingest,
+            cache_size=args.cache_size, compact=args.compact,
+        )
+    elif args.command == "bench-sort":
+        bench_sort(args.sizes, seed=args.seed)
+    elif args.command == "bench":
+        bench(
+            args.resolvers, args.sizes, _generator_args(args),
+            cache_size=args.cache_size, compact=args.compact,
+            merge_jobs=args.merge_jobs, auth_cache_size=args.auth_cache_size,
+        )
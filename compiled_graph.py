@@ -0,0 +1,426 @@
+"""A compact binary format for graphs, which is memory mapped when loaded.
+
+Building the events of a large graph from its description means parsing the
+description, and then expanding every name into a full user, event or room ID
+before creating the events. A compiled graph stores the result of that: the
+events with their IDs already expanded, and in an order in which every event
+comes after both its prev events and its auth events, so they can be added to
+an event map without sorting them first.
+
+This only saves the work of getting from the description to the events. The
+FrozenEvents, and the event map and its indexes, are still built from the
+compiled graph when it's loaded, as replaying the room auth checks every
+event anyway.
+
+The file is laid out as a header followed by a number of sections, each of
+which starts on an 8 byte boundary:
+
+    string offsets: int64 * (strings + 1)
+    strings: the utf-8 encoded strings, interned
+    events: int64 * 6 * events, each of event ID, type, state key (or -1),
+        sender (all string indices), origin_server_ts and the index of the
+        event's content in the content section (or -1 if it has none)
+    prev offsets: int64 * (events + 1)
+    prev targets: int64 * prev edges, event indices
+    auth offsets: int64 * (events + 1)
+    auth targets: int64 * auth edges, event indices
+    expected state: int64 * expected state events, event indices
+    content offsets: int64 * (events with content + 1)
+    content: the JSON encoded content of each event
+
+The integer sections are used straight out of the memory map.
+
+`CompiledGraphCache` keeps compiled copies of graph description files on disk,
+so that repeatedly loading the same file skips parsing and expanding it.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+from synapse.events import FrozenEvent
+
+from algos.event_map import EventMap
+from algos.topological_sort import lexicographical_topological_sort
+
+
+COMPILED_EXTENSION = ".cgraph"
+
+_MAGIC = b"STRESGR1"
+
+# Magic, room ID string index, and the number of strings, events, prev
+# edges, auth edges, expected state events, events with content, and bytes of
+# strings and content.
+_HEADER = struct.Struct("<8s9q")
+
+_EVENT_FIELDS = 6
+
+
+class CompiledGraph(object):
+    """A memory mapped compiled graph. It should be closed once it's no
+    longer needed, which can be done by using it as a context manager.
+
+    Attributes:
+        num_events (int)
+        room_id (str)
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # The views of the sections, which have to be released before the
+        # memory map can be closed.
+        self._views = []
+
+        try:
+            self._load(path)
+        except BaseException:
+            self.close()
+            raise
+
+    def _load(self, path):
+        if len(self._mmap) < _HEADER.size:
+            raise ValueError("%s is not a compiled graph" % (path,))
+
+        (
+            magic, room_id, num_strings, num_events, num_prev, num_auth,
+            num_expected, num_contents, strings_len, content_len,
+        ) = _HEADER.unpack_from(self._mmap, 0)
+
+        if magic != _MAGIC:
+            raise ValueError("%s is not a compiled graph" % (path,))
+
+        view = memoryview(self._mmap)
+        self._views.append(view)
+        offset = _HEADER.size
+
+        def section(length, int_array=True):
+            nonlocal offset
+            size = length * 8 if int_array else length
+            data = view[offset:offset + size]
+            self._views.append(data)
+            if len(data) != size:
+                raise ValueError("%s is truncated" % (path,))
+
+            offset = _align(offset + size)
+            if int_array:
+                data = data.cast("q")
+                self._views.append(data)
+            return data
+
+        self._string_offsets = section(num_strings + 1)
+        self._strings = section(strings_len, int_array=False)
+        self._events = section(num_events * _EVENT_FIELDS)
+        self._prev_offsets = section(num_events + 1)
+        self._prev_targets = section(num_prev)
+        self._auth_offsets = section(num_events + 1)
+        self._auth_targets = section(num_auth)
+        self._expected_state = section(num_expected)
+        self._content_offsets = section(num_contents + 1)
+        self._content = section(content_len, int_array=False)
+
+        self._string_cache = {}
+
+        self.num_events = num_events
+        self.room_id = self._get_string(room_id)
+
+    def _get_string(self, idx):
+        string = self._string_cache.get(idx)
+        if string is None:
+            start = self._string_offsets[idx]
+            end = self._string_offsets[idx + 1]
+            string = str(self._strings[start:end], "utf-8")
+            self._string_cache[idx] = string
+        return string
+
+    def get_event_id(self, idx):
+        return self._get_string(self._events[idx * _EVENT_FIELDS])
+
+    def get_prev_events(self, idx):
+        """Returns the event indices of the prev events of the event
+
+        Returns:
+            memoryview
+        """
+        return self._prev_targets[
+            self._prev_offsets[idx]:self._prev_offsets[idx + 1]
+        ]
+
+    def get_auth_events(self, idx):
+        """Returns the event indices of the auth events of the event
+
+        Returns:
+            memoryview
+        """
+        return self._auth_targets[
+            self._auth_offsets[idx]:self._auth_offsets[idx + 1]
+        ]
+
+    @property
+    def expected_state(self):
+        """The event IDs of the events in the expected end state
+
+        Returns:
+            list[str]
+        """
+        return [self.get_event_id(idx) for idx in self._expected_state]
+
+    def get_event(self, idx):
+        """Create the event with the given index
+
+        Returns:
+            FrozenEvent
+        """
+        (
+            event_id, type_idx, state_key, sender, origin_server_ts,
+            content_idx,
+        ) = self._events[idx * _EVENT_FIELDS:(idx + 1) * _EVENT_FIELDS]
+
+        event = {
+            "event_id": self._get_string(event_id),
+            "type": self._get_string(type_idx),
+            "sender": self._get_string(sender),
+            "prev_events": [
+                (self.get_event_id(pid), "")
+                for pid in self.get_prev_events(idx)
+            ],
+            "auth_events": [
+                (self.get_event_id(aid), "")
+                for aid in self.get_auth_events(idx)
+            ],
+            "room_id": self.room_id,
+            "depth": 0,
+            "origin_server_ts": origin_server_ts,
+        }
+        if state_key != -1:
+            event["state_key"] = self._get_string(state_key)
+        if content_idx != -1:
+            content = self._content[
+                self._content_offsets[content_idx]:
+                self._content_offsets[content_idx + 1]
+            ]
+            event["content"] = json.loads(str(content, "utf-8"))
+
+        return FrozenEvent(event)
+
+    def to_event_map(self, compact=False):
+        """Create the events and add them to a new event map. The events are
+        stored in an order they can be added in as is.
+
+        Args:
+            compact (bool): Whether to return a CompactEventStore
+
+        Returns:
+            EventMap
+        """
+        if compact:
+            from algos.compact_store import CompactEventStore
+            event_map = CompactEventStore()
+        else:
+            event_map = EventMap()
+
+        for idx in range(self.num_events):
+            event_map.add_event(self.get_event(idx))
+        return event_map
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Unmap the file. Events that have already been created can still be
+        used.
+        """
+        for view in self._views:
+            view.release()
+        self._mmap.close()
+
+
+def write_compiled_graph(f, events, expected_state):
+    """Write the events to a file as a compiled graph.
+
+    Args:
+        f (file): A file opened in binary mode
+        events (dict[str, FrozenEvent]): All the events in the graph
+        expected_state (list[str]): The event IDs in the expected end state
+
+    Raises:
+        ValueError: if the events have no order in which they come after
+            both their prev and auth events
+    """
+    # Order the events so that each comes after its prev and auth events
+    children = {eid: set() for eid in events}
+    for eid, event in events.items():
+        for pid, _ in event.prev_events:
+            children[pid].add(eid)
+        for aid, _ in event.auth_events:
+            children[aid].add(eid)
+
+    ordered = lexicographical_topological_sort(
+        children, key=lambda eid: events[eid].origin_server_ts,
+    )
+    event_idx = {eid: idx for idx, eid in enumerate(ordered)}
+
+    strings = []
+    string_idx = {}
+
+    def intern(string):
+        idx = string_idx.get(string)
+        if idx is None:
+            idx = len(strings)
+            strings.append(string.encode("utf-8"))
+            string_idx[string] = idx
+        return idx
+
+    room_id = None
+    event_fields = []
+    prev_offsets = [0]
+    prev_targets = []
+    auth_offsets = [0]
+    auth_targets = []
+    contents = []
+
+    for eid in ordered:
+        event = events[eid]
+        room_id = event.room_id
+
+        content_idx = -1
+        if "content" in event:
+            content_idx = len(contents)
+            contents.append(json.dumps(
+                event.content, sort_keys=True, separators=(",", ":"),
+            ).encode("utf-8"))
+
+        event_fields.extend((
+            intern(eid),
+            intern(event.type),
+            intern(event.state_key) if event.is_state() else -1,
+            intern(event.sender),
+            event.origin_server_ts,
+            content_idx,
+        ))
+
+        prev_targets.extend(event_idx[pid] for pid, _ in event.prev_events)
+        prev_offsets.append(len(prev_targets))
+
+        auth_targets.extend(event_idx[aid] for aid, _ in event.auth_events)
+        auth_offsets.append(len(auth_targets))
+
+    room_id = intern(room_id) if room_id is not None else -1
+
+    string_offsets = _offsets(strings)
+    content_offsets = _offsets(contents)
+
+    f.write(_HEADER.pack(
+        _MAGIC, room_id, len(strings), len(ordered), len(prev_targets),
+        len(auth_targets), len(expected_state), len(contents),
+        string_offsets[-1], content_offsets[-1],
+    ))
+
+    written = _HEADER.size
+    for data in (
+        _pack_ints(string_offsets),
+        b"".join(strings),
+        _pack_ints(event_fields),
+        _pack_ints(prev_offsets),
+        _pack_ints(prev_targets),
+        _pack_ints(auth_offsets),
+        _pack_ints(auth_targets),
+        _pack_ints(event_idx[eid] for eid in expected_state),
+        _pack_ints(content_offsets),
+        b"".join(contents),
+    ):
+        f.write(data)
+        written += len(data)
+
+        padding = _align(written) - written
+        f.write(b"\0" * padding)
+        written += padding
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _offsets(chunks):
+    offsets = [0]
+    for chunk in chunks:
+        offsets.append(offsets[-1] + len(chunk))
+    return offsets
+
+
+def _pack_ints(ints):
+    ints = list(ints)
+    return struct.pack("<%dq" % (len(ints),), *ints)
+
+
+class CompiledGraphCache(object):
+    """An on disk cache of compiled graph descriptions. This saves parsing
+    and expanding the descriptions, but not building the events from them,
+    see `CompiledGraph.to_event_map`.
+
+    Entries are keyed by a hash of the content of the description file and a
+    salt, which should change whenever anything else that goes into building
+    the events does. Stale entries for a file are removed when it's next
+    compiled.
+
+    Args:
+        directory (str): Where to keep the compiled graphs, created if missing
+        salt (str)
+    """
+
+    def __init__(self, directory, salt):
+        self._directory = directory
+        self._salt = salt.encode("utf-8")
+
+    def load(self, path, compile_file):
+        """Load the compiled graph of a graph description file, compiling it
+        if there isn't an up to date one in the cache.
+
+        Args:
+            path (str): The graph description file
+            compile_file (callable[str, str]): Called with the path of the
+                description and the path to write the compiled graph to
+
+        Returns:
+            CompiledGraph
+        """
+        with open(path, "rb") as f:
+            content = f.read()
+
+        prefix = hashlib.sha256(
+            os.path.abspath(path).encode("utf-8"),
+        ).hexdigest()[:16]
+        key = hashlib.sha256(_MAGIC + self._salt + content).hexdigest()
+        cached_path = os.path.join(
+            self._directory, "%s-%s%s" % (prefix, key, COMPILED_EXTENSION),
+        )
+
+        if os.path.exists(cached_path):
+            return CompiledGraph(cached_path)
+
+        os.makedirs(self._directory, exist_ok=True)
+        for name in os.listdir(self._directory):
+            if name.startswith(prefix + "-"):
+                os.unlink(os.path.join(self._directory, name))
+
+        # Compile to a temporary file first, so that concurrent loads never
+        # see a partially written graph.
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self._directory, suffix=".tmp",
+        )
+        os.close(fd)
+        try:
+            compile_file(path, tmp_path)
+            os.replace(tmp_path, cached_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return CompiledGraph(cached_path)
@@ -0,0 +1,265 @@
+"""Generates synthetic graph descriptions of large rooms.
+
+The generated descriptions have the same shape as the hand written yaml files
+in test_cases/, i.e. they can be passed straight to `create_dag`. The room
+starts with a linear run of joins, and then repeatedly forks into a number of
+branches which are later merged back together by a single message.
+
+Only the room creator (alice) ever sends power events and she never loses
+power, and anyone that gets banned or kicked never sends another event. This
+ensures every event passes auth no matter how the forks get resolved, so the
+graphs can be replayed with any resolver.
+
+The generated graphs have no expected state, as that depends on the
+resolution algorithm used; they are intended for benchmarking.
+"""
+
+import random
+
+from synapse.api.constants import EventTypes, Membership
+
+
+ADMIN = "alice"
+
+# The members that exist in INITIAL_EVENTS, other than the admin. zara sends
+# the START and END events so must never be banned.
+INITIAL_MEMBERS = ("bob", "charlie", "zara")
+PROTECTED_MEMBERS = (ADMIN, "zara")
+
+
+class _RoomGenerator(object):
+    """Keeps track of the events generated so far, along with the state as
+    seen by the branch currently being generated.
+    """
+
+    def __init__(self, rng):
+        self.rng = rng
+
+        self.events = {}
+        self.edges = []
+        self.auth = {}
+
+        self.counter = 0
+
+        # Map from (type, state_key) to the name of the event, using the
+        # initial events from check_resolution.
+        self.state = {
+            (EventTypes.PowerLevels, ""): "IPOWER",
+            (EventTypes.JoinRules, ""): "IJR",
+            (EventTypes.Member, ADMIN): "IMA",
+            (EventTypes.Member, "bob"): "IMB",
+            (EventTypes.Member, "charlie"): "IMC",
+            (EventTypes.Member, "zara"): "IMZ",
+        }
+
+        # Members that can still send events
+        self.active = [ADMIN] + list(INITIAL_MEMBERS)
+
+    def add_event(self, prefix, prev_events, auth_keys, event):
+        """Add an event to the graph, updating the current state if its a
+        state event.
+
+        Args:
+            prefix (str): Prefix of the generated event name
+            prev_events (list[str]): Names of the prev events
+            auth_keys (list[tuple[str, str]]): State keys of the auth events,
+                these get looked up in the current state.
+            event (dict): The event description
+
+        Returns:
+            str: The name of the new event
+        """
+        self.counter += 1
+        name = "%s%d" % (prefix, self.counter)
+
+        self.events[name] = event
+        for prev in prev_events:
+            self.edges.append([name, prev])
+        self.auth[name] = [
+            self.state[key] for key in auth_keys if key in self.state
+        ]
+
+        if "state_key" in event:
+            self.state[(event["type"], event["state_key"])] = name
+
+        return name
+
+    def add_random_event(self, prev, pl_churn, ban_rate, topic_spam):
+        """Add a randomly chosen event on top of `prev`.
+
+        Returns:
+            str: The name of the new event
+        """
+        roll = self.rng.random()
+
+        targets = [m for m in self.active if m not in PROTECTED_MEMBERS]
+
+        if roll < pl_churn:
+            return self.add_power_levels(prev)
+
+        roll -= pl_churn
+        if roll < ban_rate and targets:
+            target = self.rng.choice(targets)
+            self.active.remove(target)
+
+            membership = self.rng.choice((Membership.BAN, Membership.LEAVE))
+            return self.add_event(
+                "B", [prev], [
+                    (EventTypes.PowerLevels, ""),
+                    (EventTypes.Member, ADMIN),
+                    (EventTypes.Member, target),
+                ],
+                {
+                    "type": EventTypes.Member,
+                    "state_key": target,
+                    "sender": ADMIN,
+                    "content": {"membership": membership},
+                },
+            )
+
+        roll -= ban_rate
+        sender = self.rng.choice(self.active)
+        if roll < topic_spam:
+            return self.add_event(
+                "T", [prev], [
+                    (EventTypes.PowerLevels, ""),
+                    (EventTypes.Member, sender),
+                ],
+                {
+                    "type": EventTypes.Topic,
+                    "state_key": "",
+                    "sender": sender,
+                    "content": {"topic": "Topic %d" % (self.counter,)},
+                },
+            )
+
+        return self.add_event(
+            "M", [prev], [
+                (EventTypes.PowerLevels, ""),
+                (EventTypes.Member, sender),
+            ],
+            {
+                "type": EventTypes.Message,
+                "sender": sender,
+                "content": {},
+            },
+        )
+
+    def add_power_levels(self, prev):
+        """Add a power levels event sent by the admin, picking a new random
+        set of moderators.
+
+        Returns:
+            str: The name of the new event
+        """
+        users = {ADMIN: 100}
+        candidates = [m for m in self.active if m != ADMIN]
+        for user in self.rng.sample(candidates, min(3, len(candidates))):
+            users[user] = 50
+
+        return self.add_event(
+            "P", [prev], [
+                (EventTypes.PowerLevels, ""),
+                (EventTypes.Member, ADMIN),
+            ],
+            {
+                "type": EventTypes.PowerLevels,
+                "state_key": "",
+                "sender": ADMIN,
+                "content": {
+                    "users": users,
+                    # Let everyone spam the topic
+                    "events": {EventTypes.Topic: 0},
+                },
+            },
+        )
+
+
+def generate_graph_desc(members=10, fork_width=2, fork_depth=5, rounds=10,
+                        pl_churn=0.05, ban_rate=0.01, topic_spam=0.1, seed=0):
+    """Generate a graph description of a large room.
+
+    Args:
+        members (int): Number of members to join to the room, in addition to
+            the ones in the initial events.
+        fork_width (int): Number of branches each fork splits into
+        fork_depth (int): Number of events in each branch of a fork
+        rounds (int): Number of times the room forks and merges
+        pl_churn (float): Probability an event is a power levels change
+        ban_rate (float): Probability an event is a ban or kick
+        topic_spam (float): Probability an event is a topic change
+        seed: Seed for the random number generator
+
+    Returns:
+        dict: A graph description, suitable for passing to `create_dag`
+    """
+    gen = _RoomGenerator(random.Random(seed))
+
+    head = gen.add_power_levels("START")
+
+    for i in range(members):
+        user = "m%d" % (i,)
+        head = gen.add_event(
+            "J", [head], [
+                (EventTypes.PowerLevels, ""),
+                (EventTypes.JoinRules, ""),
+            ],
+            {
+                "type": EventTypes.Member,
+                "state_key": user,
+                "sender": user,
+                "content": {"membership": Membership.JOIN},
+            },
+        )
+        gen.active.append(user)
+
+    for _ in range(rounds):
+        base_state = gen.state
+        merged_state = dict(base_state)
+
+        tips = []
+        for _ in range(fork_width):
+            gen.state = dict(base_state)
+
+            tip = head
+            for _ in range(fork_depth):
+                tip = gen.add_random_event(
+                    tip, pl_churn, ban_rate, topic_spam,
+                )
+            tips.append(tip)
+
+            # The declared auth events after the merge just use the state of
+            # whichever branch changed each key last.
+            for key, name in gen.state.items():
+                if base_state.get(key) != name:
+                    merged_state[key] = name
+
+        gen.state = merged_state
+        head = gen.add_event(
+            "X", tips, [
+                (EventTypes.PowerLevels, ""),
+                (EventTypes.Member, ADMIN),
+            ],
+            {
+                "type": EventTypes.Message,
+                "sender": ADMIN,
+                "content": {},
+            },
+        )
+
+    gen.edges.append(["END", head])
+
+    return {
+        "events": gen.events,
+        "edges": gen.edges,
+        "auth": gen.auth,
+        "expected_state": [],
+    }
+
+
+def rounds_for_size(size, members, fork_width, fork_depth):
+    """Returns the number of rounds needed for `generate_graph_desc` to
+    generate roughly `size` events.
+    """
+    per_round = fork_width * fork_depth + 1
+    return max(1, (size - members) // per_round)
@@ -0,0 +1,140 @@
+"""Loads and saves graph descriptions.
+
+Graph descriptions are normally yaml files, which are loaded with libyaml's
+CSafeLoader when PyYAML has been built with it, as the pure python loader is
+very slow on large files.
+
+Large graphs can also be stored as line delimited JSON, which is much faster
+to parse and is read a line at a time rather than all at once. Files ending
+in `.jsonl` are assumed to be in this format, where each line is one of:
+
+    {"event": "T1", "type": "m.room.topic", "state_key": "", ...}
+        An event, where "event" is its name and the other fields are as in
+        the "events" section of the yaml files.
+    {"edges": ["END", "T1", "START"]}
+        A chain of prev event edges, as in the "edges" section.
+    {"auth": "T1", "auth_events": ["IPOWER"]}
+        The auth events of an event, as in the "auth" section.
+    {"expected_state": ["T1"]}
+        Events in the expected end state. This can appear more than once.
+"""
+
+import json
+
+
+def load_graph_desc(path):
+    """Load a graph description from a yaml or, if the path ends in
+    `.jsonl`, line delimited JSON file.
+
+    Args:
+        path (str)
+
+    Returns:
+        dict: The graph description
+    """
+    if path.endswith(".jsonl"):
+        with open(path) as f:
+            return load_graph_desc_jsonl(f)
+
+    with open(path) as f:
+        return load_graph_desc_yaml(f)
+
+
+def load_graph_desc_yaml(f):
+    """Load a graph description from a yaml file.
+
+    Args:
+        f (file)
+
+    Returns:
+        dict
+    """
+    import yaml
+
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    return yaml.load(f, Loader=loader)
+
+
+def load_graph_desc_jsonl(f):
+    """Load a graph description from a line delimited JSON file, see the
+    module docstring for the format.
+
+    Args:
+        f (file)
+
+    Raises:
+        ValueError: if a line isn't a valid record
+
+    Returns:
+        dict
+    """
+    graph_desc = {
+        "events": {},
+        "edges": [],
+        "auth": {},
+        "expected_state": [],
+    }
+
+    for line_number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise ValueError("Line %d: %s" % (line_number, e))
+
+        if "event" in record:
+            name = record.pop("event")
+            graph_desc["events"][name] = record
+        elif "edges" in record:
+            graph_desc["edges"].append(record["edges"])
+        elif "auth" in record:
+            graph_desc["auth"][record["auth"]] = record["auth_events"]
+        elif "expected_state" in record:
+            graph_desc["expected_state"].extend(record["expected_state"])
+        else:
+            raise ValueError("Line %d: unknown record" % (line_number,))
+
+    return graph_desc
+
+
+def dump_graph_desc_yaml(graph_desc, f):
+    """Write a graph description to a file as yaml.
+
+    Args:
+        graph_desc (dict)
+        f (file)
+    """
+    import yaml
+
+    dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+    # Keep the events in order, as they are given timestamps in the order
+    # they appear in.
+    yaml.dump(graph_desc, f, Dumper=dumper, sort_keys=False)
+
+
+def dump_graph_desc_jsonl(graph_desc, f):
+    """Write a graph description to a file as line delimited JSON.
+
+    Args:
+        graph_desc (dict)
+        f (file)
+    """
+    for name, event in graph_desc["events"].items():
+        record = {"event": name}
+        record.update(event)
+        f.write(json.dumps(record) + "\n")
+
+    for edges in graph_desc["edges"]:
+        f.write(json.dumps({"edges": edges}) + "\n")
+
+    for name, auth_events in graph_desc["auth"].items():
+        f.write(json.dumps({"auth": name, "auth_events": auth_events}) + "\n")
+
+    if graph_desc["expected_state"]:
+        f.write(json.dumps(
+            {"expected_state": graph_desc["expected_state"]}
+        ) + "\n")
@@ -0,0 +1,48 @@
+import io
+import unittest
+
+from check_resolution import create_event_map, load_resolver, replay_dag
+from generate_graph import generate_graph_desc
+from graph_loader import (
+    dump_graph_desc_jsonl, dump_graph_desc_yaml, load_graph_desc_jsonl,
+    load_graph_desc_yaml,
+)
+
+
+class RoundTripTestCase(unittest.TestCase):
+    """Dumping and reloading a graph description should describe the same
+    room, which includes keeping the events in order as that's what their
+    timestamps are assigned from.
+    """
+
+    def setUp(self):
+        self.graph_desc = generate_graph_desc(members=5, rounds=5, seed=1)
+
+    def assert_same_room(self, reloaded):
+        self.assertEqual(
+            list(reloaded["events"]), list(self.graph_desc["events"]),
+        )
+
+        resolution_func = load_resolver("algos.ts_mainline.resolver")
+        expected = replay_dag(
+            create_event_map(self.graph_desc), resolution_func,
+        )
+        actual = replay_dag(create_event_map(reloaded), resolution_func)
+        self.assertEqual(
+            {eid: dict(state) for eid, state in actual.items()},
+            {eid: dict(state) for eid, state in expected.items()},
+        )
+
+    def test_yaml(self):
+        f = io.StringIO()
+        dump_graph_desc_yaml(self.graph_desc, f)
+        f.seek(0)
+
+        self.assert_same_room(load_graph_desc_yaml(f))
+
+    def test_jsonl(self):
+        f = io.StringIO()
+        dump_graph_desc_jsonl(self.graph_desc, f)
+        f.seek(0)
+
+        self.assert_same_room(load_graph_desc_jsonl(f))
@@ -0,0 +1,113 @@
+import asyncio
+import glob
+import unittest
+
+from algos import ts_mainline, ts_mainline_async
+from algos.ts_mainline_async import (
+    EventLoader, SyncDriver, make_event_map_fetcher,
+)
+from check_resolution import (
+    create_event_map, load_graph_desc, replay_dag, to_event_id,
+)
+from generate_graph import generate_graph_desc
+
+
+class RecordingFetcher(object):
+    """A fake store that looks events up in an event map after a delay,
+    recording the batches it's asked for.
+    """
+
+    def __init__(self, event_map, latency=0.001):
+        self._fetcher = make_event_map_fetcher(event_map, latency)
+        self.batches = []
+
+    async def __call__(self, event_ids):
+        self.batches.append(list(event_ids))
+        return await self._fetcher(event_ids)
+
+
+class SyncDriverTestCase(unittest.TestCase):
+    def assert_same_states(self, event_map):
+        driver = SyncDriver(ts_mainline_async.resolver, latency=0.001)
+        try:
+            actual = replay_dag(event_map, driver)
+        finally:
+            driver.close()
+
+        expected = replay_dag(event_map, ts_mainline.resolver)
+        self.assertEqual(
+            {eid: dict(state) for eid, state in actual.items()},
+            {eid: dict(state) for eid, state in expected.items()},
+        )
+
+    def test_test_cases(self):
+        for path in sorted(glob.glob("test_cases/*.yaml")):
+            with self.subTest(path=path):
+                self.assert_same_states(
+                    create_event_map(load_graph_desc(path)),
+                )
+
+    def test_generated(self):
+        self.assert_same_states(create_event_map(
+            generate_graph_desc(members=5, rounds=5, seed=2),
+        ))
+
+
+class EventLoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.event_map = create_event_map(
+            load_graph_desc("test_cases/topic.yaml"),
+        )
+        self.fetcher = RecordingFetcher(self.event_map)
+        self.loader = EventLoader(self.fetcher)
+
+    def run_async(self, coro):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def test_concurrent_lookups_are_batched(self):
+        event_ids = list(self.event_map)
+
+        async def load():
+            return await asyncio.gather(*(
+                self.loader.get_events([event_id]) for event_id in event_ids
+            ))
+
+        results = self.run_async(load())
+
+        self.assertEqual(len(self.fetcher.batches), 1)
+        self.assertCountEqual(self.fetcher.batches[0], event_ids)
+        for event_id, result in zip(event_ids, results):
+            self.assertIs(result[event_id], self.event_map[event_id])
+
+    def test_loaded_events_are_not_refetched(self):
+        event_id = to_event_id("START")
+        self.run_async(self.loader.get_events([event_id]))
+        self.run_async(self.loader.get_events([event_id]))
+
+        self.assertEqual(self.fetcher.batches, [[event_id]])
+
+    def test_resolution_fetches_in_batches(self):
+        loop = asyncio.new_event_loop()
+
+        def resolver(state_sets, event_map):
+            return loop.run_until_complete(
+                ts_mainline_async.resolver(state_sets, self.loader),
+            )
+
+        try:
+            replay_dag(self.event_map, resolver)
+        finally:
+            loop.close()
+
+        self.assertEqual(
+            len(set().union(*self.fetcher.batches)), self.loader.fetched,
+        )
+        self.assertLess(len(self.fetcher.batches), self.loader.fetched)
+
+    def test_missing_event(self):
+        with self.assertRaises(KeyError):
+            self.run_async(self.loader.get_events(["$missing:example.com"]))